@@ -0,0 +1,335 @@
+import argparse
+import json
+import os
+import pathlib
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta, timezone
+
+import duckdb
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.resolve()))
+
+from chargecloud.repository import ChargeCloudRepository  # noqa: E402
+from chargecloud.util import load_locations_df  # noqa: E402
+from load_test import SERVER_PATH, send, wait_until_ready  # noqa: E402
+
+
+# ids of the db used by the cases: the busiest station / chargepoint, the city and state of the station's location
+def sample_ids(db_path: str) -> dict:
+    conn = duckdb.connect(database=db_path, read_only=True)
+    station_id, location_id = conn.execute(
+        "SELECT cp.stationId, cp.locationId FROM transactions tr JOIN chargepoints cp ON tr.chargePointId == cp.id "
+        "GROUP BY ALL ORDER BY count(*) DESC, 1 LIMIT 1"
+    ).fetchone()
+    chargepoint_id = conn.execute(
+        "SELECT chargePointId FROM transactions GROUP BY 1 ORDER BY count(*) DESC, 1 LIMIT 1"
+    ).fetchone()[0]
+    latitude, longitude = conn.execute(
+        "SELECT latitude, longitude FROM locations WHERE id = ?", [location_id]
+    ).fetchone()
+    day = conn.execute("SELECT date_trunc('day', min(startedAt)) FROM transactions").fetchone()[0]
+    locations_df = load_locations_df()
+    city, state = locations_df[locations_df["id"] == location_id][["city", "state"]].iloc[0]
+    station_ids = [r[0] for r in conn.execute("SELECT id FROM stations ORDER BY id LIMIT 20").fetchall()]
+    conn.close()
+    return {
+        "station_id": station_id,
+        "station_ids": station_ids,
+        "chargepoint_id": chargepoint_id,
+        "city": city,
+        "state": state,
+        "latitude": latitude,
+        "longitude": longitude,
+        "day_from": day.isoformat(),
+        "day_to": (day + timedelta(days=1)).isoformat(),
+    }
+
+
+# (name, repository call) of every public repository method
+def method_cases(repo: ChargeCloudRepository, ids: dict) -> list:
+    city, state = ids["city"], ids["state"]
+    cases = []
+    for statistics_type in ["kwhConsumed", "turnoverEur"]:
+        for interval_type in ["hourly", "daily", "allTime"]:
+            cases.append(
+                (
+                    f"get_statistics_by_station[{statistics_type},{interval_type}]",
+                    lambda s=statistics_type, i=interval_type: repo.get_statistics_by_station(ids["station_id"], s, i),
+                )
+            )
+    cases += [
+        (
+            "get_statistics_by_station[turnoverEur,hourly,window]",
+            lambda: repo.get_statistics_by_station(
+                ids["station_id"], "turnoverEur", "hourly", time_from=ids["day_from"], time_to=ids["day_to"]
+            ),
+        ),
+        (
+            "get_statistics_by_location[city,turnoverEur,daily]",
+            lambda: repo.get_statistics_by_location(city, True, "turnoverEur", "daily"),
+        ),
+        (
+            "get_statistics_by_location[state,turnoverEur,daily]",
+            lambda: repo.get_statistics_by_location(state, False, "turnoverEur", "daily"),
+        ),
+        (
+            "get_statistics_batch[daily]",
+            lambda: repo.get_statistics_batch(
+                "daily", station_ids=ids["station_ids"], city_names=[city], state_names=[state]
+            ),
+        ),
+        ("get_blocking_time_by_station", lambda: repo.get_blocking_time_by_station(ids["station_id"])),
+        (
+            "get_blocking_time_by_station[summary]",
+            lambda: repo.get_blocking_time_by_station(ids["station_id"], summary=True),
+        ),
+        (
+            "get_charge_point_status_event_reliability_pct",
+            lambda: repo.get_charge_point_status_event_reliability_pct(ids["chargepoint_id"]),
+        ),
+        ("get_charge_points_status_event_reliability_pct", repo.get_charge_points_status_event_reliability_pct),
+        (
+            "get_stations_within_radius[50km]",
+            lambda: repo.get_stations_within_radius(ids["latitude"], ids["longitude"], 50),
+        ),
+    ]
+    for attr in ["stations", "chargepoints", "city", "state"]:
+        cases.append((f"list_all[{attr}]", lambda a=attr: repo.list_all(a)))
+    cases.append(("validate", repo.validate))
+    return cases
+
+
+# (name, method, path, json payload) of every route
+def route_cases(ids: dict) -> list:
+    station, city, state = ids["station_id"], ids["city"], ids["state"]
+    cases = [
+        (f"GET /station/:id/{s}/{i}", "GET", f"/station/{station}/{s}/{i}", None)
+        for s in ["kwhConsumed", "turnoverEur"]
+        for i in ["hourly", "daily", "allTime"]
+    ]
+    cases += [
+        ("GET /station/:id/blockingTime", "GET", f"/station/{station}/blockingTime", None),
+        ("GET /station/:id/blockingTime?summary", "GET", f"/station/{station}/blockingTime?summary=true", None),
+        (
+            "POST /city/statistics",
+            "POST",
+            "/city/statistics",
+            {"city_name": city, "statistics_type": "turnoverEur", "interval_type": "daily"},
+        ),
+        (
+            "POST /state/statistics",
+            "POST",
+            "/state/statistics",
+            {"state_name": state, "statistics_type": "turnoverEur", "interval_type": "daily"},
+        ),
+        (
+            "POST /statistics/batch",
+            "POST",
+            "/statistics/batch",
+            {"interval_type": "daily", "station_ids": ids["station_ids"], "city_names": [city]},
+        ),
+        ("GET /chargepoint/:id/reliability", "GET", f"/chargepoint/{ids['chargepoint_id']}/reliability", None),
+        ("GET /chargepoints/reliability", "GET", "/chargepoints/reliability", None),
+        (
+            "POST /stationsInRadius",
+            "POST",
+            "/stationsInRadius",
+            {"latitude": ids["latitude"], "longitude": ids["longitude"], "radius_km": 50},
+        ),
+        ("GET /stations/list", "GET", "/stations/list", None),
+        ("GET /chargepoints/list", "GET", "/chargepoints/list", None),
+        ("GET /cities/list", "GET", "/cities/list", None),
+        ("GET /states/list", "GET", "/states/list", None),
+        ("GET /validate", "GET", "/validate", None),
+    ]
+    return cases
+
+
+def summarize(latencies_s: list) -> dict:
+    latencies_s = sorted(latencies_s)
+    return {
+        "runs": len(latencies_s),
+        "p50_ms": round(statistics.median(latencies_s) * 1000, 3),
+        "p95_ms": round(latencies_s[min(int(len(latencies_s) * 0.95), len(latencies_s) - 1)] * 1000, 3),
+    }
+
+
+# p50/p95 of the repeated calls, then the peak of the python allocations of an additional traced call
+# (duckdb's own memory isn't allocated by python and isn't included, see max_rss_mb)
+def benchmark_methods(repo: ChargeCloudRepository, cases: list, repeat: int) -> dict:
+    results = {}
+    for name, call in cases:
+        call()  # warm-up
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - start)
+        tracemalloc.start()
+        call()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = {**summarize(latencies), "peak_python_mb": round(peak_bytes / 2**20, 3)}
+        print_result(name, results[name])
+    return results
+
+
+# peak resident memory of a process (linux only)
+def peak_rss_mb(pid: int):
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+# p50/p95 of the routes (one request at a time) and the peak resident memory of the server after each route
+def benchmark_routes(db_path: str, cases: list, repeat: int, port: int) -> dict:
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, DB_PATH=db_path, WEBSERVER_PORT=str(port), RESPONSE_CACHE_MAX_ENTRIES="0")
+    process = subprocess.Popen(
+        [sys.executable, SERVER_PATH], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    results = {}
+    try:
+        wait_until_ready(base_url, process)
+        for name, method, path, payload in cases:
+            send(base_url, method, path, payload)  # warm-up
+            latencies = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                send(base_url, method, path, payload)
+                latencies.append(time.perf_counter() - start)
+            results[name] = {**summarize(latencies), "server_peak_rss_mb": peak_rss_mb(process.pid)}
+            print_result(name, results[name])
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+
+# time from spawning the server until it accepts connections (any response, 503 while starting) and until it is
+# ready (200 on /), over several cold starts
+def benchmark_startup(db_path: str, runs: int, port: int) -> dict:
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, DB_PATH=db_path, WEBSERVER_PORT=str(port))
+    listening_s, ready_s = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, SERVER_PATH], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        listening = None
+        try:
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError("server exited during startup")
+                try:
+                    with urllib.request.urlopen(base_url + "/", timeout=10) as response:
+                        response.read()
+                    break
+                except urllib.error.HTTPError:
+                    # 503 while the repository loads
+                    listening = listening or time.perf_counter() - start
+                except (urllib.error.URLError, ConnectionError):
+                    pass
+                time.sleep(0.005)
+            ready = time.perf_counter() - start
+            listening_s.append(listening or ready)
+            ready_s.append(ready)
+        finally:
+            process.terminate()
+            process.wait()
+
+    results = {"listening": summarize(listening_s), "ready": summarize(ready_s)}
+    for name, result in results.items():
+        print_result(f"server startup [{name}]", result)
+    return results
+
+
+def print_result(name: str, result: dict, baseline: dict = None):
+    line = f"{name:<60} {result['p50_ms']:>10.2f} {result['p95_ms']:>10.2f}"
+    memory = result.get("peak_python_mb", result.get("server_peak_rss_mb"))
+    line += f" {memory:>10.1f}" if memory is not None else f" {'-':>10}"
+    if baseline and baseline.get(name, {}).get("p50_ms"):
+        line += f" {result['p50_ms'] / baseline[name]['p50_ms']:>8.2f}x"
+    print(line)
+
+
+# times every public repository method (in process) and every route (against a server started on the db),
+# writes the results as json so runs can be compared (--baseline)
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the repository methods and routes on a db")
+    parser.add_argument("--db", required=True, help="path to the duckdb database file (see generate_data.py)")
+    parser.add_argument("--repeat", type=int, default=20, help="timed calls per case")
+    parser.add_argument("--rollup", help="path of the rollup db to use (default: no rollup)")
+    parser.add_argument("--skip-routes", action="store_true", help="only benchmark the repository methods")
+    parser.add_argument("--startup-runs", type=int, default=5, help="cold starts of the server (0 to skip)")
+    parser.add_argument("--port", type=int, default=18081)
+    parser.add_argument("--output", help="path of the json results")
+    parser.add_argument("--baseline", help="json results of a previous run, to print the p50 ratios")
+    args = parser.parse_args()
+
+    conn = duckdb.connect(database=args.db, read_only=True)
+    transactions = conn.execute("SELECT count(*) FROM transactions").fetchone()[0]
+    conn.close()
+
+    ids = sample_ids(args.db)
+    start = time.perf_counter()
+    repo = ChargeCloudRepository(args.db, rollup_path=args.rollup)
+    startup_s = time.perf_counter() - start
+
+    header = f"{'case':<60} {'p50 ms':>10} {'p95 ms':>10} {'mem mb':>10}"
+    print(f"{transactions} transactions, repository started in {startup_s:.2f}s")
+    print(header)
+    results = {
+        "meta": {
+            "db": os.path.abspath(args.db),
+            "transactions": transactions,
+            "repeat": args.repeat,
+            "rollup": bool(args.rollup),
+            "startup_s": round(startup_s, 3),
+            "python": platform.python_version(),
+            "duckdb": duckdb.__version__,
+            "cpus": os.cpu_count(),
+            "date": datetime.now(timezone.utc).isoformat(),
+        },
+        "methods": benchmark_methods(repo, method_cases(repo, ids), args.repeat),
+    }
+    results["meta"]["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    if not args.skip_routes:
+        print(header)
+        results["routes"] = benchmark_routes(args.db, route_cases(ids), args.repeat, args.port)
+
+    if args.startup_runs > 0:
+        print(header)
+        results["startup"] = benchmark_startup(args.db, args.startup_runs, args.port)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"\np50 compared to {args.baseline}")
+        print(header + f" {'p50 ratio':>9}")
+        for section in ["methods", "routes", "startup"]:
+            for name, result in results.get(section, {}).items():
+                print_result(name, result, baseline.get(section))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import argparse
+import logging
+import os
+import pathlib
+import sys
+import time
+
+import duckdb
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.resolve()))
+
+from chargecloud.util import LOCATIONS_CACHE_PATH  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+# same tables as the source db (doc/coreLogic.md)
+SCHEMA = [
+    "CREATE TABLE chargepoints(id BIGINT, locationId BIGINT, stationId BIGINT)",
+    "CREATE TABLE charging_status(id BIGINT, status VARCHAR)",
+    "CREATE TABLE kwh_price(stationId BIGINT, priceAt TIMESTAMP, kwhPrice DOUBLE)",
+    "CREATE TABLE locations(id BIGINT, latitude DOUBLE, longitude DOUBLE)",
+    "CREATE TABLE stations(id BIGINT, locationId BIGINT)",
+    "CREATE TABLE transactions(id BIGINT, startedAt TIMESTAMP, completedAt TIMESTAMP, chargingCompletedAt TIMESTAMP, "
+    "chargePointId BIGINT, meterValueStart BIGINT, meterValueStop BIGINT, kwhConsumed DOUBLE)",
+    "CREATE TABLE transaction_meter_values(createdAt TIMESTAMP, transactionId BIGINT, chargePointId BIGINT, "
+    '"value" DOUBLE, chargingStatusId BIGINT, averagePower DOUBLE)',
+]
+
+FIRST_STATION_ID = 101
+FIRST_CHARGEPOINT_ID = 1001
+FIRST_TRANSACTION_ID = 36950000
+
+
+# Writes a db with the schema of the source db and random data of the given size, including the anomalies of the
+# source data (see the validation in doc/coreLogic.md):
+# - transactions with a negative kwhConsumed
+# - transactions without any status event / without a charging_stopped event, missing charging events
+# - kwh prices not reported at the quarter-hour (stale, the statistics fall back to the station's average price)
+#   and stations without any kwh price
+# Locations are taken from the locations cache, so they don't need to be geocoded and include its locations
+# outside of Germany.
+# The data only depends on the arguments: random values are hashes of the row number and the seed.
+def generate(
+    db_path: str,
+    transactions: int,
+    stations: int,
+    days: int = 30,
+    start: str = "2024-01-01",
+    seed: int = 0,
+    negative_kwh_rate: float = 0.02,
+    missing_events_rate: float = 0.03,
+    missing_stop_rate: float = 0.05,
+    dropped_event_rate: float = 0.1,
+    stale_price_rate: float = 0.2,
+    stations_without_price_rate: float = 0.1,
+):
+    conn = duckdb.connect(database=db_path)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    # uniform value in [0, 1) of (row, salt)
+    conn.execute(f"CREATE TEMP MACRO rnd(i, salt) AS (hash(i, salt, {seed}) % 1000000) / 1000000.0")
+
+    conn.execute("INSERT INTO charging_status VALUES (1, 'charging_stopped'), (2, 'charging')")
+
+    conn.execute(
+        "CREATE TEMP TABLE cached_locations AS "
+        "SELECT row_number() OVER (ORDER BY rnd(CAST(id AS BIGINT), 'location')) - 1 AS n, "
+        "CAST(id AS BIGINT) AS id, latitude, longitude "
+        "FROM read_csv(?) WHERE id IS NOT NULL",
+        [LOCATIONS_CACHE_PATH],
+    )
+    locations_count = conn.execute("SELECT count(*) FROM cached_locations").fetchone()[0]
+    used_locations = min(stations, locations_count)
+    conn.execute(
+        "INSERT INTO locations SELECT id, latitude, longitude FROM cached_locations WHERE n < ? ORDER BY n",
+        [used_locations],
+    )
+
+    # stations at random locations, 1 to 4 chargepoints per station (at the station's location)
+    conn.execute(
+        "INSERT INTO stations "
+        "SELECT ? + s.range, l.id "
+        "FROM range(?) s JOIN cached_locations l "
+        "ON l.n = CAST(floor(rnd(s.range, 'station_location') * ?) AS BIGINT)",
+        [FIRST_STATION_ID, stations, used_locations],
+    )
+    conn.execute(
+        "INSERT INTO chargepoints "
+        "SELECT ? + row_number() OVER (ORDER BY id, c) - 1, locationId, id "
+        "FROM (SELECT id, locationId, unnest(range(1 + CAST(floor(rnd(id, 'chargepoints') * 4) AS BIGINT))) AS c "
+        "FROM stations)",
+        [FIRST_CHARGEPOINT_ID],
+    )
+    chargepoints = conn.execute("SELECT count(*) FROM chargepoints").fetchone()[0]
+
+    # transactions: random start in the period, 0.5 to 6h of charging, then 0 to 12h until the car leaves
+    conn.execute(
+        "INSERT INTO transactions "
+        "SELECT id, startedAt, chargingCompletedAt + to_seconds(CAST(rnd(i, 'idle') * 12 * 3600 AS BIGINT)), "
+        "chargingCompletedAt, chargePointId, 0, 0, "
+        "CASE WHEN rnd(i, 'negative') < ? THEN -10 * rnd(i, 'kwh') ELSE 5 + 55 * rnd(i, 'kwh') END "
+        "FROM ("
+        "    SELECT i, ? + i AS id, startedAt, "
+        "    startedAt + to_seconds(CAST((0.5 + 5.5 * rnd(i, 'charging')) * 3600 AS BIGINT)) AS chargingCompletedAt, "
+        "    ? + CAST(floor(rnd(i, 'chargepoint') * ?) AS BIGINT) AS chargePointId "
+        "    FROM ("
+        "        SELECT range AS i, "
+        "        CAST(? AS TIMESTAMP) + to_seconds(CAST(rnd(range, 'start') * ? * 86400 AS BIGINT)) AS startedAt "
+        "        FROM range(?)"
+        "    )"
+        ")",
+        [negative_kwh_rate, FIRST_TRANSACTION_ID, FIRST_CHARGEPOINT_ID, chargepoints, start, days, transactions],
+    )
+
+    # a charging event every 15 minutes while charging and a charging_stopped event when charging completed
+    conn.execute(
+        "INSERT INTO transaction_meter_values "
+        "SELECT createdAt, id, chargePointId, 0.0, chargingStatusId, CASE chargingStatusId WHEN 2 THEN 1.0 ELSE 0.0 END "
+        "FROM ("
+        "    SELECT id, chargePointId, startedAt + INTERVAL 15 MINUTE * k AS createdAt, 2 AS chargingStatusId, "
+        "    rnd(id * 1000 + k, 'dropped') < ? AS dropped "
+        "    FROM ("
+        "        SELECT id, chargePointId, startedAt, "
+        "        unnest(range(CAST(floor(epoch(chargingCompletedAt - startedAt) / 900) AS BIGINT) + 1)) AS k "
+        "        FROM transactions"
+        "    ) "
+        "    UNION ALL "
+        "    SELECT id, chargePointId, chargingCompletedAt, 1, rnd(id, 'missing_stop') < ? "
+        "    FROM transactions"
+        ") "
+        "WHERE NOT dropped AND rnd(id, 'missing_events') >= ?",
+        [dropped_event_rate, missing_stop_rate, missing_events_rate],
+    )
+
+    # a price per station every 15 minutes of the period (from an hour before its start),
+    # a stale price is reported late in its quarter-hour
+    conn.execute(
+        "INSERT INTO kwh_price "
+        "SELECT stationId, "
+        "CASE WHEN rnd(stationId * 100000 + q, 'stale') < ? "
+        "    THEN priceAt + to_seconds(CAST(60 + rnd(stationId * 100000 + q, 'late') * 780 AS BIGINT)) "
+        "    ELSE priceAt END, "
+        "20 + 50 * rnd(stationId * 100000 + q, 'price') "
+        "FROM ("
+        "    SELECT s.id AS stationId, q.range AS q, CAST(? AS TIMESTAMP) - INTERVAL 1 HOUR + INTERVAL 15 MINUTE * q.range "
+        "    AS priceAt "
+        "    FROM stations s CROSS JOIN range(? * 96 + 4) q "
+        "    WHERE rnd(s.id, 'without_price') >= ?"
+        ")",
+        [stale_price_rate, start, days, stations_without_price_rate],
+    )
+
+    for table in ["locations", "stations", "chargepoints", "transactions", "transaction_meter_values", "kwh_price"]:
+        logger.info(f"{table}: {conn.execute(f'SELECT count(*) FROM {table}').fetchone()[0]} rows")
+    conn.execute("CHECKPOINT")
+    conn.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Writes a db of random charging data with the schema of the source db")
+    parser.add_argument("target", help="path of the generated duckdb file, must not exist")
+    parser.add_argument("--transactions", type=int, default=100_000, help="number of transactions (1k to 10M)")
+    parser.add_argument(
+        "--stations", type=int, default=None, help="number of stations (default: 1 per 50 transactions, max 20000)"
+    )
+    parser.add_argument("--days", type=int, default=30, help="length of the period in days")
+    parser.add_argument("--start", default="2024-01-01", help="first day of the period")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--negative-kwh-rate", type=float, default=0.02)
+    parser.add_argument("--missing-events-rate", type=float, default=0.03)
+    parser.add_argument("--missing-stop-rate", type=float, default=0.05)
+    parser.add_argument("--dropped-event-rate", type=float, default=0.1)
+    parser.add_argument("--stale-price-rate", type=float, default=0.2)
+    parser.add_argument("--stations-without-price-rate", type=float, default=0.1)
+    args = parser.parse_args()
+
+    if os.path.exists(args.target):
+        parser.error(f"{args.target} already exists")
+
+    start_time = time.time()
+    generate(
+        args.target,
+        transactions=args.transactions,
+        stations=args.stations or min(max(args.transactions // 50, 10), 20_000),
+        days=args.days,
+        start=args.start,
+        seed=args.seed,
+        negative_kwh_rate=args.negative_kwh_rate,
+        missing_events_rate=args.missing_events_rate,
+        missing_stop_rate=args.missing_stop_rate,
+        dropped_event_rate=args.dropped_event_rate,
+        stale_price_rate=args.stale_price_rate,
+        stations_without_price_rate=args.stations_without_price_rate,
+    )
+    logger.info(f"Generated {args.target} in {time.time() - start_time:.1f}s")
@@ -0,0 +1,160 @@
+import argparse
+import json
+import os
+import pathlib
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import duckdb
+
+SERVER_PATH = str(pathlib.Path(__file__).parent.parent.resolve() / "server.py")
+
+
+# mixed traffic built from the ids in the db: (method, path, json payload)
+def build_requests(db_path: str) -> list:
+    conn = duckdb.connect(database=db_path, read_only=True)
+    station_ids = [
+        r[0] for r in conn.execute("SELECT DISTINCT stationId FROM chargepoints LIMIT 50").fetchall()
+    ]
+    chargepoint_ids = [
+        r[0] for r in conn.execute("SELECT DISTINCT chargePointId FROM transactions LIMIT 50").fetchall()
+    ]
+    locations = conn.execute("SELECT latitude, longitude FROM locations LIMIT 50").fetchall()
+    conn.close()
+
+    requests = []
+    for station_id in station_ids:
+        for statistics_type in ["kwhConsumed", "turnoverEur"]:
+            for interval_type in ["hourly", "daily", "allTime"]:
+                requests.append(
+                    ("GET", f"/station/{station_id}/{statistics_type}/{interval_type}", None)
+                )
+        requests.append(("GET", f"/station/{station_id}/blockingTime", None))
+    for chargepoint_id in chargepoint_ids:
+        requests.append(("GET", f"/chargepoint/{chargepoint_id}/reliability", None))
+    for latitude, longitude in locations:
+        requests.append(
+            (
+                "POST",
+                "/stationsInRadius",
+                {"latitude": latitude, "longitude": longitude, "radius_km": 20},
+            )
+        )
+    for state_name in ["Bayern", "Berlin", "Hessen"]:
+        requests.append(
+            (
+                "POST",
+                "/state/statistics",
+                {"state_name": state_name, "statistics_type": "turnoverEur", "interval_type": "daily"},
+            )
+        )
+    requests += [("GET", "/stations/list", None), ("GET", "/cities/list", None)]
+    return requests
+
+
+def send(base_url: str, method: str, path: str, payload) -> None:
+    data = json.dumps(payload).encode() if payload is not None else None
+    req = urllib.request.Request(
+        base_url + path, data=data, method=method, headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(req, timeout=120) as response:
+        response.read()
+
+
+def wait_until_ready(base_url: str, process, timeout_s: float = 120) -> None:
+    deadline = time.time() + timeout_s
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited during startup")
+        try:
+            send(base_url, "GET", "/", None)
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise TimeoutError("server did not become ready")
+
+
+def run_load(base_url: str, requests: list, clients: int, duration_s: float) -> dict:
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration_s
+
+    def client(seed):
+        rng = random.Random(seed)
+        while time.time() < deadline:
+            method, path, payload = rng.choice(requests)
+            start = time.perf_counter()
+            try:
+                send(base_url, method, path, payload)
+            except (urllib.error.URLError, ConnectionError):
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "throughput_rps": len(latencies) / duration_s,
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else None,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000 if latencies else None,
+    }
+
+
+# starts the server once per worker count and measures the throughput of mixed endpoint traffic
+def main():
+    parser = argparse.ArgumentParser(description="Load test the server with a growing number of workers")
+    parser.add_argument("--db", required=True, help="path to the duckdb database file")
+    parser.add_argument("--workers", default="1,2,4,8", help="comma separated worker counts")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per worker count")
+    parser.add_argument("--port", type=int, default=18080)
+    args = parser.parse_args()
+
+    requests = build_requests(args.db)
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    print(f"{'workers':>8} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for workers in [int(w) for w in args.workers.split(",")]:
+        env = dict(
+            os.environ,
+            DB_PATH=args.db,
+            WEBSERVER_PORT=str(args.port),
+            WEBSERVER_WORKERS=str(workers),
+        )
+        process = subprocess.Popen(
+            [sys.executable, SERVER_PATH],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_until_ready(base_url, process)
+            result = run_load(base_url, requests, args.clients, args.duration)
+        finally:
+            process.terminate()
+            process.wait()
+
+        print(
+            f"{workers:>8} {result['requests']:>9} {result['errors']:>7} {result['throughput_rps']:>9.1f} "
+            f"{result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+from typing import NamedTuple, Optional
+
+# the statistics are summed and averaged as fixed-point decimals: the sums are exact, so they don't depend on the order
+# the values are added in (by duckdb's threads, or shard by shard with the sharded statistics)
+EXACT_SUM_TYPE = "DECIMAL(38, 18)"
+
+
+# Averages the statistics fall back to (see _transaction_metrics_sql): the average kwhConsumed of all transactions and
+# the average kwh price of every station and of all stations (None without values).
+# They're computed once per version of the source, exactly, and loaded as tables in every connection the statistics
+# run on (the snapshot's and the ones of the sharded statistics workers), so they're the same values everywhere.
+class StatisticsAverages(NamedTuple):
+    kwh_consumed: Optional[float]
+    kwh_price: Optional[float]
+    station_ids: list
+    station_kwh_prices: list
+
+    @classmethod
+    def from_db(cls, conn) -> "StatisticsAverages":
+        kwh_consumed = conn.execute(
+            f"SELECT avg(kwhConsumed::{EXACT_SUM_TYPE}) FROM transactions"
+        ).fetchone()[0]
+        kwh_price = conn.execute(f"SELECT avg(kwhPrice::{EXACT_SUM_TYPE}) FROM kwh_price").fetchone()[0]
+        station_averages = conn.execute(
+            f"SELECT stationId, avg(kwhPrice::{EXACT_SUM_TYPE}) "
+            "FROM kwh_price WHERE stationId IS NOT NULL GROUP BY stationId ORDER BY stationId"
+        ).fetchall()
+        return cls(
+            kwh_consumed=kwh_consumed,
+            kwh_price=kwh_price,
+            station_ids=[station_id for station_id, _ in station_averages],
+            station_kwh_prices=[average_price for _, average_price in station_averages],
+        )
+
+    # global_averages (averageKwhConsumed, averagePrice) and station_average_price (stationId, averagePrice)
+    def create_tables(self, conn):
+        conn.execute(
+            "CREATE OR REPLACE TABLE global_averages AS "
+            "SELECT ?::DOUBLE AS averageKwhConsumed, ?::DOUBLE AS averagePrice",
+            [self.kwh_consumed, self.kwh_price],
+        )
+        conn.execute(
+            "CREATE OR REPLACE TABLE station_average_price AS "
+            "SELECT unnest(?::BIGINT[]) AS stationId, unnest(?::DOUBLE[]) AS averagePrice",
+            [self.station_ids, self.station_kwh_prices],
+        )
@@ -0,0 +1,141 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+# identifies the version of the files a response was computed from (modification time and size)
+def files_fingerprint(*paths: str) -> tuple:
+    fingerprint = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            fingerprint.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            fingerprint.append(None)
+    return tuple(fingerprint)
+
+
+def _estimated_size_bytes(body) -> int:
+    if isinstance(body, (str, bytes)):
+        return len(body)
+    return len(json.dumps(body, default=str))
+
+
+# Bounded LRU cache of (code, body) responses, with a TTL and a memory cap.
+# All entries are dropped when the fingerprint (e.g. of the db file) changes.
+class ResponseCache:
+    def __init__(
+        self,
+        fingerprint: Callable[[], Hashable],
+        max_entries: int = 1024,
+        ttl_s: float = 300,
+        max_bytes: int = 64 * 1024 * 1024,
+    ):
+        self._fingerprint = fingerprint
+        self._max_entries = max_entries
+        self._ttl_s = ttl_s
+        self._max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        # key -> (expires_at, size_bytes, response)
+        self._entries = OrderedDict()
+        self._size_bytes = 0
+        self._current_fingerprint = None
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def _check_fingerprint(self):
+        fingerprint = self._fingerprint()
+        if fingerprint != self._current_fingerprint:
+            if self._entries:
+                logger.info("Data changed, invalidating response cache")
+                self._invalidations += 1
+            self._entries.clear()
+            self._size_bytes = 0
+            self._current_fingerprint = fingerprint
+
+    def get(self, key: Hashable) -> Optional[Tuple[int, object]]:
+        with self._lock:
+            self._check_fingerprint()
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[2]
+
+    def put(self, key: Hashable, response: Tuple[int, object]):
+        size_bytes = _estimated_size_bytes(response[1])
+        if size_bytes > self._max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self._ttl_s, size_bytes, response)
+            self._size_bytes += size_bytes
+
+            # evict the least recently used entries
+            while (
+                len(self._entries) > self._max_entries
+                or self._size_bytes > self._max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def _remove(self, key: Hashable):
+        _, size_bytes, _ = self._entries.pop(key)
+        self._size_bytes -= size_bytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+                "entries": len(self._entries),
+                "sizeBytes": self._size_bytes,
+                "maxEntries": self._max_entries,
+                "maxBytes": self._max_bytes,
+                "ttlSeconds": self._ttl_s,
+            }
+
+
+# caches the (code, body) response of a repository method in its self._response_cache
+# only successful responses are cached, key_args normalizes the method arguments into the cache key
+# streamed responses (stream_format argument) are never cached
+def cached_response(endpoint: str, key_args: Callable[..., tuple]):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            cache = self._response_cache
+            if cache is None or kwargs.get("stream_format") is not None:
+                return method(self, *args, **kwargs)
+
+            key_kwargs = {k: v for k, v in kwargs.items() if k != "stream_format"}
+            key = (endpoint,) + key_args(*args, **key_kwargs)
+            response = cache.get(key)
+            if response is None:
+                response = method(self, *args, **kwargs)
+                if response[0] == 200:
+                    cache.put(key, response)
+            return response
+
+        return wrapper
+
+    return decorator
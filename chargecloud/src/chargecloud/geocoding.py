@@ -0,0 +1,282 @@
+import csv
+import logging
+import os
+import pathlib
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+REVERSE_GEOCODING_REFERENCE_PATH = str(
+    pathlib.Path(__file__).parent.resolve() / "resources/reverse_geocoding_reference.csv"
+)
+
+EARTH_MEAN_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+MIN_KM_PER_LATITUDE_DEGREE = 110.574
+
+# distance up to which the nearest reference point gives the city of a location: on a holdout of the reference
+# dataset (500 points, 5 draws), the nearest point within 2 km has the right city for 96% of the points
+# (59% at 2-3 km, 24% at 5-10 km)
+DEFAULT_MAX_CITY_DISTANCE_KM = 2
+
+# column order of the locations cache csv
+LOCATIONS_CACHE_COLUMNS = ["city", "country", "id", "latitude", "longitude", "state"]
+
+
+# geocoder used when none is given, geopy's geocoders are only imported when locations need to be geocoded
+def default_geocoder():
+    from geopy.geocoders import Nominatim
+
+    return Nominatim(user_agent="chargecloud_monitoring")
+
+
+# thread-safe token bucket, acquire() blocks until a token is available
+class TokenBucket:
+    def __init__(self, rate_per_s: float, capacity: Optional[float] = None):
+        self._rate_per_s = rate_per_s
+        self._capacity = capacity if capacity is not None else max(rate_per_s, 1)
+        self._tokens = self._capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self._rate_per_s <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._capacity,
+                    self._tokens + (now - self._last_refill) * self._rate_per_s,
+                )
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_s = (1 - self._tokens) / self._rate_per_s
+            time.sleep(wait_s)
+
+
+# city / state / country of a geocoder address
+# fallback to municipality -> town -> village if no city data is available
+def address_to_city_state_country(address: dict) -> dict:
+    return {
+        "city": address.get(
+            "city",
+            address.get(
+                "municipality", address.get("town", address.get("village", ""))
+            ),
+        ),
+        "state": address.get("state"),
+        "country": address.get("country", address.get("country_code", "")),
+    }
+
+
+# reverse geocodes a location with any geopy-compatible geocoder (reverse(query, exactly_one, timeout))
+# returns None if the location couldn't be geocoded
+def reverse_geocode_location(geocoder, location: dict, timeout_s: float = 10) -> Optional[dict]:
+    try:
+        result = geocoder.reverse(
+            f"{location['latitude']}, {location['longitude']}",
+            exactly_one=True,
+            timeout=timeout_s,
+        )
+        if result is None:
+            logger.warning(f"No address found for locationId {location['id']}")
+            return None
+        address = result.raw["address"]
+    except Exception as e:
+        logger.error(f"Failed to get location for locationId {location['id']}: {e}")
+        return None
+
+    return {**location, **address_to_city_state_country(address)}
+
+
+# Offline reverse geocoder resolving a point to the city / state / country of the nearest point of a local
+# reference dataset (csv with latitude, longitude, city, state, country columns, e.g. a gazetteer), no network needed.
+# The address is only taken from a reference point within max_city_distance_km: further away, the point is geocoded
+# by the optional fallback geocoder (e.g. Nominatim, throttled to fallback_rate_limit_per_s requests per second),
+# or left unresolved without fallback (not cached, so it's geocoded again by the next run).
+# The reference points are bucketed in a lat/lon grid, a query searches the grid cells in growing rings
+# around the point until no closer reference point can be found.
+# Drop-in replacement for geopy's Nominatim in the geocoding pipeline (same reverse() signature).
+class OfflineReverseGeocoder:
+    def __init__(
+        self,
+        reference_path: str = REVERSE_GEOCODING_REFERENCE_PATH,
+        max_city_distance_km: float = DEFAULT_MAX_CITY_DISTANCE_KM,
+        fallback=None,
+        fallback_rate_limit_per_s: float = 1.0,
+        cell_size_deg: float = 0.25,
+    ):
+        reference_df = pd.read_csv(reference_path).replace({np.nan: None})
+        self._latitudes = reference_df["latitude"].to_numpy(dtype=float)
+        self._longitudes = reference_df["longitude"].to_numpy(dtype=float)
+        self._addresses = reference_df[["city", "state", "country"]].to_dict(orient="records")
+        self._max_city_distance_km = max_city_distance_km
+        self._fallback = fallback
+        self._fallback_rate_limiter = TokenBucket(fallback_rate_limit_per_s)
+        self._cell_size_deg = cell_size_deg
+
+        cells_df = pd.DataFrame(
+            {
+                "row": np.floor(self._latitudes / cell_size_deg).astype(int),
+                "col": np.floor(self._longitudes / cell_size_deg).astype(int),
+            }
+        )
+        self._cells = {
+            cell: np.asarray(indexes)
+            for cell, indexes in cells_df.groupby(["row", "col"]).indices.items()
+        }
+        logger.info(f"Loaded {len(self._addresses)} reverse geocoding reference points")
+
+    def _haversine_km(self, latitude: float, longitude: float, indexes: np.ndarray):
+        latitude_rad, longitude_rad = np.radians(latitude), np.radians(longitude)
+        latitudes_rad = np.radians(self._latitudes[indexes])
+        a = (
+            np.sin((latitudes_rad - latitude_rad) / 2) ** 2
+            + np.cos(latitude_rad)
+            * np.cos(latitudes_rad)
+            * np.sin((np.radians(self._longitudes[indexes]) - longitude_rad) / 2) ** 2
+        )
+        return 2 * EARTH_MEAN_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+    # (index, distance in km) of the nearest reference point within the city distance, None if there is none
+    def nearest(self, latitude: float, longitude: float) -> Optional[Tuple[int, float]]:
+        row = int(np.floor(latitude / self._cell_size_deg))
+        col = int(np.floor(longitude / self._cell_size_deg))
+        best_index, best_distance_km = None, self._max_city_distance_km
+
+        ring = 0
+        while True:
+            # points outside the rings searched so far are at least (ring - 1) cells away
+            ring_latitude = min(abs(latitude) + ring * self._cell_size_deg, 89.9)
+            min_km_per_degree = min(
+                MIN_KM_PER_LATITUDE_DEGREE, KM_PER_DEGREE * np.cos(np.radians(ring_latitude))
+            )
+            if (ring - 1) * self._cell_size_deg * min_km_per_degree > best_distance_km:
+                break
+
+            ring_cells = (
+                [(row, col)]
+                if ring == 0
+                else [(row + r, col + c) for r in (-ring, ring) for c in range(-ring, ring + 1)]
+                + [(row + r, col + c) for r in range(-ring + 1, ring) for c in (-ring, ring)]
+            )
+            indexes = [self._cells[cell] for cell in ring_cells if cell in self._cells]
+            if indexes:
+                indexes = np.concatenate(indexes)
+                distances_km = self._haversine_km(latitude, longitude, indexes)
+                i = int(np.argmin(distances_km))
+                if distances_km[i] <= best_distance_km:
+                    best_index, best_distance_km = int(indexes[i]), distances_km[i]
+            ring += 1
+
+        return None if best_index is None else (best_index, float(best_distance_km))
+
+    def reverse(self, query, exactly_one=True, timeout=None):
+        from geopy.location import Location
+
+        latitude, longitude = (float(v) for v in str(query).split(","))
+        nearest = self.nearest(latitude, longitude)
+        if nearest is None:
+            if self._fallback is None:
+                return None
+            self._fallback_rate_limiter.acquire()
+            return self._fallback.reverse(query, exactly_one=exactly_one, timeout=timeout)
+
+        address = {k: v for k, v in self._addresses[nearest[0]].items() if v is not None}
+        return Location(
+            ", ".join(address.values()), (latitude, longitude), {"address": address}
+        )
+
+
+def _cached_location_ids(path: str) -> set:
+    if not pathlib.Path(path).exists():
+        return set()
+    # rows cut off by an interrupted run have no id and are geocoded again
+    ids = pd.read_csv(path, usecols=["id"])["id"].dropna()
+    return set(ids.astype(int).to_list())
+
+
+def _append_to_cache(path: str, rows: list):
+    write_header = not pathlib.Path(path).exists() or os.path.getsize(path) == 0
+    with open(path, "a", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=LOCATIONS_CACHE_COLUMNS)
+        if write_header:
+            writer.writeheader()
+        writer.writerows(
+            {column: row.get(column) for column in LOCATIONS_CACHE_COLUMNS}
+            for row in rows
+        )
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# Incremental reverse geocoding of the locations in the db into the csv cache:
+# - only locations missing from the cache are geocoded
+# - requests are sent by up to max_workers threads, throttled by a token bucket (rate_limit_per_s, 0 = unlimited)
+# - results are appended to the cache every batch_size locations, so an interrupted run resumes where it stopped
+# - locations that fail to geocode are not cached and are retried by the next run
+# - geocoder defaults to the public Nominatim service
+# returns the number of newly cached locations
+def geocode_missing_locations(
+    conn,
+    geocoder,
+    path: str,
+    rate_limit_per_s: float = 1.0,
+    max_workers: int = 1,
+    batch_size: int = 100,
+) -> int:
+    cached_ids = _cached_location_ids(path)
+    locations_df = conn.execute("SELECT id, latitude, longitude FROM locations").df()
+    missing = [
+        location
+        for location in locations_df.to_dict(orient="records")
+        if location["id"] not in cached_ids
+    ]
+    if not missing:
+        if not cached_ids:
+            # empty cache, nothing to geocode
+            _append_to_cache(path, [])
+        return 0
+
+    logger.info(
+        f"Geocoding {len(missing)} locations missing from the cache "
+        f"({len(cached_ids)} already cached)"
+    )
+
+    # only imported when there is something to geocode, a warm start doesn't pay for it
+    from tqdm import tqdm
+
+    if geocoder is None:
+        geocoder = default_geocoder()
+    rate_limiter = TokenBucket(rate_limit_per_s)
+
+    def geocode(location):
+        rate_limiter.acquire()
+        return reverse_geocode_location(geocoder, location)
+
+    cached_count = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, tqdm(
+        total=len(missing)
+    ) as progress:
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start : start + batch_size]
+            rows = [row for row in executor.map(geocode, batch) if row is not None]
+            _append_to_cache(path, rows)
+            cached_count += len(rows)
+            progress.update(len(batch))
+
+    if cached_count < len(missing):
+        logger.warning(
+            f"{len(missing) - cached_count} locations couldn't be geocoded, they will be retried on the next run"
+        )
+    return cached_count
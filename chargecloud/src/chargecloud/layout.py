@@ -0,0 +1,75 @@
+import argparse
+import logging
+
+import duckdb
+
+logger = logging.getLogger(__name__)
+
+# row order of the tables in a sorted copy, tables not listed keep their order
+# duckdb keeps min/max statistics (zone maps) per row group, a predicate on a column the rows are sorted by
+# only reads the row groups overlapping it (e.g. the transactions of the last 24h)
+TABLE_SORT_KEYS = {
+    "transactions": "startedAt, id",
+    "transaction_meter_values": "transactionId, createdAt",
+    "kwh_price": "stationId, priceAt",
+}
+
+
+# tables of the source db, referenced tables first so foreign keys are satisfied when inserting
+def _tables_in_insert_order(conn) -> list:
+    tables = [
+        row[0]
+        for row in conn.execute(
+            "SELECT table_name FROM duckdb_tables() WHERE database_name = 'source' ORDER BY table_name"
+        ).fetchall()
+    ]
+    references = {table: set() for table in tables}
+    for table, referenced_table in conn.execute(
+        "SELECT table_name, referenced_table FROM duckdb_constraints() "
+        "WHERE database_name = 'source' AND constraint_type = 'FOREIGN KEY'"
+    ).fetchall():
+        if referenced_table != table:
+            references[table].add(referenced_table)
+
+    ordered = []
+    while references:
+        ready = sorted(t for t, refs in references.items() if not refs - set(ordered))
+        if not ready:
+            # reference cycle, insert the remaining tables as they are
+            ready = sorted(references)
+        for table in ready:
+            ordered.append(table)
+            references.pop(table)
+    return ordered
+
+
+# writes a copy of the db (same schema) with the rows of the tables in TABLE_SORT_KEYS sorted
+def write_sorted_copy(source_path: str, target_path: str):
+    conn = duckdb.connect(database=target_path)
+    conn.execute(f"ATTACH '{source_path}' AS source (READ_ONLY)")
+    conn.execute(f"COPY FROM DATABASE source TO {_target_database_name(conn)} (SCHEMA)")
+
+    for table in _tables_in_insert_order(conn):
+        sort_key = TABLE_SORT_KEYS.get(table)
+        order_by = f" ORDER BY {sort_key}" if sort_key else ""
+        conn.execute(f'INSERT INTO "{table}" SELECT * FROM source."{table}"{order_by}')
+        logger.info(f"Copied {table}{' sorted by ' + sort_key if sort_key else ''}")
+
+    conn.execute("DETACH source")
+    conn.execute("CHECKPOINT")
+    conn.close()
+
+
+def _target_database_name(conn) -> str:
+    return conn.execute("SELECT current_database()").fetchone()[0]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Writes a copy of the db with the transactions sorted by startedAt"
+    )
+    parser.add_argument("source", help="path of the source duckdb file")
+    parser.add_argument("target", help="path of the sorted copy, must not exist")
+    args = parser.parse_args()
+    write_sorted_copy(args.source, args.target)
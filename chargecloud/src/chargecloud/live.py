@@ -0,0 +1,403 @@
+import logging
+import threading
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+from typing import Optional, Tuple
+
+from .window import TimeWindow, parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+# columns of the ingested events (same as the source tables) and the ones an event must have
+TRANSACTION_COLUMNS = {
+    "id": "Int64",
+    "startedAt": "datetime64[us]",
+    "completedAt": "datetime64[us]",
+    "chargingCompletedAt": "datetime64[us]",
+    "chargePointId": "Int64",
+    "meterValueStart": "Int64",
+    "meterValueStop": "Int64",
+    "kwhConsumed": "float64",
+}
+REQUIRED_TRANSACTION_COLUMNS = ["id", "startedAt", "completedAt", "chargePointId", "kwhConsumed"]
+METER_VALUE_COLUMNS = {
+    "createdAt": "datetime64[us]",
+    "transactionId": "Int64",
+    "chargePointId": "Int64",
+    "value": "float64",
+    "chargingStatusId": "Int64",
+    "averagePower": "float64",
+}
+REQUIRED_METER_VALUE_COLUMNS = ["createdAt", "transactionId", "chargePointId"]
+
+# column of the ingested transactions holding the value of a statistics type
+STATISTIC_COLUMNS = {"kwhConsumed": "statisticKwhConsumed", "turnoverEur": "statisticTurnoverEur"}
+
+
+# Transactions and meter values ingested while the server runs, kept in a writable sidecar duckdb file
+# (the source is read-only), with rolling aggregates updated by every micro-batch:
+# - hourly_statistics: kwhConsumed / turnoverEur of the ingested transactions by chargepoint and hour, with the station
+#   and location of the chargepoint (the statistics filter them like the transactions of the source)
+# - chargepoint_events: expected / actual status events count of the ingested transactions by chargepoint
+# The live data complements the source: transactions already in the source are skipped, and when a new version of
+# the source is loaded (rebuild) the transactions it now contains are dropped from the store.
+# The statistics of an ingested transaction are computed like the raw statistics, with the averages and kwh prices of
+# the source snapshot the store is built on (rebuild recomputes them on the new one).
+class LiveIngestStore:
+    def __init__(self, live_path: str, snapshot):
+        self._conn = duckdb.connect(database=live_path)
+        # a single writer: micro-batches and rebuilds are applied one at a time
+        self._write_lock = threading.Lock()
+        # incremented by every change of the live data, part of the response cache fingerprint
+        self.version = 0
+        self._create_tables()
+        self.rebuild(snapshot)
+
+    def _create_tables(self):
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS transactions ("
+            "    id BIGINT PRIMARY KEY, "
+            "    startedAt TIMESTAMP NOT NULL, "
+            "    completedAt TIMESTAMP NOT NULL, "
+            "    chargingCompletedAt TIMESTAMP, "
+            "    chargePointId BIGINT NOT NULL, "
+            "    meterValueStart BIGINT, "
+            "    meterValueStop BIGINT, "
+            "    kwhConsumed DOUBLE NOT NULL, "
+            "    stationId BIGINT, "
+            "    locationId BIGINT, "
+            "    statisticKwhConsumed DOUBLE, "
+            "    statisticTurnoverEur DOUBLE"
+            ")"
+        )
+        # stores of an older version: the column is filled by the rebuild on startup, and the aggregates below are
+        # rebuilt from the transactions
+        self._conn.execute("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS locationId BIGINT")
+        self._conn.execute("DROP TABLE IF EXISTS station_hourly")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS transaction_meter_values ("
+            "    createdAt TIMESTAMP NOT NULL, "
+            "    transactionId BIGINT NOT NULL, "
+            "    chargePointId BIGINT NOT NULL, "
+            "    value DOUBLE, "
+            "    chargingStatusId BIGINT, "
+            "    averagePower DOUBLE"
+            ")"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS hourly_statistics ("
+            "    chargePointId BIGINT NOT NULL, "
+            "    stationId BIGINT, "
+            "    locationId BIGINT, "
+            "    hour TIMESTAMP NOT NULL, "
+            "    transactionsCount BIGINT, "
+            "    kwhConsumed DOUBLE, "
+            "    turnoverEur DOUBLE, "
+            "    PRIMARY KEY (chargePointId, hour)"
+            ")"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chargepoint_events ("
+            "    chargePointId BIGINT PRIMARY KEY, "
+            "    expectedEventsCount BIGINT, "
+            "    actualEventsCount BIGINT"
+            ")"
+        )
+
+    # cursor on the live db to run queries on (one per query, so it's thread-safe)
+    def cursor(self):
+        return self._conn.cursor()
+
+    # events of a micro-batch as a dataframe with the columns of the table, raises ValueError on invalid events
+    @staticmethod
+    def _events_df(events, columns: dict, required: list, name: str) -> pd.DataFrame:
+        if not isinstance(events, list) or not all(isinstance(event, dict) for event in events):
+            raise ValueError(f"{name} must be a list of objects")
+        rows = []
+        for position, event in enumerate(events):
+            if missing := [column for column in required if event.get(column) is None]:
+                raise ValueError(f"{name}[{position}] is missing {missing}")
+            try:
+                rows.append(
+                    {
+                        column: (
+                            None
+                            if event.get(column) is None
+                            else parse_timestamp(event[column])
+                            if dtype.startswith("datetime")
+                            else float(event[column])
+                            if dtype == "float64"
+                            else int(event[column])
+                        )
+                        for column, dtype in columns.items()
+                    }
+                )
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"{name}[{position}] is invalid: {e}")
+        return pd.DataFrame(rows, columns=list(columns)).astype(columns)
+
+    # ingests a micro-batch of events, all or nothing, returns the number of received / ingested events
+    # (transactions already in the source or in the store, meter values of transactions in the source and meter values
+    # already in the store are skipped: the source is read-only, the store only adds the transactions it doesn't have)
+    def ingest(self, transactions: list, meter_values: list) -> dict:
+        transactions_df = self._events_df(
+            transactions, TRANSACTION_COLUMNS, REQUIRED_TRANSACTION_COLUMNS, "transactions"
+        ).drop_duplicates("id")
+        meter_values_df = self._events_df(
+            meter_values, METER_VALUE_COLUMNS, REQUIRED_METER_VALUE_COLUMNS, "meterValues"
+        ).drop_duplicates(["transactionId", "createdAt", "chargingStatusId"])
+
+        with self._write_lock:
+            snapshot = self._snapshot
+            transactions_df = self._with_stations_and_locations(transactions_df, snapshot)
+            source_ids = self._source_transaction_ids(
+                snapshot, transactions_df["id"].tolist() + meter_values_df["transactionId"].tolist()
+            )
+            transactions_df = transactions_df[~transactions_df["id"].isin(source_ids)]
+            transactions_df = self._with_statistics(transactions_df, snapshot)
+            meter_values_df = meter_values_df[~meter_values_df["transactionId"].isin(source_ids)]
+
+            conn = self._conn.cursor()
+            conn.begin()
+            try:
+                conn.register("batch_meter_values", meter_values_df)
+                conn.register("batch_transactions", transactions_df)
+                ingested_meter_values = self._insert_meter_values(conn)
+                ingested_transactions = self._insert_transactions(conn)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            self.version += 1
+
+        logger.debug(
+            f"Ingested {ingested_transactions} transactions and {ingested_meter_values} meter values"
+        )
+        return {
+            "transactions": {"received": len(transactions), "ingested": ingested_transactions},
+            "meterValues": {"received": len(meter_values), "ingested": ingested_meter_values},
+        }
+
+    # appends the new meter values, the ones of transactions already in the store are counted right away
+    # (the others are counted when their transaction is ingested)
+    @staticmethod
+    def _insert_meter_values(conn) -> int:
+        conn.execute(
+            "CREATE TEMP TABLE new_meter_values AS "
+            "SELECT * FROM batch_meter_values bmv "
+            "WHERE NOT EXISTS ("
+            "    SELECT 1 FROM transaction_meter_values mv "
+            "    WHERE mv.transactionId = bmv.transactionId AND mv.createdAt = bmv.createdAt "
+            "    AND mv.chargingStatusId IS NOT DISTINCT FROM bmv.chargingStatusId"
+            ")"
+        )
+        conn.execute(
+            "INSERT INTO chargepoint_events "
+            "SELECT tr.chargePointId, 0, count(*) "
+            "FROM new_meter_values nmv JOIN transactions tr ON nmv.transactionId = tr.id "
+            "GROUP BY tr.chargePointId "
+            "ON CONFLICT DO UPDATE SET actualEventsCount = actualEventsCount + EXCLUDED.actualEventsCount"
+        )
+        conn.execute("INSERT INTO transaction_meter_values SELECT * FROM new_meter_values")
+        count = conn.execute("SELECT count(*) FROM new_meter_values").fetchone()[0]
+        conn.execute("DROP TABLE new_meter_values")
+        return count
+
+    # appends the new transactions and adds them to the hourly statistics and to the events count
+    @staticmethod
+    def _insert_transactions(conn) -> int:
+        conn.execute(
+            "CREATE TEMP TABLE new_transactions AS "
+            "SELECT * FROM batch_transactions "
+            "WHERE id NOT IN (SELECT id FROM transactions)"
+        )
+        conn.execute("INSERT INTO transactions BY NAME SELECT * FROM new_transactions")
+        conn.execute(
+            "INSERT INTO hourly_statistics "
+            f"{LiveIngestStore._hourly_statistics_sql('new_transactions')} "
+            "ON CONFLICT DO UPDATE SET "
+            "transactionsCount = transactionsCount + EXCLUDED.transactionsCount, "
+            "kwhConsumed = kwhConsumed + EXCLUDED.kwhConsumed, "
+            "turnoverEur = turnoverEur + EXCLUDED.turnoverEur"
+        )
+        conn.execute(
+            "INSERT INTO chargepoint_events "
+            f"{LiveIngestStore._chargepoint_events_sql('new_transactions')} "
+            "ON CONFLICT DO UPDATE SET "
+            "expectedEventsCount = expectedEventsCount + EXCLUDED.expectedEventsCount, "
+            "actualEventsCount = actualEventsCount + EXCLUDED.actualEventsCount"
+        )
+        count = conn.execute("SELECT count(*) FROM new_transactions").fetchone()[0]
+        conn.execute("DROP TABLE new_transactions")
+        return count
+
+    # statistics by chargepoint (and its station / location) and hour of the transactions of a table
+    @staticmethod
+    def _hourly_statistics_sql(transactions_table: str) -> str:
+        return (
+            "SELECT chargePointId, stationId, locationId, date_trunc('hour', startedAt) AS hour, count(*), "
+            "coalesce(sum(statisticKwhConsumed), 0), coalesce(sum(statisticTurnoverEur), 0) "
+            f"FROM {transactions_table} "
+            "GROUP BY ALL"
+        )
+
+    # expected / actual status events count by chargepoint of the transactions of a table, same as the source's
+    # (at least 2 events per transaction, 1 every 15 minutes)
+    @staticmethod
+    def _chargepoint_events_sql(transactions_table: str) -> str:
+        return (
+            "WITH transaction_events_count AS ("
+            "    SELECT transactionId, count(*) AS actualEventsCount "
+            "    FROM transaction_meter_values "
+            f"    WHERE transactionId IN (SELECT id FROM {transactions_table}) "
+            "    GROUP BY transactionId"
+            ") "
+            "SELECT tr.chargePointId, "
+            "sum(greatest(CAST(floor(epoch(tr.completedAt - tr.startedAt) / 60 / 15) AS BIGINT), 2)), "
+            "coalesce(sum(tec.actualEventsCount), 0) "
+            f"FROM {transactions_table} tr "
+            "LEFT JOIN transaction_events_count tec ON tr.id = tec.transactionId "
+            "GROUP BY tr.chargePointId"
+        )
+
+    # adds the stationId / locationId of the transactions' chargepoints,
+    # raises ValueError on chargepoints missing from the source
+    @staticmethod
+    def _with_stations_and_locations(transactions_df: pd.DataFrame, snapshot) -> pd.DataFrame:
+        chargepoint_ids = transactions_df["chargePointId"].unique().tolist()
+        chargepoints = {
+            chargepoint_id: (station_id, location_id)
+            for chargepoint_id, station_id, location_id in snapshot.db.cursor().execute(
+                "SELECT id, stationId, locationId FROM chargepoints WHERE id IN (SELECT unnest(?::BIGINT[]))",
+                [chargepoint_ids],
+            ).fetchall()
+        }
+        if unknown := sorted(set(chargepoint_ids) - chargepoints.keys()):
+            raise ValueError(f"Unknown chargePointIds : {unknown}")
+        station_ids = {chargepoint_id: station_id for chargepoint_id, (station_id, _) in chargepoints.items()}
+        location_ids = {chargepoint_id: location_id for chargepoint_id, (_, location_id) in chargepoints.items()}
+        return transactions_df.assign(
+            stationId=transactions_df["chargePointId"].map(station_ids).astype("Int64"),
+            locationId=transactions_df["chargePointId"].map(location_ids).astype("Int64"),
+        )
+
+    @staticmethod
+    def _source_transaction_ids(snapshot, transaction_ids: list) -> set:
+        return {
+            transaction_id
+            for (transaction_id,) in snapshot.db.cursor().execute(
+                "SELECT id FROM transactions WHERE id IN (SELECT unnest(?::BIGINT[]))",
+                [transaction_ids],
+            ).fetchall()
+        }
+
+    # kwhConsumed / turnoverEur of every transaction, like the raw statistics:
+    # negative kwhConsumed is replaced by the average kwhConsumed of the source transactions,
+    # the kwh price is the one the price index resolves for the turnover of a transaction started at startedAt
+    # (the average price of all stations for the transactions of chargepoints without station)
+    def _with_statistics(self, transactions_df: pd.DataFrame, snapshot) -> pd.DataFrame:
+        kwh_consumed = transactions_df["kwhConsumed"].to_numpy(dtype=float)
+        kwh_consumed = np.where(kwh_consumed < 0, self._average_kwh_consumed, kwh_consumed)
+
+        price_index = snapshot.price_index() if len(transactions_df) else None
+        kwh_prices = np.full(
+            kwh_consumed.shape, np.nan if price_index is None else price_index.global_average_price
+        )
+        started_at_us = transactions_df["startedAt"].to_numpy().astype("datetime64[us]").astype(np.int64)
+        station_ids = transactions_df["stationId"].to_numpy(dtype=float, na_value=np.nan)
+        for station_id in np.unique(station_ids[~np.isnan(station_ids)]):
+            positions = np.flatnonzero(station_ids == station_id)
+            kwh_prices[positions] = price_index.resolve(int(station_id), started_at_us[positions])[
+                "turnoverKwhPrice"
+            ]
+
+        return transactions_df.assign(
+            statisticKwhConsumed=kwh_consumed,
+            statisticTurnoverEur=(kwh_prices * kwh_consumed) / 100,
+        )
+
+    # makes the store consistent with a (new) source snapshot: the transactions the source now contains are dropped
+    # with their meter values (as are the meter values waiting for a transaction the source now contains), the
+    # statistics of the others are computed again with the source's averages and kwh prices and the aggregates are
+    # rebuilt from them
+    def rebuild(self, snapshot):
+        with self._write_lock:
+            self._snapshot = snapshot
+            self._average_kwh_consumed = snapshot.statistics_averages().kwh_consumed
+
+            conn = self._conn.cursor()
+            transactions_df = conn.execute(
+                f"SELECT {', '.join(TRANSACTION_COLUMNS)} FROM transactions"
+            ).df()
+            meter_values_transaction_ids = [
+                transaction_id
+                for (transaction_id,) in conn.execute(
+                    "SELECT DISTINCT transactionId FROM transaction_meter_values"
+                ).fetchall()
+            ]
+            source_ids = self._source_transaction_ids(
+                snapshot, transactions_df["id"].tolist() + meter_values_transaction_ids
+            )
+            stored_count = len(transactions_df)
+            transactions_df = transactions_df[~transactions_df["id"].isin(source_ids)]
+            transactions_df = self._with_statistics(
+                self._with_stations_and_locations(transactions_df, snapshot), snapshot
+            )
+
+            conn.begin()
+            try:
+                conn.register("live_transactions", transactions_df)
+                conn.execute("DELETE FROM transactions")
+                conn.execute("INSERT INTO transactions BY NAME SELECT * FROM live_transactions")
+                conn.execute(
+                    "DELETE FROM transaction_meter_values WHERE transactionId IN (SELECT unnest(?::BIGINT[]))",
+                    [sorted(source_ids)],
+                )
+                conn.execute("DELETE FROM hourly_statistics")
+                conn.execute(f"INSERT INTO hourly_statistics {self._hourly_statistics_sql('transactions')}")
+                conn.execute("DELETE FROM chargepoint_events")
+                conn.execute(
+                    f"INSERT INTO chargepoint_events {self._chargepoint_events_sql('transactions')}"
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            self.version += 1
+
+        logger.info(
+            f"Live store rebuilt: {len(transactions_df)} transactions, "
+            f"{stored_count - len(transactions_df)} now in the source"
+        )
+
+    # hourly statistics (hour, stationId, locationId and a column per statistics type) of the ingested transactions
+    # matching the filter (on stationId / locationId, its params come first) in the window:
+    # from the hourly aggregates, or from the transactions if the window doesn't fall on hour boundaries
+    @staticmethod
+    def statistics_sql(statistics_types: list, transactions_filter: str, window: TimeWindow) -> Tuple[str, list]:
+        if window.is_hour_aligned():
+            table, hour, columns = "hourly_statistics", "hour", statistics_types
+            window_predicate, window_params = window.predicate("hour")
+        else:
+            table, hour = "transactions", "date_trunc('hour', startedAt)"
+            columns = [STATISTIC_COLUMNS[statistics_type] for statistics_type in statistics_types]
+            window_predicate, window_params = window.predicate("startedAt")
+        sums = ", ".join(
+            f"sum({column}) AS {statistics_type}" for column, statistics_type in zip(columns, statistics_types)
+        )
+        return (
+            f"SELECT {hour} AS hour, stationId, locationId, {sums} FROM {table} "
+            f"WHERE ({transactions_filter}) AND {window_predicate} GROUP BY ALL",
+            window_params,
+        )
+
+    # expected / actual status events count of the ingested transactions by chargepoint (all if no ids are given)
+    @staticmethod
+    def chargepoint_events_sql(chargepoint_ids: Optional[list]) -> Tuple[str, list]:
+        sql = "SELECT chargePointId, expectedEventsCount, actualEventsCount FROM chargepoint_events"
+        if chargepoint_ids is None:
+            return sql, []
+        return sql + " WHERE chargePointId IN (SELECT unnest(?::BIGINT[]))", [chargepoint_ids]
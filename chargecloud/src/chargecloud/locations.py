@@ -0,0 +1,71 @@
+import logging
+import os
+import threading
+
+import pandas as pd
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from .util import LOCATIONS_CACHE_PATH, load_locations_df
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class _LocationsSnapshot:
+    mtime_ns: int
+    df: pd.DataFrame
+    # casefolded city / state name -> location ids
+    location_ids_by_name: Dict[str, Dict[str, List[int]]]
+    # distinct city / state names
+    names: Dict[str, List[str]]
+
+
+# In-memory index of the cached locations (city/state/country by location id).
+# The csv cache is parsed once and reloaded only when its modification time changes.
+class LocationsIndex:
+    def __init__(self, path: str = LOCATIONS_CACHE_PATH):
+        self._path = path
+        self._lock = threading.Lock()
+        self._snapshot: Optional[_LocationsSnapshot] = None
+
+    def _load(self, mtime_ns: int) -> _LocationsSnapshot:
+        df = load_locations_df(self._path)
+        location_ids_by_name = {}
+        names = {}
+        for attr in ["city", "state"]:
+            located_df = df[df[attr].notna()]
+            location_ids_by_name[attr] = (
+                located_df.groupby(located_df[attr].str.casefold())["id"]
+                .agg(list)
+                .to_dict()
+            )
+            names[attr] = located_df[attr].drop_duplicates().to_list()
+
+        logger.info(f"Loaded {df.shape[0]} cached locations")
+        return _LocationsSnapshot(mtime_ns, df, location_ids_by_name, names)
+
+    def _current(self) -> _LocationsSnapshot:
+        mtime_ns = os.stat(self._path).st_mtime_ns
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.mtime_ns == mtime_ns:
+            return snapshot
+
+        with self._lock:
+            if self._snapshot is None or self._snapshot.mtime_ns != mtime_ns:
+                self._snapshot = self._load(mtime_ns)
+            return self._snapshot
+
+    def locations_df(self) -> pd.DataFrame:
+        return self._current().df
+
+    # ids of the locations in a city / state (case-insensitive)
+    def location_ids(self, location_name: str, for_city: bool) -> List[int]:
+        return self._current().location_ids_by_name["city" if for_city else "state"].get(
+            location_name.casefold(), []
+        )
+
+    # distinct city / state names
+    def names(self, attr: str) -> List[str]:
+        return self._current().names[attr]
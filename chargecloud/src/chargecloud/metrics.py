@@ -0,0 +1,160 @@
+import bisect
+import functools
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Optional
+
+# histogram bucket upper bounds (prometheus "le"), +Inf is implicit
+DURATION_BUCKETS_S = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROWS_BUCKETS = (0, 1, 10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+# stage of a request -> (histogram name, label of the stage's name, help)
+STAGES = {
+    "request": (
+        "chargecloud_request_duration_seconds",
+        "route",
+        "Wall time of the requests by route, including the json serialization of the response",
+    ),
+    "method": (
+        "chargecloud_repository_method_duration_seconds",
+        "method",
+        "Wall time of the public repository methods (cached responses included)",
+    ),
+    "query": (
+        "chargecloud_query_duration_seconds",
+        "query",
+        "Execution time of the duckdb statements by query name",
+    ),
+    "materialize": (
+        "chargecloud_materialize_duration_seconds",
+        "query",
+        "Time to convert the results of the duckdb statements to DataFrames by query name",
+    ),
+    "serialize": (
+        "chargecloud_serialize_duration_seconds",
+        "name",
+        "Json serialization time of the responses (route) and of the json strings built by the repository",
+    ),
+}
+ROWS_METRIC = ("chargecloud_query_rows", "query", "Rows returned by the duckdb statements by query name")
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+# Histograms with a single label, rendered in the prometheus text format.
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # metric name -> (label name, help, buckets, {label value: _Histogram})
+        self._metrics = {}
+
+    def register(self, name: str, label: str, help_text: str, buckets: tuple):
+        with self._lock:
+            self._metrics.setdefault(name, (label, help_text, buckets, {}))
+
+    def observe(self, name: str, label_value: str, value: float):
+        with self._lock:
+            _, _, buckets, histograms = self._metrics[name]
+            histogram = histograms.get(label_value)
+            if histogram is None:
+                histogram = histograms[label_value] = _Histogram(buckets)
+            histogram.observe(value)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (label, help_text, buckets, histograms) in sorted(self._metrics.items()):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for label_value, histogram in sorted(histograms.items()):
+                    label_pair = f'{label}="{_escape_label_value(label_value)}"'
+                    cumulative = 0
+                    for bound, count in zip(buckets + (float("inf"),), histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(float(bound))
+                        lines.append(f'{name}_bucket{{{label_pair},le="{le}"}} {cumulative}')
+                    lines.append(f"{name}_sum{{{label_pair}}} {histogram.sum!r}")
+                    lines.append(f"{name}_count{{{label_pair}}} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label_value(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+METRICS = MetricsRegistry()
+for _name, _label, _help in STAGES.values():
+    METRICS.register(_name, _label, _help, DURATION_BUCKETS_S)
+METRICS.register(*ROWS_METRIC, ROWS_BUCKETS)
+
+
+# Stages recorded while serving a single request (?profile=1), in the order they completed.
+class RequestProfile:
+    def __init__(self):
+        self.stages = []
+
+    def add(self, stage: str, name: str, seconds: float, rows: Optional[int] = None):
+        entry = {"stage": stage, "name": name, "ms": round(seconds * 1000, 3)}
+        if rows is not None:
+            entry["rows"] = rows
+        self.stages.append(entry)
+
+    # total ms by stage and the stages themselves
+    def summary(self, total_s: float) -> dict:
+        totals = {}
+        for entry in self.stages:
+            totals[entry["stage"]] = round(totals.get(entry["stage"], 0) + entry["ms"], 3)
+        return {"totalMs": round(total_s * 1000, 3), "totalMsByStage": totals, "stages": self.stages}
+
+
+_active = threading.local()
+
+
+# records the stages of the calls made by the current thread inside the block into the returned profile
+@contextmanager
+def profiling():
+    profile = RequestProfile()
+    _active.profile = profile
+    try:
+        yield profile
+    finally:
+        _active.profile = None
+
+
+def observe_stage(stage: str, name: str, seconds: float, rows: Optional[int] = None):
+    METRICS.observe(STAGES[stage][0], name, seconds)
+    if rows is not None:
+        METRICS.observe(ROWS_METRIC[0], name, rows)
+    profile = getattr(_active, "profile", None)
+    if profile is not None:
+        profile.add(stage, name, seconds, rows)
+
+
+@contextmanager
+def timed_stage(stage: str, name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, name, time.perf_counter() - start)
+
+
+# times every call of a public repository method as a "method" stage
+def instrumented(method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with timed_stage("method", method.__name__):
+            return method(*args, **kwargs)
+
+    return wrapper
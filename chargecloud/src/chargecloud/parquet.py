@@ -0,0 +1,121 @@
+import argparse
+import json
+import logging
+import os
+from datetime import datetime, timezone
+
+import duckdb
+
+logger = logging.getLogger(__name__)
+
+# written last by the export, a dataset without it is incomplete
+MANIFEST_FILE = "_manifest.json"
+
+# large tables, written as hive partitions <dataset>/<table>/stationId=<id>/month=<yyyy-mm>/*.parquet
+# with the rows of a file sorted, so parquet row group min/max statistics skip the rows outside of a time window:
+# - transactions carry the stationId / locationId of their chargepoint (no join needed to filter them by station)
+#   and are partitioned by the month they started in
+# - transaction_meter_values are partitioned by the station of their chargepoint and the month they were created in
+# - kwh_price is partitioned by station and the month of the price
+PARTITIONED_TABLES = {
+    "transactions": (
+        "SELECT tr.*, cp.locationId, cp.stationId, strftime(tr.startedAt, '%Y-%m') AS month "
+        "FROM source.transactions tr "
+        "LEFT JOIN source.chargepoints cp ON tr.chargePointId == cp.id "
+        "ORDER BY tr.startedAt, tr.id"
+    ),
+    "transaction_meter_values": (
+        "SELECT mv.*, cp.stationId, strftime(mv.createdAt, '%Y-%m') AS month "
+        "FROM source.transaction_meter_values mv "
+        "LEFT JOIN source.chargepoints cp ON mv.chargePointId == cp.id "
+        "ORDER BY mv.transactionId, mv.createdAt"
+    ),
+    "kwh_price": (
+        "SELECT *, strftime(priceAt, '%Y-%m') AS month FROM source.kwh_price ORDER BY stationId, priceAt"
+    ),
+}
+PARTITION_COLUMNS = "stationId, month"
+# partition columns the views don't expose, the other tables keep their columns of the db
+# (transactions keep stationId / locationId / month: filtering on them skips whole partitions)
+VIEW_EXCLUDED_COLUMNS = {
+    "transaction_meter_values": "stationId, month",
+    "kwh_price": "month",
+}
+PARTITION_TYPES = "{'stationId': BIGINT, 'month': VARCHAR}"
+
+# small tables, written as a single file <dataset>/<table>.parquet
+PLAIN_TABLES = ["chargepoints", "charging_status", "locations", "stations"]
+
+
+# writes the tables of the db as a parquet dataset, the target directory must not exist
+def export_parquet(source_path: str, dataset_path: str):
+    os.makedirs(dataset_path)
+    conn = duckdb.connect()
+    conn.execute(f"ATTACH '{source_path}' AS source (READ_ONLY)")
+
+    rows = {}
+    for table, select_sql in PARTITIONED_TABLES.items():
+        conn.execute(
+            f"COPY ({select_sql}) TO '{os.path.join(dataset_path, table)}' "
+            f"(FORMAT parquet, PARTITION_BY ({PARTITION_COLUMNS}))"
+        )
+        rows[table] = conn.execute(f"SELECT count(*) FROM source.{table}").fetchone()[0]
+        logger.info(f"Exported {rows[table]} {table} partitioned by {PARTITION_COLUMNS}")
+
+    for table in PLAIN_TABLES:
+        conn.execute(
+            f"COPY source.{table} TO '{os.path.join(dataset_path, table)}.parquet' (FORMAT parquet)"
+        )
+        rows[table] = conn.execute(f"SELECT count(*) FROM source.{table}").fetchone()[0]
+        logger.info(f"Exported {rows[table]} {table}")
+
+    conn.execute("DETACH source")
+    conn.close()
+
+    with open(os.path.join(dataset_path, MANIFEST_FILE), "w") as manifest:
+        json.dump(
+            {
+                "source": os.path.abspath(source_path),
+                "exportedAt": datetime.now(timezone.utc).isoformat(),
+                "rows": rows,
+            },
+            manifest,
+            indent=4,
+        )
+
+
+def manifest_path(dataset_path: str) -> str:
+    return os.path.join(dataset_path, MANIFEST_FILE)
+
+
+# creates a view per table of the dataset on the connection, named like the tables of the db, so the queries
+# run unchanged
+def create_parquet_views(conn, dataset_path: str):
+    if not os.path.exists(manifest_path(dataset_path)):
+        raise FileNotFoundError(f"{dataset_path} is not a complete parquet export (no {MANIFEST_FILE})")
+    # keep the parquet footers (schema, row group statistics) in memory instead of re-reading them on every query
+    conn.execute("SET parquet_metadata_cache = true")
+
+    for table in PARTITIONED_TABLES:
+        files = os.path.join(dataset_path, table, "*", "*", "*.parquet")
+        exclude = f" EXCLUDE ({VIEW_EXCLUDED_COLUMNS[table]})" if table in VIEW_EXCLUDED_COLUMNS else ""
+        conn.execute(
+            f"CREATE VIEW {table} AS SELECT *{exclude} FROM read_parquet("
+            f"'{files}', hive_partitioning = true, hive_types = {PARTITION_TYPES})"
+        )
+
+    for table in PLAIN_TABLES:
+        conn.execute(
+            f"CREATE VIEW {table} AS SELECT * FROM read_parquet('{os.path.join(dataset_path, table)}.parquet')"
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Exports the db as parquet files partitioned by station and month"
+    )
+    parser.add_argument("source", help="path of the source duckdb file")
+    parser.add_argument("target", help="directory of the parquet dataset, must not exist")
+    args = parser.parse_args()
+    export_parquet(args.source, args.target)
@@ -0,0 +1,104 @@
+import numpy as np
+
+QUARTER_HOUR_US = 15 * 60 * 1_000_000
+
+# where the price used by the turnover statistics comes from (see _transaction_metrics_sql)
+PRICE_SOURCES = np.array(["quarterHour", "stationAverage", "globalAverage"], dtype=object)
+
+
+# In-memory kwh prices of every station, for O(log n) price lookups.
+# The prices are kept sorted by (stationId, priceAt) as two flat arrays (priceAt in epoch microseconds, kwhPrice),
+# each station owning a contiguous slice, next to the average price of every station and of all stations
+# (the StatisticsAverages of the snapshot, so they are the averages the statistics fall back to).
+# A lookup finds the station's slice with a binary search on the station ids, then resolves all timestamps of the
+# lookup at once with searchsorted. Memory: 16 bytes per kwh_price row.
+class StationPriceIndex:
+    def __init__(self, station_ids, prices_at_us, kwh_prices, average_station_ids, average_prices, global_average_price):
+        station_ids = np.asarray(station_ids, dtype=np.int64)
+        self._prices_at_us = np.asarray(prices_at_us, dtype=np.int64)
+        self._kwh_prices = np.asarray(kwh_prices, dtype=float)
+        self._station_ids = np.asarray(average_station_ids, dtype=np.int64)
+        self._average_prices = np.asarray(average_prices, dtype=float)
+        self._global_average_price = global_average_price
+        # slice [starts[i], ends[i]) of the prices of _station_ids[i]
+        self._starts = np.searchsorted(station_ids, self._station_ids, side="left")
+        self._ends = np.searchsorted(station_ids, self._station_ids, side="right")
+
+    @classmethod
+    def from_db(cls, conn, averages):
+        prices = conn.execute(
+            "SELECT stationId, epoch_us(priceAt) AS priceAtUs, coalesce(kwhPrice, 'NaN'::DOUBLE) AS kwhPrice "
+            "FROM kwh_price WHERE stationId IS NOT NULL AND priceAt IS NOT NULL "
+            "ORDER BY stationId, priceAt"
+        ).fetchnumpy()
+        return cls(
+            station_ids=prices["stationId"],
+            prices_at_us=prices["priceAtUs"],
+            kwh_prices=prices["kwhPrice"],
+            average_station_ids=averages.station_ids,
+            # stations whose prices are all NULL have a NULL average
+            average_prices=[np.nan if price is None else price for price in averages.station_kwh_prices],
+            global_average_price=averages.kwh_price,
+        )
+
+    def __len__(self):
+        return self._prices_at_us.size
+
+    # average price of all stations, the price of the transactions of chargepoints without station (NaN if none)
+    @property
+    def global_average_price(self) -> float:
+        return np.nan if self._global_average_price is None else float(self._global_average_price)
+
+    # station's prices (priceAt in epoch microseconds, kwhPrice) and average price, empty / None without prices
+    def _station_prices(self, station_id: int):
+        position = np.searchsorted(self._station_ids, station_id)
+        if position == self._station_ids.size or self._station_ids[position] != station_id:
+            return self._prices_at_us[:0], self._kwh_prices[:0], None
+        start, end = self._starts[position], self._ends[position]
+        average_price = self._average_prices[position]
+        return (
+            self._prices_at_us[start:end],
+            self._kwh_prices[start:end],
+            None if np.isnan(average_price) else float(average_price),
+        )
+
+    # resolves the prices of a station at the timestamps (epoch microseconds, any order), returns arrays of:
+    # - hasPrice / priceAtUs / kwhPrice: the latest price reported at or before the timestamp (if any)
+    # - turnoverKwhPrice / turnoverPriceSource: the price the turnover statistics use for a transaction started at
+    #   the timestamp: the latest price strictly before it if it was reported exactly at its quarter-hour,
+    #   otherwise the station's average price, then the average price of all stations (NaN / None if none)
+    def resolve(self, station_id: int, timestamps_us) -> dict:
+        timestamps_us = np.asarray(timestamps_us, dtype=np.int64)
+        prices_at_us, kwh_prices, average_price = self._station_prices(station_id)
+
+        if average_price is not None:
+            fallback_price, fallback_source = average_price, PRICE_SOURCES[1]
+        elif self._global_average_price is not None:
+            fallback_price, fallback_source = self._global_average_price, PRICE_SOURCES[2]
+        else:
+            fallback_price, fallback_source = np.nan, None
+
+        if prices_at_us.size == 0:
+            return {
+                "hasPrice": np.zeros(timestamps_us.shape, dtype=bool),
+                "priceAtUs": np.zeros(timestamps_us.shape, dtype=np.int64),
+                "kwhPrice": np.full(timestamps_us.shape, np.nan),
+                "turnoverKwhPrice": np.full(timestamps_us.shape, fallback_price),
+                "turnoverPriceSource": np.full(timestamps_us.shape, fallback_source, dtype=object),
+            }
+
+        current = np.searchsorted(prices_at_us, timestamps_us, side="right") - 1
+        previous = np.searchsorted(prices_at_us, timestamps_us, side="left") - 1
+        previous_prices = kwh_prices[np.maximum(previous, 0)]
+        priced = (
+            (previous >= 0)
+            & (prices_at_us[np.maximum(previous, 0)] == timestamps_us // QUARTER_HOUR_US * QUARTER_HOUR_US)
+            & ~np.isnan(previous_prices)
+        )
+        return {
+            "hasPrice": current >= 0,
+            "priceAtUs": prices_at_us[np.maximum(current, 0)],
+            "kwhPrice": kwh_prices[np.maximum(current, 0)],
+            "turnoverKwhPrice": np.where(priced, previous_prices, fallback_price),
+            "turnoverPriceSource": np.where(priced, PRICE_SOURCES[0], fallback_source).astype(object),
+        }
@@ -0,0 +1,85 @@
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Optional
+
+import pandas as pd
+
+from .metrics import observe_stage
+
+logger = logging.getLogger(__name__)
+
+
+# Runs named sql statements with bound parameters ("?", lists as ?::BIGINT[]) on a given duckdb connection / cursor
+# and keeps the number of executions and the execution time of every statement name.
+# Executions are also recorded as "query" stages, conversions of their results to DataFrames as "materialize" stages
+# (see metrics.py).
+# Values are never formatted into the sql: a statement's text only depends on its shape (filter, interval, ...),
+# so duckdb sees a small set of distinct statements whatever the requested ids / time windows are.
+class QueryRunner:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> [executions, total seconds, max seconds, errors]
+        self._stats = {}
+
+    @contextmanager
+    def _timed(self, name: str):
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed_s = time.perf_counter() - start
+            with self._lock:
+                stats = self._stats.setdefault(name, [0, 0.0, 0.0, 0])
+                stats[0] += 1
+                stats[1] += elapsed_s
+                stats[2] = max(stats[2], elapsed_s)
+                stats[3] += failed
+            observe_stage("query", name, elapsed_s)
+            logger.debug(f"Query {name} took {elapsed_s * 1000:.2f} ms")
+
+    # executes the statement, the result is fetched by the caller (with fetch_df, or chunk by chunk when streamed)
+    def execute(self, conn, name: str, sql: str, params: Optional[list] = None):
+        with self._timed(name):
+            return conn.execute(sql, params or [])
+
+    # times a function running statements elsewhere (e.g. in worker processes) under the statement name
+    def call(self, name: str, function, *args):
+        with self._timed(name):
+            return function(*args)
+
+    def df(self, conn, name: str, sql: str, params: Optional[list] = None) -> pd.DataFrame:
+        with self._timed(name):
+            result = conn.execute(sql, params or [])
+        return self.fetch_df(name, result)
+
+    # converts the result of an executed statement to a DataFrame
+    @staticmethod
+    def fetch_df(name: str, result) -> pd.DataFrame:
+        start = time.perf_counter()
+        df = result.df()
+        observe_stage("materialize", name, time.perf_counter() - start, rows=df.shape[0])
+        return df
+
+    def fetchone(self, conn, name: str, sql: str, params: Optional[list] = None) -> Optional[tuple]:
+        with self._timed(name):
+            return conn.execute(sql, params or []).fetchone()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                name: {
+                    "executions": executions,
+                    "errors": errors,
+                    "totalMs": round(total_s * 1000, 3),
+                    "meanMs": round(total_s * 1000 / executions, 3),
+                    "maxMs": round(max_s * 1000, 3),
+                }
+                for name, (executions, total_s, max_s, errors) in sorted(self._stats.items())
+            }
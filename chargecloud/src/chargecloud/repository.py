@@ -1,335 +1,1442 @@
 import json
 import logging
-from collections import defaultdict
+import os
+import threading
+import time
+from datetime import datetime
 
 import duckdb
+import numpy as np
 import pandas as pd
 
-from datetime import datetime
-from geopy.distance import distance
 from typing import Tuple, Optional
 
-from .validate import validate_locations, validate_transactions
-from .util import (
-    check_and_update_locations_cache,
-    load_locations_df,
-    previous_quarter_hour,
+from .averages import EXACT_SUM_TYPE
+from .cache import ResponseCache, cached_response, files_fingerprint
+from .live import LiveIngestStore
+from .locations import LocationsIndex
+from .metrics import instrumented, timed_stage
+from .queries import QueryRunner
+from .rollup import HourlyRollupStore
+from .sharding import ShardedStatistics
+from .snapshot import SourceSnapshot, pinned_snapshot
+from .spatial import DEFAULT_BOUNDARY_TOLERANCE
+from .streaming import (
+    STREAM_FORMATS,
+    iter_df_chunks,
+    peek_chunks,
+    stream_grouped_records,
+    stream_json_records,
+    stream_values,
+)
+from .validate import (
+    ISSUE_NAMES,
+    ValidationCache,
+    counts_response,
+    full_response,
+    page_response,
+    validate_locations,
+    validate_transactions,
 )
+from .window import DEFAULT_PAGE_LIMIT, TimeWindow, parse_timestamp
+from .util import LOCATIONS_CACHE_PATH, check_and_update_locations_cache
 
 STATISTICS_TYPES = ["turnoverEur", "kwhConsumed"]
 INTERVAL_TYPES = ["hourly", "daily", "allTime"]
+DURATION_FORMATS = ["iso", "seconds"]
 
 
 class ChargeCloudRepository:
-    def __init__(self, db_path: str):
-        self._conn = duckdb.connect(database=db_path, read_only=True)
+    def __init__(
+        self,
+        db_path: str,
+        rollup_path: Optional[str] = None,
+        radius_boundary_tolerance: float = DEFAULT_BOUNDARY_TOLERANCE,
+        geocoding_options: Optional[dict] = None,
+        response_cache_options: Optional[dict] = None,
+        parquet_path: Optional[str] = None,
+        validation_interval_s: float = 0,
+        background_startup: bool = False,
+        reload_interval_s: float = 0,
+        live_path: Optional[str] = None,
+        statistics_workers: int = 1,
+    ):
+        self._db_path = db_path
+        self._parquet_path = parquet_path
+        self._radius_boundary_tolerance = radius_boundary_tolerance
+        self._response_cache_options = response_cache_options
+        self._geocoding_options = geocoding_options
+        self._thread_local = threading.local()
         self._logger = logging.getLogger(__name__)
+        self._queries = QueryRunner()
+
+        # the tables are read from the db, or from a parquet export of it (see parquet.py) if parquet_path is given,
+        # through the current snapshot of the source (connection, spatial / price indexes and response cache),
+        # swapped for a new one when the source file is replaced (see reload)
+        self._reload_lock = threading.Lock()
+        self._live = None
+        self._snapshot = self._open_snapshot()
+        # transactions with the stationId / locationId of their chargepoint (alias tr),
+        # the parquet transactions already carry them and are partitioned by stationId and month
+        self._parquet = bool(parquet_path)
+        self._station_transactions_sql = (
+            "transactions tr"
+            if self._parquet
+            else "(SELECT tr.*, cp.stationId, cp.locationId "
+            "FROM transactions tr JOIN chargepoints cp ON tr.chargePointId == cp.id) tr"
+        )
 
         # fetch and cache city/state information from location points
-        check_and_update_locations_cache(self._conn, overwrite=False)
-
-    def validate(self) -> Tuple[int, object]:
-        issues = defaultdict(list)
-        validate_locations(load_locations_df(), issues)
-        validate_transactions(self._conn, issues)
-        return 200, issues
-
-    def _compute_transaction_turnover(self, row):
-
-        candidate_price = self._conn.execute(
-            f"SELECT * FROM kwh_price "
-            f"WHERE stationId = '{row['stationId']}' "
-            f"AND priceAt < '{row['startedAt']}' "
-            f"ORDER BY priceAt DESC LIMIT 1"
-        ).df()
-
-        kwh_price_ideal_time = previous_quarter_hour(row["startedAt"].isoformat())
-        if candidate_price.empty:
-            # found no price for station prior to the transaction time -> use fallback price
-            transaction_kwh_price = self._kwh_price_fallback_by_station(
-                row["stationId"]
+        # with background_startup, locations missing from an existing cache are geocoded in the background
+        # (the cache is reloaded as they are appended), without a cache there are no city / state names to serve yet
+        if background_startup and os.path.exists(LOCATIONS_CACHE_PATH):
+            threading.Thread(
+                target=self._update_locations_cache,
+                name="chargecloud-geocoding",
+                daemon=True,
+            ).start()
+        else:
+            check_and_update_locations_cache(
+                self._conn, overwrite=False, **(geocoding_options or {})
             )
-        elif (
-            datetime.fromisoformat(candidate_price["priceAt"][0].isoformat())
-            != kwh_price_ideal_time
-        ):
-            # price at station is not up-to-date -> use fallback price
-            transaction_kwh_price = self._kwh_price_fallback_by_station(
-                row["stationId"]
+        self._locations = LocationsIndex()
+
+        # validation issues, validated again when the source is reloaded or the locations cache changes
+        # (periodically in the background if validation_interval_s > 0, otherwise on the next /validate)
+        self._validation = ValidationCache(
+            fingerprint=self._source_fingerprint, validate=self._validation_issues
+        )
+
+        # optional precomputed hourly statistics, kept in a sidecar db as the source db is read-only
+        # with background_startup, the statistics use the raw transactions until the rollup is refreshed
+        # (as they do if the refresh fails, see HourlyRollupStore.refresh)
+        self._rollups = None
+        if rollup_path:
+            self._rollups = HourlyRollupStore(rollup_path)
+            source_fingerprint = self._current_snapshot().source_fingerprint
+            if background_startup:
+                self._rollups.refresh_in_background(self._conn, source_fingerprint)
+            else:
+                self._rollups.refresh(self._conn, source_fingerprint)
+
+        # optional transactions / meter values ingested while the server runs (see ingest),
+        # kept in a sidecar db and added to the statistics and the chargepoint reliability
+        if live_path:
+            self._live = LiveIngestStore(live_path, self._snapshot)
+
+        # optional worker processes computing the city / state statistics shard by shard (see sharding.py)
+        self._sharded_statistics = (
+            ShardedStatistics(statistics_workers) if statistics_workers > 1 else None
+        )
+
+        if validation_interval_s > 0:
+            self._validation.start_background_revalidation(validation_interval_s)
+
+        if reload_interval_s > 0:
+            threading.Thread(
+                target=self._watch_source,
+                args=(reload_interval_s,),
+                name="chargecloud-reload",
+                daemon=True,
+            ).start()
+
+    def _open_snapshot(self) -> SourceSnapshot:
+        return SourceSnapshot(
+            self._db_path,
+            parquet_path=self._parquet_path,
+            radius_boundary_tolerance=self._radius_boundary_tolerance,
+            response_cache_options=self._response_cache_options,
+            data_version=lambda: self._live.version if self._live is not None else None,
+        )
+
+    # the snapshot pinned by the running public method (see pinned_snapshot), otherwise the current one
+    def _current_snapshot(self) -> SourceSnapshot:
+        return getattr(self._thread_local, "snapshot", None) or self._snapshot
+
+    # every thread gets its own cursor on the read-only connection, so requests can be served concurrently
+    @property
+    def _conn(self) -> duckdb.DuckDBPyConnection:
+        snapshot = self._current_snapshot()
+        if getattr(self._thread_local, "cursor_snapshot", None) is not snapshot:
+            self._thread_local.cursor = snapshot.db.cursor()
+            self._thread_local.cursor_snapshot = snapshot
+        return self._thread_local.cursor
+
+    @property
+    def _response_cache(self) -> Optional[ResponseCache]:
+        return self._current_snapshot().response_cache
+
+    # opens the source file again as a new snapshot, builds its indexes and swaps it in,
+    # requests already running finish on the previous snapshot (released when they are done)
+    def reload(self):
+        with self._reload_lock:
+            previous = self._snapshot
+            snapshot = self._open_snapshot()
+            snapshot.warm_up(previous)
+            self._snapshot = snapshot
+            # the live transactions the new source contains are now read from it
+            if self._live is not None:
+                self._live.rebuild(snapshot)
+        # the statistics use the raw transactions until the rollup is refreshed from the new source
+        if self._rollups is not None:
+            self._rollups.refresh_in_background(snapshot.db, snapshot.source_fingerprint)
+        self._logger.info(f"Reloaded {snapshot.source_path}")
+        # locations of the new source missing from the locations cache
+        self._update_locations_cache()
+
+    # reloads the source once its file was replaced and stayed unchanged for an interval (it may still be written),
+    # a file that fails to load is kept until it changes again
+    def _watch_source(self, interval_s: float):
+        pending, failed = None, None
+        while True:
+            time.sleep(interval_s)
+            fingerprint = files_fingerprint(self._snapshot.source_path)[0]
+            if fingerprint is None or fingerprint in (self._snapshot.source_fingerprint, failed):
+                pending = None
+                continue
+            if fingerprint != pending:
+                pending = fingerprint
+                continue
+            try:
+                self.reload()
+            except Exception:
+                self._logger.exception(f"Reloading {self._snapshot.source_path} failed")
+                failed = fingerprint
+            pending = None
+
+    def _update_locations_cache(self):
+        try:
+            check_and_update_locations_cache(
+                self._conn, overwrite=False, **(self._geocoding_options or {})
             )
-        else:
-            transaction_kwh_price = candidate_price["kwhPrice"][0]
+        except Exception:
+            self._logger.exception("Background geocoding failed")
 
-        row["turnoverEur"] = (transaction_kwh_price * row["kwhConsumed"]) / 100
+    # loads the indexes that are otherwise built by the first request using them
+    def warm_up(self):
+        self._locations.locations_df()
 
-        # useful for debugging
-        row["transaction_kwh_price_eur"] = transaction_kwh_price / 100
-        return row
+    # version of the source the current snapshot was opened on and of the locations cache
+    def _source_fingerprint(self) -> tuple:
+        return (self._current_snapshot().source_fingerprint,) + files_fingerprint(LOCATIONS_CACHE_PATH)
 
-    #  use average price of the stations instead of using an old price
-    #  falls back to the average price of all stations in case the station didn't have any reported price
-    def _kwh_price_fallback_by_station(self, station_id) -> float:
-        average_price = self._conn.execute(
-            f"SELECT avg(kwhPrice) FROM kwh_price "
-            f"WHERE stationId = '{station_id}' "
-            f"GROUP BY stationId"
-        ).df()
-        if average_price.empty:
-            return self._kwh_price_last_fallback()
+    def _validation_issues(self) -> list:
+        return validate_locations(self._locations.locations_df()) + validate_transactions(
+            self._conn, self._queries
+        )
 
-        return average_price["avg(kwhPrice)"][0]
+    # all issues with their ids, the number of ids of every issue (counts_only),
+    # or a page of the ids of an issue (issue, limit, cursor)
+    @instrumented
+    @pinned_snapshot
+    def validate(
+        self,
+        counts_only: bool = False,
+        issue: Optional[str] = None,
+        limit: Optional[int] = None,
+        cursor: Optional[int] = None,
+    ) -> Tuple[int, object]:
+        if issue is None and (limit is not None or cursor is not None):
+            error_msg = "limit and cursor are only supported with an issue"
+            self._logger.error(error_msg)
+            return 400, {"ERROR": error_msg}
+        if issue is not None and counts_only:
+            error_msg = "counts can't be combined with an issue"
+            self._logger.error(error_msg)
+            return 400, {"ERROR": error_msg}
+        if issue is not None and issue not in ISSUE_NAMES:
+            error_msg = f"Invalid issue : {issue}. Must be one of {ISSUE_NAMES}"
+            self._logger.error(error_msg)
+            return 400, {"ERROR": error_msg}
+        if issue is not None:
+            try:
+                limit = DEFAULT_PAGE_LIMIT if limit is None else int(limit)
+                cursor = None if cursor is None else int(cursor)
+            except (TypeError, ValueError):
+                error_msg = f"Invalid limit / cursor : {limit} / {cursor}. Must be integers"
+                self._logger.error(error_msg)
+                return 400, {"ERROR": error_msg}
+            if limit <= 0:
+                error_msg = f"Invalid limit : {limit}. Must be positive"
+                self._logger.error(error_msg)
+                return 400, {"ERROR": error_msg}
 
-    def _kwh_price_last_fallback(self) -> float:
-        average_price = self._conn.execute(f"SELECT avg(kwhPrice) FROM kwh_price").df()
-        return average_price["avg(kwhPrice)"][0]
+        issues, validated_at = self._validation.issues()
+        if counts_only:
+            return 200, counts_response(issues, validated_at)
+        if issue is not None:
+            page = page_response(issues, issue, limit, cursor, validated_at)
+            if page is None:
+                return 200, {"NoContent": f"No {issue} found"}
+            return 200, page
+        return 200, full_response(issues)
 
-    def _fetch_transactions(self, station_id: Optional[int] = None):
+    # builds the CTEs computing the statistics of every transaction matching the filter (on stationId / locationId)
+    # as transaction_metrics (startedAt, stationId, locationId and a column per statistics type):
+    # - transactions with negative kwhConsumed are incomplete -> use average kwhConsumed of all transactions
+    # - turnoverEur uses the latest kwh_price of the station before the transaction start (ASOF join),
+    #   only if it was reported exactly at the previous quarter-hour of the transaction start.
+    #   otherwise falls back to the average price of the station, then to the average price of all stations
+    #   only the prices of the stations of the filtered transactions are joined,
+    #   so the ASOF join sorts the prices of these stations instead of the whole kwh_price table
+    # the averages are the snapshot's StatisticsAverages (global_averages / station_average_price), computed once
+    def _transaction_metrics_sql(self, statistics_types: list, transactions_filter: str) -> str:
+        self._current_snapshot().statistics_averages()
         sql = (
-            f"SELECT * FROM transactions tr "
-            f"JOIN chargepoints cp "
-            f"ON tr.chargePointId == cp.id "
+            "WITH filtered_transactions AS ("
+            "    SELECT tr.startedAt, tr.stationId, tr.locationId, "
+            "    CASE WHEN tr.kwhConsumed < 0 "
+            "        THEN (SELECT averageKwhConsumed FROM global_averages) "
+            "        ELSE tr.kwhConsumed "
+            "    END AS kwhConsumed "
+            f"    FROM {self._station_transactions_sql} "
+            f"    WHERE {transactions_filter}"
+            "), "
         )
 
-        if station_id:
-            sql += f"WHERE cp.stationId = '{station_id}'"
+        if "turnoverEur" not in statistics_types:
+            return sql + (
+                "transaction_metrics AS ("
+                "    SELECT startedAt, stationId, locationId, kwhConsumed FROM filtered_transactions"
+                ") "
+            )
+
+        return sql + (
+            "station_price AS ("
+            "    SELECT * FROM kwh_price WHERE stationId IN (SELECT stationId FROM filtered_transactions)"
+            "), "
+            "transaction_metrics AS ("
+            "    SELECT ft.startedAt, ft.stationId, ft.locationId, ft.kwhConsumed, "
+            "    (coalesce("
+            "        CASE WHEN p.priceAt = time_bucket(INTERVAL '15 minutes', ft.startedAt) "
+            "            THEN p.kwhPrice END, "
+            "        sap.averagePrice, "
+            "        ga.averagePrice"
+            "    ) * ft.kwhConsumed) / 100 AS turnoverEur "
+            "    FROM filtered_transactions ft "
+            "    ASOF LEFT JOIN station_price p "
+            "    ON ft.stationId = p.stationId AND ft.startedAt > p.priceAt "
+            "    LEFT JOIN station_average_price sap ON ft.stationId = sap.stationId "
+            "    CROSS JOIN global_averages ga"
+            ") "
+        )
 
-        return self._conn.execute(sql).df().rename(columns={"id": "transactionId"})
+    # window predicate on the transactions of _station_transactions_sql
+    # (the parquet transactions are also selected by month, so only the partitions of the window are read)
+    def _transactions_window_predicate(self, window: TimeWindow) -> Tuple[str, list]:
+        predicate, params = window.predicate("tr.startedAt")
+        if self._parquet:
+            month_predicate, month_params = window.month_predicate("tr.month")
+            predicate, params = f"{predicate} AND {month_predicate}", params + month_params
+        return predicate, params
+
+    # transaction_statistics (startedAt, statistic) of a single statistics type (or the given cte name)
+    def _transaction_statistics_sql(
+        self, statistics_type: str, transactions_filter: str, cte_name: str = "transaction_statistics"
+    ) -> str:
+        return self._transaction_metrics_sql([statistics_type], transactions_filter) + (
+            f", {cte_name} AS ("
+            f"    SELECT startedAt, {statistics_type} AS statistic FROM transaction_metrics"
+            ") "
+        )
 
+    # runs the whole statistics pipeline in duckdb, only the aggregated buckets are returned
     def _aggregate_statistics_by_type_and_interval(
-        self, transactions_df: pd.DataFrame, statistics_type: str, interval_type: str
+        self,
+        transactions_filter: str,
+        params: list,
+        statistics_type: str,
+        interval_type: str,
+        stream_format: Optional[str] = None,
+        window: TimeWindow = TimeWindow(),
+        page: Optional[Tuple[int, Optional[datetime]]] = None,
+        sharded: bool = False,
+    ):
+        if statistics_type not in STATISTICS_TYPES:
+            error_msg = f"Invalid statistics_type : {statistics_type}. Must be one of {STATISTICS_TYPES}"
+            self._logger.error(error_msg)
+            return 400, {"ERROR": error_msg}
+
+        # hourly statistics of the live transactions matching the filter, added to the ones of the source
+        live_rows = self._live_statistics([statistics_type], transactions_filter, params, window)
+        cte_name = "source_statistics" if live_rows else "transaction_statistics"
+
+        # answer from the hourly rollup when it's up-to-date with the db, otherwise compute from raw transactions
+        # (a window that doesn't fall on hour boundaries can't be answered from hourly buckets)
+        rollup_fresh = self._rollups is not None and self._rollups.is_fresh(
+            self._current_snapshot().source_fingerprint
+        )
+        if rollup_fresh and window.is_hour_aligned():
+            window_predicate, window_params = window.predicate("hour")
+            sql = self._rollups.statistics_sql(
+                statistics_type, f"({transactions_filter}) AND {window_predicate}", cte_name
+            )
+            conn, source = self._rollups.cursor(), "rollup"
+        else:
+            if self._rollups is not None and not rollup_fresh:
+                self._rollups.refresh_in_background(self._conn, self._current_snapshot().source_fingerprint)
+            window_predicate, window_params = self._transactions_window_predicate(window)
+            sql = self._transaction_statistics_sql(
+                statistics_type, f"({transactions_filter}) AND {window_predicate}", cte_name
+            )
+            # a streamed result is consumed after the method returns -> use a dedicated cursor
+            conn = self._current_snapshot().db.cursor() if stream_format else self._conn
+            source = "transactions"
+
+            # the partial buckets of the worker processes are summed by bucket like the statistics of the transactions
+            if sharded and self._sharded_statistics is not None:
+                partial_buckets = self._sharded_partial_buckets(
+                    statistics_type, transactions_filter, params, window_predicate, window_params
+                )
+                if partial_buckets is not None:
+                    sql = (
+                        f"WITH {cte_name} AS ("
+                        "    SELECT unnest(?::TIMESTAMP[]) AS startedAt, "
+                        f"    unnest(?::{EXACT_SUM_TYPE}[]) AS statistic"
+                        ") "
+                    )
+                    params, window_params = [
+                        [hour for hour, _ in partial_buckets],
+                        [statistic for _, statistic in partial_buckets],
+                    ], []
+                    source = "sharded"
+
+        params = params + window_params
+
+        if live_rows:
+            sql += (
+                ", transaction_statistics AS ("
+                "    SELECT startedAt, statistic FROM source_statistics "
+                "    UNION ALL "
+                "    SELECT unnest(?::TIMESTAMP[]) AS startedAt, unnest(?::DOUBLE[]) AS statistic"
+                ") "
+            )
+            params = params + [[row[0] for row in live_rows], [row[3] for row in live_rows]]
+
+        if interval_type == "allTime":
+            buckets_count, statistic_sum = self._queries.fetchone(
+                conn,
+                f"{source}.statistics_allTime",
+                sql + "SELECT count(*), "
+                f"sum(statistic::{EXACT_SUM_TYPE})::DOUBLE FROM transaction_statistics",
+                params,
+            )
+            if buckets_count == 0:
+                msg = "No transactions found"
+                self._logger.warning(msg)
+                return 200, {"NoContent": msg}
+            return 200, {f"allTime_{statistics_type}": statistic_sum}
+
+        return self._aggregate_statistics(
+            conn, source, sql, params, statistics_type, interval_type, stream_format, page
+        )
+
+    # (hour, exact sum of the statistic) partial buckets of every shard of the transactions matching the filter (a range
+    # of the stations of their chargepoints, the transactions of chargepoints without station are a shard of their own),
+    # computed by the worker processes on the version of the source of the current snapshot, with its averages.
+    # None if the source was replaced meanwhile or a worker failed (the statistics are then computed in the process)
+    def _sharded_partial_buckets(
+        self, statistics_type, transactions_filter, params, window_predicate, window_params
+    ) -> Optional[list]:
+        station_ids = [
+            station_id
+            for (station_id,) in self._queries.execute(
+                self._conn,
+                "sharded.station_ids",
+                f"SELECT DISTINCT stationId FROM chargepoints WHERE {transactions_filter} ORDER BY stationId",
+                params,
+            ).fetchall()
+        ]
+
+        def shard_query(shard_predicate: str, shard_params: list):
+            sql = self._transaction_statistics_sql(
+                statistics_type, f"({transactions_filter}) AND {shard_predicate} AND {window_predicate}"
+            ) + (
+                f"SELECT date_trunc('hour', startedAt), sum(statistic::{EXACT_SUM_TYPE}) "
+                "FROM transaction_statistics GROUP BY ALL"
+            )
+            return sql, params + shard_params + window_params
+
+        shard_queries = [
+            shard_query("stationId BETWEEN ? AND ?", [first, last])
+            for first, last in self._sharded_statistics.station_ranges(
+                [station_id for station_id in station_ids if station_id is not None]
+            )
+        ]
+        if None in station_ids:
+            shard_queries.append(shard_query("stationId IS NULL", []))
+
+        source = (self._db_path, self._parquet_path, self._current_snapshot().source_fingerprint)
+        try:
+            return self._queries.call(
+                "sharded.statistics_partial_buckets",
+                self._sharded_statistics.partial_buckets,
+                source,
+                self._current_snapshot().statistics_averages(),
+                shard_queries,
+            )
+        except Exception:
+            self._logger.exception("Sharded statistics failed, computing them in the process")
+            return None
+
+    # hourly statistics (hour, stationId, locationId and a value per statistics type) of the live transactions matching
+    # the filter (the one of the source transactions, with its params) in the window, empty without live data
+    def _live_statistics(
+        self, statistics_types: list, transactions_filter: str, params: list, window: TimeWindow
+    ) -> list:
+        if self._live is None:
+            return []
+        sql, window_params = self._live.statistics_sql(statistics_types, transactions_filter, window)
+        return self._queries.execute(
+            self._live.cursor(), "live.statistics", sql, params + window_params
+        ).fetchall()
+
+    def _aggregate_statistics(
+        self,
+        conn,
+        source,
+        sql,
+        params,
+        statistics_type,
+        interval_type,
+        stream_format=None,
+        page=None,
     ):
-        def use_average_kwh_consumed(row):
-            if row["kwhConsumed"] < 0:
-                row["kwhConsumed"] = average_kwh_consumed
-            return row
-
-        if not transactions_df[transactions_df["kwhConsumed"] < 0].empty:
-            # transactions with negative kwhConsumed are incomplete -> use average kwhConsumed of all transactions
-            average_kwh_consumed = self._conn.execute(
-                "SELECT avg(kwhConsumed) FROM transactions"
-            ).df()["avg(kwhConsumed)"][0]
-            transactions_df = transactions_df.apply(use_average_kwh_consumed, axis=1)
-
-        if transactions_df.empty:
+        date_part, column = {"hourly": ("hour", "hour"), "daily": ("day", "date")}[
+            interval_type
+        ]
+
+        # a page holds the buckets after the cursor (the last bucket of the previous page)
+        # one more bucket than the limit is fetched to know whether there is a next page
+        page_sql, page_params = "", []
+        if page is not None:
+            limit, cursor = page
+            if cursor is not None:
+                page_sql += "WHERE ab.bucket > ? "
+                page_params.append(cursor)
+            page_sql += "ORDER BY ab.bucket LIMIT ?"
+            page_params.append(limit + 1)
+        else:
+            page_sql = "ORDER BY ab.bucket"
+
+        # sum by bucket, empty buckets between the first and the last transaction are reported as 0
+        query_name = f"{source}.statistics_{interval_type}"
+        result = self._queries.execute(
+            conn,
+            query_name,
+            sql + f", buckets AS ("
+            f"    SELECT date_trunc('{date_part}', startedAt) AS bucket, "
+            f"    sum(statistic::{EXACT_SUM_TYPE})::DOUBLE AS statistic "
+            f"    FROM transaction_statistics GROUP BY bucket"
+            f"), "
+            f"all_buckets AS ("
+            f"    SELECT unnest(generate_series(min(bucket), max(bucket), INTERVAL 1 {date_part})) AS bucket "
+            f"    FROM buckets"
+            f") "
+            f"SELECT ab.bucket AS {column}, coalesce(b.statistic, 0) AS {statistics_type} "
+            f"FROM all_buckets ab LEFT JOIN buckets b ON ab.bucket = b.bucket "
+            f"{page_sql}",
+            params + page_params,
+        )
+
+        if stream_format:
+            chunks = peek_chunks(iter_df_chunks(result))
+            if chunks is None:
+                msg = "No transactions found"
+                self._logger.warning(msg)
+                return 200, {"NoContent": msg}
+
+            # serialized like the non-streamed output (same to_json formatting of the dates and values)
+            def format_buckets(chunk):
+                if interval_type == "daily":
+                    chunk["date"] = chunk["date"].dt.date
+                return chunk
+
+            return 200, stream_json_records(map(format_buckets, chunks), stream_format)
+
+        df = self._queries.fetch_df(query_name, result)
+        if df.empty:
             msg = "No transactions found"
             self._logger.warning(msg)
             return 200, {"NoContent": msg}
 
-        match statistics_type:
-            case "kwhConsumed":
-                return 200, self._aggregate_statistics(
-                    transactions_df, statistics_type, interval_type
-                )
-            case "turnoverEur":
-                transactions_df = transactions_df.apply(
-                    self._compute_transaction_turnover, axis=1
-                )
-                return 200, self._aggregate_statistics(
-                    transactions_df, statistics_type, interval_type
-                )
-            case _:
-                error_msg = f"Invalid statistics_type : {statistics_type}. Must be one of {STATISTICS_TYPES}"
-                self._logger.error(error_msg)
-                return 400, {"ERROR": error_msg}
+        next_cursor = None
+        if page is not None and df.shape[0] > page[0]:
+            df = df.iloc[: page[0]]
+            next_cursor = df[column].iloc[-1].isoformat()
+
+        if interval_type == "daily":
+            df["date"] = df["date"].dt.date
+
+        if page is not None:
+            with timed_stage("serialize", "statistics"):
+                buckets = json.loads(df.to_json(date_format="iso", orient="records"))
+            return 200, {"buckets": buckets, "count": df.shape[0], "nextCursor": next_cursor}
+
+        with timed_stage("serialize", "statistics"):
+            return 200, df.to_json(indent=4, date_format="iso", orient="records")
 
+    @instrumented
+    @pinned_snapshot
+    @cached_response(
+        "station_statistics",
+        lambda station_id, statistics_type, interval_type, time_from=None, time_to=None, limit=None, cursor=None: (
+            station_id,
+            statistics_type,
+            interval_type,
+            time_from,
+            time_to,
+            limit,
+            cursor,
+        ),
+    )
     def get_statistics_by_station(
-        self, station_id: int, statistics_type: str, interval_type: str
+        self,
+        station_id: int,
+        statistics_type: str,
+        interval_type: str,
+        stream_format: Optional[str] = None,
+        time_from: Optional[str] = None,
+        time_to: Optional[str] = None,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
     ) -> Tuple[int, object]:
         if interval_type not in INTERVAL_TYPES:
             error_msg = f"Invalid interval_type : {interval_type}. Must be one of {INTERVAL_TYPES}"
             self._logger.error(error_msg)
             return 400, error_msg
 
-        transactions_df = self._fetch_transactions(station_id=station_id)
+        if invalid_stream_format := self._check_stream_format(stream_format):
+            return invalid_stream_format
+
+        window, page, invalid_window_or_page = self._parse_window_and_page(
+            time_from, time_to, limit, cursor, stream_format, parse_timestamp
+        )
+        if invalid_window_or_page:
+            return invalid_window_or_page
+
+        station_id, invalid_station_id = self._parse_id(station_id, "station_id")
+        if invalid_station_id:
+            return invalid_station_id
+
         return self._aggregate_statistics_by_type_and_interval(
-            transactions_df=transactions_df,
+            transactions_filter="stationId = ?",
+            params=[station_id],
             statistics_type=statistics_type,
             interval_type=interval_type,
+            stream_format=stream_format,
+            window=window,
+            page=page,
         )
 
     # location name could be a city or a state
+    @instrumented
+    @pinned_snapshot
+    @cached_response(
+        "location_statistics",
+        lambda location_name, for_city, statistics_type, interval_type, time_from=None, time_to=None, limit=None, cursor=None: (
+            location_name.casefold(),
+            for_city,
+            statistics_type,
+            interval_type,
+            time_from,
+            time_to,
+            limit,
+            cursor,
+        ),
+    )
     def get_statistics_by_location(
         self,
         location_name: str,
         for_city: bool,
         statistics_type: str,
         interval_type: str,
+        stream_format: Optional[str] = None,
+        time_from: Optional[str] = None,
+        time_to: Optional[str] = None,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
     ):
 
-        def location_filter(row):
-            # filter on city/state name (case-insensitive)
-            val = row.get("city" if for_city else "state", "UNKNOWN")
-            if not val:
-                return False
-            return (
-                row["city" if for_city else "state"].casefold()
-                == location_name.casefold()
-            )
-
         if interval_type not in INTERVAL_TYPES:
             error_msg = f"Invalid interval_type : {interval_type}. Must be one of {INTERVAL_TYPES}"
             self._logger.error(error_msg)
             return 400, error_msg
 
-        # load cached locations with city / state info
-        df = load_locations_df().rename(columns={"id": "locationId"})
+        if invalid_stream_format := self._check_stream_format(stream_format):
+            return invalid_stream_format
 
-        # filter locations within the city / state
-        locations_df = df[df.apply(location_filter, axis=1)]
+        window, page, invalid_window_or_page = self._parse_window_and_page(
+            time_from, time_to, limit, cursor, stream_format, parse_timestamp
+        )
+        if invalid_window_or_page:
+            return invalid_window_or_page
 
-        # all transactions
-        transactions_df = self._fetch_transactions()
+        # locations within the city / state (case-insensitive)
+        location_ids = self._locations.location_ids(location_name, for_city)
 
         # all transactions for city / state
-        transactions_df = locations_df.merge(transactions_df, on="locationId")
         return self._aggregate_statistics_by_type_and_interval(
-            transactions_df=transactions_df,
+            transactions_filter="locationId IN (SELECT unnest(?::BIGINT[]))",
+            params=[location_ids],
             statistics_type=statistics_type,
             interval_type=interval_type,
+            stream_format=stream_format,
+            window=window,
+            page=page,
+            sharded=True,
+        )
+
+    # statistics of several stations / cities / states and statistics types in a single grouped query
+    # returns {"stations": {stationId: result}, "cities": {name: result}, "states": {name: result}} where a result
+    # is the list of buckets with a column per statistics type (hourly / daily) or the allTime statistics
+    @instrumented
+    @pinned_snapshot
+    @cached_response(
+        "statistics_batch",
+        # (repr: the payload is keyed before it's validated, it may hold strings instead of lists or unhashable values)
+        lambda interval_type, station_ids=None, city_names=None, state_names=None, statistics_types=None, time_from=None, time_to=None: (
+            repr((interval_type, station_ids, city_names, state_names, statistics_types, time_from, time_to)),
+        ),
+    )
+    def get_statistics_batch(
+        self,
+        interval_type: str,
+        station_ids: Optional[list] = None,
+        city_names: Optional[list] = None,
+        state_names: Optional[list] = None,
+        statistics_types: Optional[list] = None,
+        time_from: Optional[str] = None,
+        time_to: Optional[str] = None,
+    ):
+        if interval_type not in INTERVAL_TYPES:
+            error_msg = f"Invalid interval_type : {interval_type}. Must be one of {INTERVAL_TYPES}"
+            self._logger.error(error_msg)
+            return 400, {"ERROR": error_msg}
+
+        # the lists are iterated: a string would be taken character by character
+        for argument, values in [
+            ("station_ids", station_ids),
+            ("city_names", city_names),
+            ("state_names", state_names),
+            ("statistics_types", statistics_types),
+        ]:
+            if values is not None and not isinstance(values, list):
+                error_msg = f"Invalid {argument} : {values}. Must be a list"
+                self._logger.error(error_msg)
+                return 400, {"ERROR": error_msg}
+        for argument, values in [("city_names", city_names), ("state_names", state_names)]:
+            if not all(isinstance(value, str) for value in values or []):
+                error_msg = f"Invalid {argument} : {values}. Must be a list of strings"
+                self._logger.error(error_msg)
+                return 400, {"ERROR": error_msg}
+
+        statistics_types = statistics_types or STATISTICS_TYPES
+        for statistics_type in statistics_types:
+            if statistics_type not in STATISTICS_TYPES:
+                error_msg = f"Invalid statistics_type : {statistics_type}. Must be one of {STATISTICS_TYPES}"
+                self._logger.error(error_msg)
+                return 400, {"ERROR": error_msg}
+        statistics_types = [t for t in STATISTICS_TYPES if t in statistics_types]
+
+        try:
+            station_ids = [int(station_id) for station_id in station_ids or []]
+        except (TypeError, ValueError):
+            error_msg = f"Invalid station_ids : {station_ids}. Must be a list of integers"
+            self._logger.error(error_msg)
+            return 400, {"ERROR": error_msg}
+
+        if not (station_ids or city_names or state_names):
+            error_msg = "At least one of station_ids, city_names, state_names is required"
+            self._logger.error(error_msg)
+            return 400, {"ERROR": error_msg}
+
+        window, _, invalid_window = self._parse_window_and_page(
+            time_from, time_to, None, None, None, None
+        )
+        if invalid_window:
+            return invalid_window
+
+        # (response key, name) of every group and the stations / locations it's made of
+        groups = [("stations", station_id) for station_id in station_ids]
+        group_station_ids = list(range(len(groups)))
+        station_ids_by_group = list(station_ids)
+        group_location_ids, location_ids_by_group = [], []
+        for response_key, names, for_city in [
+            ("cities", city_names or [], True),
+            ("states", state_names or [], False),
+        ]:
+            for name in names:
+                for location_id in self._locations.location_ids(name, for_city):
+                    group_location_ids.append(len(groups))
+                    location_ids_by_group.append(location_id)
+                groups.append((response_key, name))
+
+        # answer from the hourly rollup when possible, like the single statistics
+        rollup_fresh = self._rollups is not None and self._rollups.is_fresh(
+            self._current_snapshot().source_fingerprint
         )
+        if rollup_fresh and window.is_hour_aligned():
+            window_predicate, window_params = window.predicate("hour")
+            metrics_sql = self._rollups.metrics_sql
+            conn, source = self._rollups.cursor(), "rollup"
+        else:
+            if self._rollups is not None and not rollup_fresh:
+                self._rollups.refresh_in_background(self._conn, self._current_snapshot().source_fingerprint)
+            window_predicate, window_params = self._transactions_window_predicate(window)
+            metrics_sql = self._transaction_metrics_sql
+            conn, source = self._conn, "transactions"
+
+        # transactions of a group: of its stations (station groups) or at its locations (city / state groups)
+        # a transaction is counted in every group it belongs to (e.g. a city and its state)
+        transactions_filter = (
+            "stationId IN (SELECT unnest(?::BIGINT[])) OR locationId IN (SELECT unnest(?::BIGINT[]))"
+        )
+        filter_params = [station_ids_by_group, location_ids_by_group]
+        sql = metrics_sql(statistics_types, f"({transactions_filter}) AND {window_predicate}")
+        params = filter_params + window_params
+
+        # hourly metrics of the live transactions of the groups, added to the ones of the source
+        metrics_table = "transaction_metrics"
+        if live_rows := self._live_statistics(statistics_types, transactions_filter, filter_params, window):
+            columns = ", ".join(statistics_types)
+            sql += (
+                ", all_metrics AS ("
+                f"    SELECT startedAt, stationId, locationId, {columns} FROM transaction_metrics "
+                "    UNION ALL "
+                "    SELECT unnest(?::TIMESTAMP[]), unnest(?::BIGINT[]), unnest(?::BIGINT[]), "
+                + ", ".join("unnest(?::DOUBLE[])" for _ in statistics_types)
+                + ") "
+            )
+            params = params + [list(column) for column in zip(*live_rows)]
+            metrics_table = "all_metrics"
+
+        sql += (
+            ", station_groups AS ("
+            "    SELECT unnest(?::BIGINT[]) AS groupId, unnest(?::BIGINT[]) AS stationId"
+            "), "
+            "location_groups AS ("
+            "    SELECT unnest(?::BIGINT[]) AS groupId, unnest(?::BIGINT[]) AS locationId"
+            "), "
+            "grouped_metrics AS ("
+            f"    SELECT g.groupId, tm.* FROM {metrics_table} tm JOIN station_groups g ON tm.stationId = g.stationId "
+            "    UNION ALL "
+            f"    SELECT g.groupId, tm.* FROM {metrics_table} tm JOIN location_groups g ON tm.locationId = g.locationId"
+            ") "
+        )
+        params = params + [
+            group_station_ids,
+            station_ids_by_group,
+            group_location_ids,
+            location_ids_by_group,
+        ]
+
+        # exact sums, like the single statistics
+        sums = ", ".join(f"sum({t}::{EXACT_SUM_TYPE})::DOUBLE AS {t}" for t in statistics_types)
+        if interval_type == "allTime":
+            df = self._queries.df(
+                conn,
+                f"{source}.statistics_batch_allTime",
+                sql + f"SELECT groupId, {sums} FROM grouped_metrics GROUP BY groupId",
+                params,
+            )
+            results = {
+                row["groupId"]: {f"allTime_{t}": row[t] for t in statistics_types}
+                for row in df.to_dict(orient="records")
+            }
+        else:
+            date_part, column = {"hourly": ("hour", "hour"), "daily": ("day", "date")}[
+                interval_type
+            ]
+            # same zero-filled buckets as the single statistics, by group
+            df = self._queries.df(
+                conn,
+                f"{source}.statistics_batch_{interval_type}",
+                sql + f", buckets AS ("
+                f"    SELECT groupId, date_trunc('{date_part}', startedAt) AS bucket, {sums} "
+                f"    FROM grouped_metrics GROUP BY groupId, bucket"
+                f"), "
+                f"all_buckets AS ("
+                f"    SELECT groupId, unnest(generate_series(min(bucket), max(bucket), INTERVAL 1 {date_part})) AS bucket "
+                f"    FROM buckets GROUP BY groupId"
+                f") "
+                f"SELECT ab.groupId, ab.bucket AS {column}, "
+                + ", ".join(f"coalesce(b.{t}, 0) AS {t}" for t in statistics_types)
+                + " FROM all_buckets ab LEFT JOIN buckets b ON ab.groupId = b.groupId AND ab.bucket = b.bucket "
+                f"ORDER BY ab.groupId, ab.bucket",
+                params,
+            )
+            if interval_type == "daily":
+                df["date"] = df["date"].dt.date
+            with timed_stage("serialize", "statistics_batch"):
+                results = {
+                    group_id: json.loads(
+                        group_df.drop(columns=["groupId"]).to_json(date_format="iso", orient="records")
+                    )
+                    for group_id, group_df in df.groupby("groupId", sort=False)
+                }
 
-    def get_blocking_time_by_station(self, station_id: int) -> Tuple[int, object]:
-        def compute_blocking_time(row):
-            row["blockingTime"] = (
-                row["completedAt"] - row["chargingCompletedAt"]
-            ).isoformat()
-            return row
+        response = {"stations": {}, "cities": {}, "states": {}}
+        for group_id, (response_key, name) in enumerate(groups):
+            response[response_key][name] = results.get(
+                group_id, {"NoContent": "No transactions found"}
+            )
+        return 200, response
 
-        df = self._fetch_transactions(station_id=station_id)
+    @instrumented
+    @pinned_snapshot
+    @cached_response(
+        "blocking_time",
+        lambda station_id, time_from=None, time_to=None, limit=None, cursor=None, duration_format="iso", summary=False: (
+            station_id,
+            time_from,
+            time_to,
+            limit,
+            cursor,
+            duration_format,
+            summary,
+        ),
+    )
+    def get_blocking_time_by_station(
+        self,
+        station_id: int,
+        stream_format: Optional[str] = None,
+        time_from: Optional[str] = None,
+        time_to: Optional[str] = None,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        duration_format: str = "iso",
+        summary: bool = False,
+    ) -> Tuple[int, object]:
+        if invalid_stream_format := self._check_stream_format(stream_format):
+            return invalid_stream_format
+
+        if duration_format not in DURATION_FORMATS:
+            error_msg = f"Invalid duration_format : {duration_format}. Must be one of {DURATION_FORMATS}"
+            self._logger.error(error_msg)
+            return 400, {"ERROR": error_msg}
+
+        window, page, invalid_window_or_page = self._parse_window_and_page(
+            time_from, time_to, limit, cursor, stream_format, self._parse_blocking_time_cursor
+        )
+        if invalid_window_or_page:
+            return invalid_window_or_page
+
+        station_id, invalid_station_id = self._parse_id(station_id, "station_id")
+        if invalid_station_id:
+            return invalid_station_id
+
+        if summary:
+            if stream_format or page is not None:
+                error_msg = "Blocking time summaries can't be streamed or paginated"
+                self._logger.error(error_msg)
+                return 400, {"ERROR": error_msg}
+            return self._blocking_time_summary_by_station(station_id, window, duration_format)
+
+        if stream_format:
+            return self._stream_blocking_time_by_station(
+                station_id, stream_format, window, duration_format
+            )
+
+        if page is not None:
+            return self._blocking_time_page_by_station(
+                station_id, window, page, duration_format
+            )
+
+        # transactions in id order (the order they are stored in the db), whatever the storage (db, sorted copy, parquet)
+        sql, params = self._blocking_time_sql(station_id, window, order_by="tr.id")
+        df = self._queries.df(self._conn, "blocking_time", sql, params)
 
         if df.empty:
             msg = f"No transactions found for stationId '{station_id}'"
             self._logger.warning(msg)
             return 200, {"NoContent": msg}
 
-        df = df.apply(compute_blocking_time, axis=1)
-        df = df[["transactionId", "chargePointId", "blockingTime"]]
-        result = defaultdict(list)
-        for _, row in df.iterrows():
-            result[row["chargePointId"]].append(
-                {
-                    "transactionId": row["transactionId"],
-                    "blockingTime": row["blockingTime"],
-                }
-            )
+        blocking_times = self._group_blocking_times(df, duration_format)
+        with timed_stage("serialize", "blocking_time"):
+            return 200, json.dumps({"BlockingTimeByChargePointIds": blocking_times}, indent=4)
 
-        return 200, json.dumps({"BlockingTimeByChargePointIds": result}, indent=4)
+    # blocking time (completedAt - chargingCompletedAt, in microseconds) of the transactions of a station in the window,
+    # ordered by (chargePointId, transactionId) by default, or by order_by (unordered if None)
+    # only the transactions after the (chargePointId, transactionId) cursor are selected if given
+    def _blocking_time_sql(
+        self,
+        station_id: int,
+        window: TimeWindow,
+        cursor: Optional[Tuple[int, int]] = None,
+        order_by: Optional[str] = "tr.chargePointId, tr.id",
+    ) -> Tuple[str, list]:
+        window_predicate, window_params = self._transactions_window_predicate(window)
+        cursor_predicate, cursor_params = "true", []
+        if cursor is not None:
+            cursor_predicate, cursor_params = "(tr.chargePointId, tr.id) > (?, ?)", list(cursor)
+        return (
+            "SELECT tr.chargePointId, tr.id AS transactionId, "
+            "epoch_us(tr.completedAt) - epoch_us(tr.chargingCompletedAt) AS blockingTime "
+            f"FROM {self._station_transactions_sql} "
+            f"WHERE tr.stationId = ? AND {window_predicate} AND {cursor_predicate}"
+            + (f" ORDER BY {order_by}" if order_by else "")
+        ), [station_id] + window_params + cursor_params
 
-    def get_charge_point_status_event_reliability_pct(self, chargepoint_id: int):
+    # formats durations in microseconds column-wise, as ISO 8601 durations (same as pd.Timedelta.isoformat) or seconds
+    # missing durations are "NaT" (iso) / None (seconds)
+    @staticmethod
+    def _format_durations(durations_us: pd.Series, duration_format: str) -> list:
+        durations_us = durations_us.astype("float64")
+        if duration_format == "seconds":
+            seconds = durations_us / 1_000_000
+            return seconds.astype(object).where(seconds.notna(), None).to_list()
 
-        def compute_expected_and_actual_events_count(row):
-            # assumption: a chargepoint with 100% reliability sends at least 1 event every 15 mins
-            # -> calculate the number of 15-minute intervals
-            # at least 2 events are expected for a transaction (charging_started, charging_stopped)
-            transaction_duration_mins = (
-                row["completedAt"] - row["startedAt"]
-            ).total_seconds() / 60
-            row["expectedEventsCount"] = max(int(transaction_duration_mins // 15), 2)
-            row["actualEventsCount"] = (
-                self._conn.execute(
-                    f"SELECT * FROM transaction_meter_values "
-                    f"WHERE transactionId = '{row['id']}'"
-                )
-                .df()
-                .shape[0]
-            )
-            return row
+        components = pd.to_timedelta(durations_us, unit="us").dt.components.fillna(0).astype("int64")
+        fraction = (
+            components["milliseconds"].astype(str).str.zfill(3)
+            + components["microseconds"].astype(str).str.zfill(3)
+            + components["nanoseconds"].astype(str).str.zfill(3)
+        )
+        seconds = (components["seconds"].astype(str) + "." + fraction).str.rstrip("0").str.rstrip(".")
+        iso = (
+            "P" + components["days"].astype(str)
+            + "DT" + components["hours"].astype(str)
+            + "H" + components["minutes"].astype(str)
+            + "M" + seconds + "S"
+        )
+        return iso.where(durations_us.notna(), "NaT").to_list()
 
-        df = self._conn.execute(
-            f"SELECT * FROM transactions " f"WHERE chargePointId = '{chargepoint_id}'"
-        ).df()
+    # {chargePointId: [{transactionId, blockingTime}]} in the order of the rows
+    def _group_blocking_times(self, df: pd.DataFrame, duration_format: str) -> dict:
+        df = df.assign(blockingTime=self._format_durations(df["blockingTime"], duration_format))
+        return {
+            int(chargepoint_id): group_df[["transactionId", "blockingTime"]].to_dict(orient="records")
+            for chargepoint_id, group_df in df.groupby("chargePointId", sort=False)
+        }
+
+    # cursor of the blocking time pages: "<chargePointId>:<transactionId>" of the last transaction of the previous page
+    @staticmethod
+    def _parse_blocking_time_cursor(cursor: str) -> Tuple[int, int]:
+        chargepoint_id, transaction_id = cursor.split(":")
+        return int(chargepoint_id), int(transaction_id)
+
+    def _blocking_time_page_by_station(
+        self,
+        station_id: int,
+        window: TimeWindow,
+        page: Tuple[int, Optional[Tuple[int, int]]],
+        duration_format: str,
+    ):
+        limit, cursor = page
+        sql, params = self._blocking_time_sql(station_id, window, cursor)
+        df = self._queries.df(
+            self._conn, "blocking_time_page", sql + " LIMIT ?", params + [limit + 1]
+        )
 
         if df.empty:
-            msg = f"No transactions found for chargePointId '{chargepoint_id}'"
+            msg = f"No transactions found for stationId '{station_id}'"
+            self._logger.warning(msg)
+            return 200, {"NoContent": msg}
+
+        next_cursor = None
+        if df.shape[0] > limit:
+            df = df.iloc[:limit]
+            next_cursor = f"{df['chargePointId'].iloc[-1]}:{df['transactionId'].iloc[-1]}"
+
+        return 200, {
+            "BlockingTimeByChargePointIds": self._group_blocking_times(df, duration_format),
+            "count": df.shape[0],
+            "nextCursor": next_cursor,
+        }
+
+    def _stream_blocking_time_by_station(
+        self, station_id: int, stream_format: str, window: TimeWindow, duration_format: str
+    ):
+        def format_blocking_time(chunk):
+            chunk["blockingTime"] = self._format_durations(chunk["blockingTime"], duration_format)
+            return chunk
+
+        sql, params = self._blocking_time_sql(station_id, window)
+        result = self._queries.execute(self._current_snapshot().db.cursor(), "blocking_time_stream", sql, params)
+        chunks = peek_chunks(iter_df_chunks(result))
+        if chunks is None:
+            msg = f"No transactions found for stationId '{station_id}'"
+            self._logger.warning(msg)
+            return 200, {"NoContent": msg}
+
+        return 200, stream_grouped_records(
+            map(format_blocking_time, chunks),
+            stream_format,
+            key_column="chargePointId",
+            prefix='{"BlockingTimeByChargePointIds":{',
+            suffix="}}",
+        )
+
+    # mean / median / 95th percentile / max blocking time by chargepoint, aggregated in duckdb
+    def _blocking_time_summary_by_station(
+        self, station_id: int, window: TimeWindow, duration_format: str
+    ):
+        sql, params = self._blocking_time_sql(station_id, window, order_by=None)
+        df = self._queries.df(
+            self._conn,
+            "blocking_time_summary",
+            f"SELECT chargePointId, count(*) AS transactionsCount, "
+            f"avg(blockingTime) AS mean, "
+            f"quantile_cont(blockingTime, 0.5) AS p50, "
+            f"quantile_cont(blockingTime, 0.95) AS p95, "
+            f"max(blockingTime) AS max "
+            f"FROM ({sql}) GROUP BY chargePointId ORDER BY chargePointId",
+            params,
+        )
+
+        if df.empty:
+            msg = f"No transactions found for stationId '{station_id}'"
             self._logger.warning(msg)
             return 200, {"NoContent": msg}
 
-        df = df.apply(compute_expected_and_actual_events_count, axis=1)
+        for column in ["mean", "p50", "p95", "max"]:
+            df[column] = self._format_durations(df[column], duration_format)
+
+        return 200, {
+            "BlockingTimeSummaryByChargePointIds": {
+                row.pop("chargePointId"): row for row in df.to_dict(orient="records")
+            },
+            "count": df.shape[0],
+        }
+
+    # expected and actual status events count by chargepoint, for the transactions matching the filter
+    # assumption: a chargepoint with 100% reliability sends at least 1 event every 15 mins
+    # -> calculate the number of 15-minute intervals
+    # at least 2 events are expected for a transaction (charging_started, charging_stopped)
+    def _charge_points_events_count(self, name: str, transactions_filter: str, params: list):
+        return self._queries.df(
+            self._conn,
+            name,
+            "WITH selected_transactions AS ("
+            "    SELECT id, chargePointId, startedAt, completedAt FROM transactions "
+            f"    WHERE {transactions_filter}"
+            "), "
+            "transaction_events_count AS ("
+            "    SELECT transactionId, count(*) AS actualEventsCount "
+            "    FROM transaction_meter_values "
+            "    WHERE transactionId IN (SELECT id FROM selected_transactions) "
+            "    GROUP BY transactionId"
+            ") "
+            "SELECT st.chargePointId, "
+            "sum(greatest(CAST(floor(epoch(st.completedAt - st.startedAt) / 60 / 15) AS BIGINT), 2)) "
+            "    AS expectedEventsCount, "
+            "coalesce(sum(tec.actualEventsCount), 0) AS actualEventsCount "
+            "FROM selected_transactions st "
+            "LEFT JOIN transaction_events_count tec ON st.id = tec.transactionId "
+            "GROUP BY st.chargePointId "
+            "ORDER BY st.chargePointId",
+            params,
+        )
+
+    # adds the events count of the live transactions of the chargepoints (all chargepoints if no ids are given)
+    def _with_live_events_count(
+        self, events_count_df: pd.DataFrame, chargepoint_ids: Optional[list]
+    ) -> pd.DataFrame:
+        if self._live is None:
+            return events_count_df
+        sql, params = self._live.chargepoint_events_sql(chargepoint_ids)
+        live_df = self._queries.df(self._live.cursor(), "live.chargepoint_events_count", sql, params)
+        if live_df.empty:
+            return events_count_df
+        return (
+            pd.concat([events_count_df, live_df])
+            .groupby("chargePointId", as_index=False)
+            .sum()
+            .sort_values("chargePointId", ignore_index=True)
+        )
+
+    @staticmethod
+    def _reliability_pct(events_count_df: pd.DataFrame) -> pd.Series:
+        return (
+            events_count_df["actualEventsCount"]
+            / events_count_df["expectedEventsCount"]
+            * 100
+        )
+
+    # Reliability (%) = (Number of successfully recorded events / Total number of expected events) × 100
+    # maxed out at 100%
+    @staticmethod
+    def _format_reliability_pct(reliability_pct) -> str:
+        return f"{round(min(reliability_pct, 100), 2)}%"
+
+    @instrumented
+    @pinned_snapshot
+    @cached_response("chargepoint_reliability", lambda chargepoint_id: (chargepoint_id,))
+    def get_charge_point_status_event_reliability_pct(self, chargepoint_id: int):
+        parsed_chargepoint_id, invalid_chargepoint_id = self._parse_id(
+            chargepoint_id, "chargepoint_id"
+        )
+        if invalid_chargepoint_id:
+            return invalid_chargepoint_id
 
-        # Reliability (%) = (Number of successfully recorded events / Total number of expected events) × 100
-        # maxed out at 100%
-        reliability_pct = min(
-            (df["actualEventsCount"].sum() / df["expectedEventsCount"].sum()) * 100, 100
+        df = self._with_live_events_count(
+            self._charge_points_events_count(
+                "chargepoint_events_count", "chargePointId = ?", [parsed_chargepoint_id]
+            ),
+            [parsed_chargepoint_id],
         )
 
+        if df.empty:
+            msg = f"No transactions found for chargePointId '{chargepoint_id}'"
+            self._logger.warning(msg)
+            return 200, {"NoContent": msg}
+
+        reliability_pct = self._reliability_pct(df).to_numpy()[0]
+
         return 200, {
             "chargePointId": chargepoint_id,
-            "reliability_pct": f"{round(reliability_pct, 2)}%",
+            "reliability_pct": self._format_reliability_pct(reliability_pct),
         }
 
-    def get_stations_within_radius(
-        self, input_latitude: float, input_longitude: float, radius_km: int
+    # reliability of several chargepoints (all chargepoints if no ids are given) in a single pass
+    @instrumented
+    @pinned_snapshot
+    @cached_response(
+        "chargepoints_reliability",
+        # (ids of any type: the key is computed before they are validated)
+        lambda chargepoint_ids=None: (
+            tuple(sorted(map(str, chargepoint_ids)))
+            if isinstance(chargepoint_ids, list)
+            else repr(chargepoint_ids),
+        ),
+    )
+    def get_charge_points_status_event_reliability_pct(
+        self, chargepoint_ids: Optional[list] = None
     ):
-        def is_in_radius(row):
-            return (
-                distance(
-                    (input_latitude, input_longitude),
-                    (row["latitude"], row["longitude"]),
-                ).km
-                <= radius_km
+        if chargepoint_ids is None:
+            df = self._charge_points_events_count("chargepoints_events_count", "true", [])
+        else:
+            try:
+                if not isinstance(chargepoint_ids, list):
+                    raise TypeError
+                chargepoint_ids = [int(chargepoint_id) for chargepoint_id in chargepoint_ids]
+            except (TypeError, ValueError):
+                error_msg = f"Invalid chargepoint_ids : {chargepoint_ids}. Must be a list of integers"
+                self._logger.error(error_msg)
+                return 400, {"ERROR": error_msg}
+
+            df = self._charge_points_events_count(
+                "chargepoints_events_count",
+                "chargePointId IN (SELECT unnest(?::BIGINT[]))",
+                [chargepoint_ids],
             )
+        df = self._with_live_events_count(df, chargepoint_ids)
+
+        if df.empty:
+            msg = "No transactions found for the selected chargepoints"
+            self._logger.warning(msg)
+            return 200, {"NoContent": msg}
+
+        reliability_pct = self._reliability_pct(df).to_numpy()
+        return 200, {
+            "chargePoints": [
+                {
+                    "chargePointId": chargepoint_id,
+                    "reliability_pct": self._format_reliability_pct(pct),
+                }
+                for chargepoint_id, pct in zip(
+                    df["chargePointId"].to_list(), reliability_pct
+                )
+            ],
+            "count": df.shape[0],
+        }
+
+    # appends a micro-batch of transactions / meter values to the live store (all or nothing)
+    @instrumented
+    def ingest(self, transactions: Optional[list] = None, meter_values: Optional[list] = None):
+        if self._live is None:
+            error_msg = "Live ingestion is disabled (LIVE_PATH is not set)"
+            self._logger.error(error_msg)
+            return 400, {"ERROR": error_msg}
+        if not (transactions or meter_values):
+            error_msg = "At least one of transactions, meterValues is required"
+            self._logger.error(error_msg)
+            return 400, {"ERROR": error_msg}
+
+        try:
+            counts = self._live.ingest(transactions or [], meter_values or [])
+        except ValueError as e:
+            error_msg = f"Invalid events : {e}"
+            self._logger.error(error_msg)
+            return 400, {"ERROR": error_msg}
+        return 200, counts
+
+    # kwh price of a station at one or more timestamps (resolved with the in-memory price index):
+    # the latest price reported at or before the timestamp and the price its turnover statistics use
+    @instrumented
+    @pinned_snapshot
+    def get_price_at(self, station_id: int, timestamps: list):
+        station_id, invalid_station_id = self._parse_id(station_id, "station_id")
+        if invalid_station_id:
+            return invalid_station_id
+
+        if not timestamps:
+            error_msg = "Missing ts : at least one timestamp is required"
+            self._logger.error(error_msg)
+            return 400, {"ERROR": error_msg}
+        try:
+            parsed_timestamps = [parse_timestamp(ts) for ts in timestamps]
+        except ValueError as e:
+            error_msg = f"Invalid ts : {timestamps}. {e}"
+            self._logger.error(error_msg)
+            return 400, {"ERROR": error_msg}
+
+        if not self._queries.fetchone(
+            self._conn, "station_exists", "SELECT count(*) FROM stations WHERE id = ?", [station_id]
+        )[0]:
+            return 200, {"NoContent": f"No station found with id {station_id}"}
 
-        df = (
-            self._conn.execute(f"SELECT * FROM locations")
-            .df()
-            .rename(columns={"id": "locationId"})
+        prices = self._current_snapshot().price_index().resolve(
+            station_id, np.array(parsed_timestamps, dtype="datetime64[us]").view(np.int64)
         )
+        prices_at = prices["priceAtUs"].astype("datetime64[us]").astype(datetime)
+        return 200, {
+            "stationId": station_id,
+            "prices": [
+                {
+                    "ts": ts.isoformat(),
+                    "priceAt": price_at.isoformat() if has_price else None,
+                    "kwhPrice": float(kwh_price) if has_price and not np.isnan(kwh_price) else None,
+                    "turnoverKwhPrice": None if np.isnan(turnover_price) else float(turnover_price),
+                    "turnoverPriceSource": source,
+                }
+                for ts, has_price, price_at, kwh_price, turnover_price, source in zip(
+                    parsed_timestamps,
+                    prices["hasPrice"],
+                    prices_at,
+                    prices["kwhPrice"],
+                    prices["turnoverKwhPrice"],
+                    prices["turnoverPriceSource"],
+                )
+            ],
+            "count": len(parsed_timestamps),
+        }
+
+    @instrumented
+    @pinned_snapshot
+    def get_stations_within_radius(
+        self, input_latitude: float, input_longitude: float, radius_km: int
+    ):
+        # geopy is only imported by the requests needing it
+        from geopy.point import Point
 
-        # filter locations within radius
         try:
-            df = df[df.apply(is_in_radius, axis=1)]
+            point = Point(input_latitude, input_longitude)
         except ValueError as e:
             return 400, {
                 "ERROR": f"Invalid latitude / longitude: {input_latitude}, {input_longitude}: {e}"
             }
 
-        if df.empty:
+        # filter locations within radius
+        location_ids = self._current_snapshot().locations_index.locations_within_radius(
+            point.latitude, point.longitude, radius_km
+        )
+
+        if location_ids.size == 0:
             return 200, {
                 "NoContent": f"No locations found within {radius_km} km radius"
             }
 
-        location_ids = df["locationId"].astype(str).to_list()
-        del df
-
-        result = self._conn.execute(
-            f"SELECT id FROM stations WHERE locationId IN ({', '.join(location_ids)})"
-        ).df()
+        station_ids = self._current_snapshot().locations_index.stations_at_locations(location_ids)
+        return 200, {"stationIds": station_ids.tolist(), "count": len(station_ids)}
 
-        return 200, {"stationIds": result["id"].to_list(), "count": result.shape[0]}
+    @instrumented
+    @pinned_snapshot
+    def list_all(self, attr, stream_format: Optional[str] = None):
+        if invalid_stream_format := self._check_stream_format(stream_format):
+            return invalid_stream_format
 
-    def list_all(self, attr):
         if attr in ["stations", "chargepoints"]:
-            ids = self._conn.execute(f"SELECT id from {attr}").df()["id"].to_list()
+            # attr is one of the table names above, never a request value
+            if stream_format:
+                count = self._queries.fetchone(
+                    self._conn, f"count_{attr}", f"SELECT count(*) FROM {attr}"
+                )[0]
+                result = self._queries.execute(
+                    self._current_snapshot().db.cursor(), f"list_{attr}", f"SELECT id FROM {attr}"
+                )
+                return 200, stream_values(
+                    iter_df_chunks(result),
+                    stream_format,
+                    column="id",
+                    prefix=f'{{"{attr}":[',
+                    suffix=f'],"count":{count}}}',
+                )
+
+            ids = self._queries.df(self._conn, f"list_{attr}", f"SELECT id FROM {attr}")[
+                "id"
+            ].to_list()
             return 200, {attr: ids, "count": len(ids)}
         else:
-            locations = list(
-                set([loc for loc in load_locations_df()[attr].to_list() if loc is not None])
-            )
+            locations = self._locations.names(attr)
             return 200, {attr: locations, "count": len(locations)}
 
-    @staticmethod
-    def _aggregate_statistics(df, statistics_type, interval_type):
-        def aggregate_sum(input_df, rule):
-            return (
-                input_df.set_index("startedAt")
-                .resample(rule)[statistics_type]
-                .sum()
-                .to_frame()
-                .reset_index()
-            )
+    # ids of the url are strings, they are bound to the queries as integers
+    # returns (id, error response)
+    def _parse_id(self, value, name: str):
+        try:
+            return int(value), None
+        except (TypeError, ValueError):
+            error_msg = f"Invalid {name} : {value}. Must be an integer"
+            self._logger.error(error_msg)
+            return None, (400, {"ERROR": error_msg})
 
-        match interval_type:
-            case "hourly":
-                return (
-                    aggregate_sum(df, "h")
-                    .rename(columns={"startedAt": "hour"})
-                    .to_json(indent=4, date_format="iso", orient="records")
-                )
+    # time window (from / to) and page (limit, cursor) of a request, None page if no limit / cursor is given
+    # returns (window, page, error response)
+    def _parse_window_and_page(
+        self, time_from, time_to, limit, cursor, stream_format, parse_cursor
+    ):
+        try:
+            window = TimeWindow.parse(time_from, time_to)
+        except ValueError as e:
+            error_msg = f"Invalid time window from : {time_from}, to : {time_to}. {e}"
+            self._logger.error(error_msg)
+            return None, None, (400, {"ERROR": error_msg})
 
-            case "daily":
-                df = aggregate_sum(df, "D").rename(columns={"startedAt": "date"})
-                df["date"] = df["date"].dt.date
-                return df.to_json(indent=4, date_format="iso", orient="records")
+        if limit is None and cursor is None:
+            return window, None, None
+
+        if stream_format:
+            error_msg = "Streamed responses can't be paginated (limit / cursor)"
+            self._logger.error(error_msg)
+            return None, None, (400, {"ERROR": error_msg})
+
+        try:
+            page_limit = DEFAULT_PAGE_LIMIT if limit is None else int(limit)
+            if page_limit <= 0:
+                raise ValueError
+        except ValueError:
+            error_msg = f"Invalid limit : {limit}. Must be a positive integer"
+            self._logger.error(error_msg)
+            return None, None, (400, {"ERROR": error_msg})
+
+        try:
+            page_cursor = None if cursor is None else parse_cursor(cursor)
+        except ValueError:
+            error_msg = f"Invalid cursor : {cursor}"
+            self._logger.error(error_msg)
+            return None, None, (400, {"ERROR": error_msg})
+
+        return window, (page_limit, page_cursor), None
+
+    def _check_stream_format(self, stream_format: Optional[str]):
+        if stream_format is not None and stream_format not in STREAM_FORMATS:
+            error_msg = f"Invalid stream format : {stream_format}. Must be one of {STREAM_FORMATS}"
+            self._logger.error(error_msg)
+            return 400, {"ERROR": error_msg}
+        return None
+
+    # executions and execution time of every sql statement since the start
+    @instrumented
+    @pinned_snapshot
+    def query_stats(self):
+        return 200, self._queries.stats()
 
-            case "allTime":
-                return {f"allTime_{statistics_type}": df[statistics_type].sum()}
+    @instrumented
+    @pinned_snapshot
+    def response_cache_stats(self):
+        response_cache = self._response_cache
+        if response_cache is None:
+            return 200, {"NoContent": "Response cache is disabled"}
+        return 200, response_cache.stats()
@@ -0,0 +1,349 @@
+import logging
+import threading
+import time
+
+import duckdb
+
+from typing import Optional
+
+from .averages import EXACT_SUM_TYPE
+
+logger = logging.getLogger(__name__)
+
+# delay before a failed refresh of a source version is attempted again, doubled after every failure up to the maximum
+REFRESH_BACKOFF_S = 30
+REFRESH_MAX_BACKOFF_S = 3600
+
+
+# Precomputed per-station, per-hour statistics kept in a sidecar duckdb file
+# (the source db is opened read-only).
+#
+# The statistics depend on values that change as new data arrives (average kwhConsumed of all transactions,
+# average kwh_price of a station / of all stations), so a bucket doesn't store the final kwhConsumed/turnoverEur
+# but the parts they are computed from. The averages are applied when the rollup is queried:
+# - kwhConsumed = kwhConsumed + negativeKwhCount * averageKwhConsumed
+# - turnoverEur = pricedTurnoverEur + pricedNegativeKwhPrice * averageKwhConsumed / 100
+#                 + (fallbackKwhConsumed + fallbackNegativeKwhCount * averageKwhConsumed) * fallbackPrice / 100
+#
+# Chargepoints without station / location have buckets with a NULL stationId / locationId, so the buckets have no
+# primary key: new buckets are merged into the existing ones matching their (stationId, locationId, hour) with
+# IS NOT DISTINCT FROM (see _merge_buckets).
+class HourlyRollupStore:
+    def __init__(self, rollup_path: str):
+        self._conn = duckdb.connect(database=rollup_path)
+        self._refresh_lock = threading.Lock()
+        # (source fingerprint, consecutive failures, time.monotonic() of the next attempt) after a failed refresh
+        self._failed_refresh = None
+        self._create_tables()
+
+    def _create_tables(self):
+        # rollups keyed by (stationId, locationId, hour), which can't hold the buckets without station / location:
+        # rebuilt on their next refresh
+        primary_keys = self._conn.execute(
+            "SELECT count(*) FROM duckdb_constraints() "
+            "WHERE table_name = 'hourly_rollup' AND constraint_type = 'PRIMARY KEY'"
+        ).fetchone()[0]
+        if primary_keys:
+            self._conn.execute("DROP TABLE hourly_rollup")
+            self._conn.execute("DROP TABLE IF EXISTS rollup_state")
+
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS hourly_rollup ("
+            "    stationId BIGINT, "
+            "    locationId BIGINT, "
+            "    hour TIMESTAMP NOT NULL, "
+            "    transactionsCount BIGINT, "
+            "    kwhConsumed DOUBLE, "
+            "    negativeKwhCount BIGINT, "
+            "    pricedTurnoverEur DOUBLE, "
+            "    pricedNegativeKwhPrice DOUBLE, "
+            "    fallbackKwhConsumed DOUBLE, "
+            "    fallbackNegativeKwhCount BIGINT"
+            ")"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS station_average_price ("
+            "    stationId BIGINT PRIMARY KEY, averagePrice DOUBLE"
+            ")"
+        )
+        # single row describing the state of the source db the rollup was built from
+        # (the fingerprint of the source file and the checksum of the source rows it aggregates, see _source_checksum)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rollup_state ("
+            "    lastTransactionId BIGINT, "
+            "    lastStartedAt TIMESTAMP, "
+            "    transactionsCount BIGINT, "
+            "    kwhConsumedCount BIGINT, "
+            "    kwhConsumedSum DOUBLE, "
+            "    kwhPriceCount BIGINT, "
+            "    lastPriceAt TIMESTAMP, "
+            "    globalAveragePrice DOUBLE, "
+            "    sourceFingerprint VARCHAR, "
+            "    sourceChecksum UBIGINT"
+            ")"
+        )
+        # rollups built before the fingerprint was stored: rebuilt on their next refresh
+        self._conn.execute("ALTER TABLE rollup_state ADD COLUMN IF NOT EXISTS sourceFingerprint VARCHAR")
+        self._conn.execute("ALTER TABLE rollup_state ADD COLUMN IF NOT EXISTS sourceChecksum UBIGINT")
+
+    # (number of kwh prices, last priceAt) of the source
+    @staticmethod
+    def _kwh_price_state(source_conn) -> tuple:
+        return source_conn.execute("SELECT count(*), max(priceAt) FROM kwh_price").fetchone()
+
+    # checksum of the source rows the buckets of the transactions up to last_transaction_id were computed from:
+    # these transactions, their chargepoints (station / location) and the kwh prices before the last transaction start
+    @staticmethod
+    def _source_checksum(source, last_transaction_id: Optional[int], last_started_at) -> int:
+        return source.execute(
+            "SELECT hash("
+            "(SELECT bit_xor(hash(id, chargePointId, startedAt, kwhConsumed)) FROM transactions WHERE id <= ?), "
+            "(SELECT bit_xor(hash(id, stationId, locationId)) FROM chargepoints "
+            "    WHERE id IN (SELECT chargePointId FROM transactions WHERE id <= ?)), "
+            "(SELECT bit_xor(hash(stationId, priceAt, kwhPrice)) FROM kwh_price WHERE priceAt < ?)"
+            ")",
+            [last_transaction_id, last_transaction_id, last_started_at],
+        ).fetchone()[0]
+
+    # the rollup is fresh if it was refreshed from the source file with this fingerprint (files_fingerprint):
+    # a source that changed is a new file version, opened as a new snapshot
+    def is_fresh(self, source_fingerprint) -> bool:
+        state = self._conn.cursor().execute("SELECT sourceFingerprint FROM rollup_state").fetchone()
+        return state is not None and state[0] == repr(source_fingerprint)
+
+    # a failed refresh is logged (the statistics use the raw transactions meanwhile), the refresh from the same source
+    # version is only attempted again after a backoff. Returns whether the rollup was refreshed
+    def refresh(self, source_conn, source_fingerprint) -> bool:
+        with self._refresh_lock:
+            try:
+                self._refresh(source_conn.cursor(), self._conn.cursor(), repr(source_fingerprint))
+            except Exception:
+                failures = 1
+                if self._failed_refresh is not None and self._failed_refresh[0] == source_fingerprint:
+                    failures = self._failed_refresh[1] + 1
+                backoff_s = min(REFRESH_BACKOFF_S * 2 ** (failures - 1), REFRESH_MAX_BACKOFF_S)
+                self._failed_refresh = (source_fingerprint, failures, time.monotonic() + backoff_s)
+                logger.exception(f"Hourly rollup refresh failed, next attempt in {backoff_s}s")
+                return False
+            self._failed_refresh = None
+            return True
+
+    # refresh in a background thread, does nothing if a refresh is already running
+    # or if the refresh of this source version failed less than the backoff ago
+    def refresh_in_background(self, source_conn, source_fingerprint):
+        if self._refresh_lock.locked():
+            return
+        failed_refresh = self._failed_refresh
+        if (
+            failed_refresh is not None
+            and failed_refresh[0] == source_fingerprint
+            and time.monotonic() < failed_refresh[2]
+        ):
+            return
+        threading.Thread(
+            target=self.refresh, args=(source_conn, source_fingerprint), daemon=True
+        ).start()
+
+    def _refresh(self, source, conn, source_fingerprint: str):
+        state = conn.execute(
+            "SELECT lastTransactionId, lastStartedAt, sourceFingerprint, sourceChecksum FROM rollup_state"
+        ).fetchone()
+        if state is not None and state[2] == source_fingerprint:
+            return
+
+        # only the transactions added since the last refresh are aggregated if the rows the buckets were computed
+        # from are unchanged, otherwise (rows corrected / removed in a replaced source) it's rebuilt from scratch
+        last_transaction_id = None
+        if state is not None and state[0] is not None:
+            if state[3] is not None and self._source_checksum(source, state[0], state[1]) == state[3]:
+                last_transaction_id = state[0]
+            else:
+                logger.info("Source rows of the hourly rollup changed, rebuilding hourly rollup")
+        kwh_price_state = self._kwh_price_state(source)
+
+        # transactions added since the last refresh, aggregated by station/location/hour
+        # kwh_price validity is the same as in the raw statistics: the latest price before the transaction start
+        # is only used if it was reported exactly at the previous quarter-hour of the transaction start
+        high_water_mark = -1 if last_transaction_id is None else last_transaction_id
+        new_buckets_df = source.execute(
+            "WITH new_transactions AS ("
+            "    SELECT tr.startedAt, tr.kwhConsumed, cp.stationId, cp.locationId "
+            "    FROM transactions tr "
+            "    JOIN chargepoints cp ON tr.chargePointId == cp.id "
+            "    WHERE tr.id > ?"
+            "), "
+            "priced_transactions AS ("
+            "    SELECT nt.*, "
+            "    CASE WHEN p.priceAt = time_bucket(INTERVAL '15 minutes', nt.startedAt) "
+            "        THEN p.kwhPrice END AS kwhPrice "
+            "    FROM new_transactions nt "
+            "    ASOF LEFT JOIN kwh_price p "
+            "    ON nt.stationId = p.stationId AND nt.startedAt > p.priceAt"
+            ") "
+            "SELECT stationId, locationId, date_trunc('hour', startedAt) AS hour, "
+            "count(*) AS transactionsCount, "
+            "coalesce(sum(kwhConsumed) FILTER (WHERE kwhConsumed >= 0), 0) AS kwhConsumed, "
+            "count(*) FILTER (WHERE kwhConsumed < 0) AS negativeKwhCount, "
+            "coalesce(sum((kwhPrice * kwhConsumed) / 100) "
+            "    FILTER (WHERE kwhConsumed >= 0 AND kwhPrice IS NOT NULL), 0) AS pricedTurnoverEur, "
+            "coalesce(sum(kwhPrice) "
+            "    FILTER (WHERE kwhConsumed < 0 AND kwhPrice IS NOT NULL), 0) AS pricedNegativeKwhPrice, "
+            "coalesce(sum(kwhConsumed) "
+            "    FILTER (WHERE kwhConsumed >= 0 AND kwhPrice IS NULL), 0) AS fallbackKwhConsumed, "
+            "count(*) FILTER (WHERE kwhConsumed < 0 AND kwhPrice IS NULL) AS fallbackNegativeKwhCount "
+            "FROM priced_transactions "
+            "GROUP BY ALL",
+            [high_water_mark],
+        ).df()
+
+        new_transactions_state = source.execute(
+            "SELECT max(id), max(startedAt), count(*), count(kwhConsumed), "
+            f"coalesce(sum(kwhConsumed::{EXACT_SUM_TYPE})::DOUBLE, 0) "
+            "FROM transactions WHERE id > ?",
+            [high_water_mark],
+        ).fetchone()
+
+        # kwh_price fallbacks are recomputed fully, the kwh_price table is small compared to transactions
+        station_average_price_df = source.execute(
+            f"SELECT stationId, avg(kwhPrice::{EXACT_SUM_TYPE}) AS averagePrice "
+            "FROM kwh_price WHERE stationId IS NOT NULL GROUP BY stationId"
+        ).df()
+        global_average_price = source.execute(
+            f"SELECT avg(kwhPrice::{EXACT_SUM_TYPE}) FROM kwh_price"
+        ).fetchone()[0]
+
+        conn.begin()
+        try:
+            if last_transaction_id is None:
+                conn.execute("DELETE FROM hourly_rollup")
+                previous_state = (None, None, 0, 0, 0.0)
+            else:
+                previous_state = conn.execute(
+                    "SELECT lastTransactionId, lastStartedAt, transactionsCount, kwhConsumedCount, kwhConsumedSum "
+                    "FROM rollup_state"
+                ).fetchone()
+
+            conn.register("new_buckets", new_buckets_df)
+            self._merge_buckets(conn, "new_buckets")
+            conn.unregister("new_buckets")
+
+            conn.register("new_station_average_price", station_average_price_df)
+            conn.execute("DELETE FROM station_average_price")
+            conn.execute(
+                "INSERT INTO station_average_price SELECT stationId, averagePrice FROM new_station_average_price"
+            )
+            conn.unregister("new_station_average_price")
+
+            new_last_id, new_last_started_at, new_count, new_kwh_count, new_kwh_sum = (
+                new_transactions_state
+            )
+            last_id = new_last_id if new_last_id is not None else previous_state[0]
+            last_started_at = max(
+                (ts for ts in (previous_state[1], new_last_started_at) if ts), default=None
+            )
+            conn.execute("DELETE FROM rollup_state")
+            conn.execute(
+                "INSERT INTO rollup_state VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    last_id,
+                    last_started_at,
+                    previous_state[2] + new_count,
+                    previous_state[3] + new_kwh_count,
+                    previous_state[4] + new_kwh_sum,
+                    kwh_price_state[0],
+                    kwh_price_state[1],
+                    global_average_price,
+                    source_fingerprint,
+                    self._source_checksum(source, last_id, last_started_at),
+                ],
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        logger.info(
+            f"Hourly rollup refreshed with {new_transactions_state[2]} new transactions"
+        )
+
+    # adds the buckets of the table to the rollup: summed into the existing bucket of their (stationId, locationId, hour),
+    # if any (NULL stationId / locationId included), inserted otherwise.
+    # rows are appended in hour order, so the row groups of the rollup cover distinct time ranges
+    # and a time window only reads the row groups overlapping it
+    @staticmethod
+    def _merge_buckets(conn, buckets_table: str):
+        same_bucket = (
+            "r.stationId IS NOT DISTINCT FROM b.stationId "
+            "AND r.locationId IS NOT DISTINCT FROM b.locationId "
+            "AND r.hour = b.hour"
+        )
+        conn.execute(
+            "UPDATE hourly_rollup r SET "
+            "transactionsCount = r.transactionsCount + b.transactionsCount, "
+            "kwhConsumed = r.kwhConsumed + b.kwhConsumed, "
+            "negativeKwhCount = r.negativeKwhCount + b.negativeKwhCount, "
+            "pricedTurnoverEur = r.pricedTurnoverEur + b.pricedTurnoverEur, "
+            "pricedNegativeKwhPrice = r.pricedNegativeKwhPrice + b.pricedNegativeKwhPrice, "
+            "fallbackKwhConsumed = r.fallbackKwhConsumed + b.fallbackKwhConsumed, "
+            "fallbackNegativeKwhCount = r.fallbackNegativeKwhCount + b.fallbackNegativeKwhCount "
+            f"FROM {buckets_table} b WHERE {same_bucket}"
+        )
+        conn.execute(
+            "INSERT INTO hourly_rollup "
+            "SELECT stationId, locationId, hour, transactionsCount, kwhConsumed, negativeKwhCount, "
+            "pricedTurnoverEur, pricedNegativeKwhPrice, fallbackKwhConsumed, fallbackNegativeKwhCount "
+            f"FROM {buckets_table} b "
+            f"WHERE NOT EXISTS (SELECT 1 FROM hourly_rollup r WHERE {same_bucket}) "
+            "ORDER BY hour"
+        )
+
+    # builds the CTEs computing the statistics by hour bucket from the rollup, same shape as the raw statistics
+    # transaction_metrics (startedAt, stationId, locationId and a column per statistics type).
+    # the filter is applied on the rollup columns (stationId, locationId, hour)
+    @staticmethod
+    def metrics_sql(statistics_types: list, rollup_filter: str) -> str:
+        sql = (
+            "WITH filtered_rollup AS ("
+            f"    SELECT * FROM hourly_rollup WHERE {rollup_filter}"
+            "), "
+            "rollup_averages AS ("
+            "    SELECT kwhConsumedSum / kwhConsumedCount AS averageKwhConsumed, globalAveragePrice "
+            "    FROM rollup_state"
+            "), "
+        )
+
+        kwh_consumed = "r.kwhConsumed + r.negativeKwhCount * ra.averageKwhConsumed AS kwhConsumed"
+        if "turnoverEur" not in statistics_types:
+            return sql + (
+                "transaction_metrics AS ("
+                f"    SELECT r.hour AS startedAt, r.stationId, r.locationId, {kwh_consumed} "
+                "    FROM filtered_rollup r CROSS JOIN rollup_averages ra"
+                ") "
+            )
+
+        return sql + (
+            "transaction_metrics AS ("
+            f"    SELECT r.hour AS startedAt, r.stationId, r.locationId, {kwh_consumed}, "
+            "    r.pricedTurnoverEur "
+            "    + (r.pricedNegativeKwhPrice * ra.averageKwhConsumed) / 100 "
+            "    + ((r.fallbackKwhConsumed + r.fallbackNegativeKwhCount * ra.averageKwhConsumed) "
+            "        * coalesce(sap.averagePrice, ra.globalAveragePrice)) / 100 AS turnoverEur "
+            "    FROM filtered_rollup r "
+            "    CROSS JOIN rollup_averages ra "
+            "    LEFT JOIN station_average_price sap ON r.stationId = sap.stationId"
+            ") "
+        )
+
+    # transaction_statistics (startedAt, statistic) of a single statistics type (or the given cte name)
+    def statistics_sql(
+        self, statistics_type: str, rollup_filter: str, cte_name: str = "transaction_statistics"
+    ) -> str:
+        return self.metrics_sql([statistics_type], rollup_filter) + (
+            f", {cte_name} AS ("
+            f"    SELECT startedAt, {statistics_type} AS statistic FROM transaction_metrics"
+            ") "
+        )
+
+    # cursor on the rollup db to run statistics queries on (one per query, so it's thread-safe)
+    def cursor(self):
+        return self._conn.cursor()
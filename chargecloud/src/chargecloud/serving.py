@@ -0,0 +1,168 @@
+import cProfile
+import functools
+import io
+import json
+import logging
+import pstats
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Callable
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from bottle import HTTPResponse, ServerAdapter, json_dumps, request
+
+from .metrics import observe_stage, profiling, timed_stage
+
+logger = logging.getLogger(__name__)
+
+
+# wsgiref server handing every accepted connection to a bounded pool of worker threads
+class ThreadPoolWSGIServer(WSGIServer):
+    workers = 8
+    request_queue_size = 128
+
+    def server_activate(self):
+        super().server_activate()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="chargecloud-worker"
+        )
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._process_request_in_worker, request, client_address)
+
+    def _process_request_in_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=True)
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+# bottle server adapter, usage: run(server=ThreadPoolServer, workers=8)
+class ThreadPoolServer(ServerAdapter):
+    def run(self, handler):
+        server_class = type(
+            "ChargeCloudWSGIServer",
+            (ThreadPoolWSGIServer,),
+            {"workers": int(self.options.get("workers", ThreadPoolWSGIServer.workers))},
+        )
+        handler_class = _QuietHandler if self.quiet else WSGIRequestHandler
+        server = make_server(
+            self.host, self.port, handler, server_class=server_class, handler_class=handler_class
+        )
+        logger.info(
+            f"Serving on {self.host}:{self.port} with {server_class.workers} worker threads"
+        )
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+
+# ?profile= values answering the request's profile with its response
+PROFILE_MODES = ["1", "true", "cprofile"]
+CPROFILE_LINES = 40
+
+
+# Bottle plugin recording the wall time of every route ("request" stage) and the json serialization of its dict
+# responses ("serialize" stage, done here with bottle's json_dumps instead of bottle's json plugin, same output).
+# With ?profile=1 the response is {"response": <response>, "profile": <stages of the request>},
+# ?profile=cprofile adds the cProfile statistics of the request (functions by cumulative time).
+# Streamed responses are sent as they are, their stages happen while they are sent.
+class MetricsPlugin:
+    name = "metrics"
+    api = 2
+
+    def apply(self, callback, route):
+        route_name = f"{route.method} {route.rule}"
+
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            profile_mode = request.query.get("profile")
+            profiled = profile_mode in PROFILE_MODES
+            try:
+                with (profiling() if profiled else nullcontext()) as profile:
+                    profiler = cProfile.Profile() if profile_mode == "cprofile" else None
+                    if profiler is not None:
+                        profiler.enable()
+                    try:
+                        rv = callback(*args, **kwargs)
+                    except HTTPResponse as e:
+                        rv = e
+                    finally:
+                        if profiler is not None:
+                            profiler.disable()
+
+                    if not isinstance(rv, HTTPResponse):
+                        return rv
+                    body = rv.body
+                    if isinstance(body, dict):
+                        with timed_stage("serialize", route_name):
+                            rv.body = json_dumps(body)
+                        rv.content_type = "application/json"
+
+                if profiled and isinstance(body, (dict, str)):
+                    rv.body = json_dumps(
+                        {
+                            "response": body if isinstance(body, dict) else _parse_json(body),
+                            "profile": {
+                                **profile.summary(time.perf_counter() - start),
+                                **({"cProfile": _cprofile_lines(profiler)} if profiler is not None else {}),
+                            },
+                        }
+                    )
+                    rv.content_type = "application/json"
+                return rv
+            finally:
+                observe_stage("request", route_name, time.perf_counter() - start)
+
+        return wrapper
+
+
+def _parse_json(body: str):
+    try:
+        return json.loads(body)
+    except ValueError:
+        return body
+
+
+def _cprofile_lines(profiler: cProfile.Profile) -> list:
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(CPROFILE_LINES)
+    return [line for line in stream.getvalue().splitlines() if line.strip()]
+
+
+# Bottle plugin answering 503 on every route but the always available ones (readiness / metrics)
+# until is_ready() returns true, so a starting server accepts connections before the repository is loaded
+class ReadinessPlugin:
+    name = "readiness"
+    api = 2
+
+    def __init__(self, is_ready: Callable[[], bool], always_available: tuple = ("/", "/metrics")):
+        self._is_ready = is_ready
+        self._always_available = always_available
+
+    def apply(self, callback, route):
+        if route.rule in self._always_available:
+            return callback
+
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            if not self._is_ready():
+                return HTTPResponse(status=503, body={"ERROR": "Server is starting, not ready for requests"})
+            return callback(*args, **kwargs)
+
+        return wrapper
@@ -0,0 +1,100 @@
+import logging
+import multiprocessing
+import os
+import threading
+
+import duckdb
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from .cache import files_fingerprint
+from .parquet import create_parquet_views, manifest_path
+
+logger = logging.getLogger(__name__)
+
+
+class StaleSourceError(Exception):
+    pass
+
+
+# read-only connection of a worker process on the version of the source it was opened on: (source, connection)
+_worker_source = None
+
+
+# the worker's connection on the source (db_path / parquet_path) with the given fingerprint, opened on the first shard
+# of a version with the parent's averages of this version loaded as tables (see StatisticsAverages).
+# Raises StaleSourceError if the file isn't the version of the parent's snapshot anymore (replaced since)
+def _source_connection(source: tuple, averages, threads: int) -> duckdb.DuckDBPyConnection:
+    global _worker_source
+    if _worker_source is not None and _worker_source[0] == source:
+        return _worker_source[1]
+
+    db_path, parquet_path, fingerprint = source
+    source_path = manifest_path(parquet_path) if parquet_path else db_path
+    if files_fingerprint(source_path)[0] != fingerprint:
+        raise StaleSourceError(f"{source_path} changed")
+
+    # imported here: the snapshot module imports the spatial / price indexes the workers don't need
+    from .snapshot import attach_db
+
+    conn = duckdb.connect(config={"threads": threads})
+    if parquet_path:
+        create_parquet_views(conn, parquet_path)
+    else:
+        attach_db(conn, db_path)
+    if files_fingerprint(source_path)[0] != fingerprint:
+        conn.close()
+        raise StaleSourceError(f"{source_path} changed")
+    averages.create_tables(conn)
+
+    if _worker_source is not None:
+        _worker_source[1].close()
+    _worker_source = (source, conn)
+    return conn
+
+
+# runs in a worker: the (hour, statistic) partial buckets of a shard
+def _partial_buckets(source: tuple, averages, threads: int, sql: str, params: list) -> list:
+    return _source_connection(source, averages, threads).execute(sql, params).fetchall()
+
+
+# Pool of worker processes computing the statistics of a region shard by shard: every worker sums the statistics of
+# the transactions of a shard (a range of stations of the region) by hour on its own read-only connection, and the
+# parent adds up the partial buckets. The cpu cores are split between the workers' duckdb threads.
+# The workers are started (spawn, the parent runs duckdb threads) on the first sharded query.
+class ShardedStatistics:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._worker_threads = max(1, (os.cpu_count() or 1) // workers)
+        self._executor_lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    # contiguous ranges (first, last) of the sorted station ids, one per worker with the same number of stations:
+    # the transactions and kwh prices of a range are stored close together in a sorted db (see layout.py)
+    def station_ranges(self, station_ids: list) -> list:
+        if not station_ids:
+            return []
+        shards_count = min(self.workers, len(station_ids))
+        bounds = [len(station_ids) * shard // shards_count for shard in range(shards_count + 1)]
+        return [
+            (station_ids[bounds[shard]], station_ids[bounds[shard + 1] - 1]) for shard in range(shards_count)
+        ]
+
+    # runs the (sql, params) query of every shard in the workers, with the averages of the parent's snapshot,
+    # returns all the partial buckets
+    def partial_buckets(self, source: tuple, averages, shard_queries: list) -> list:
+        executor = self._get_executor()
+        futures = [
+            executor.submit(_partial_buckets, source, averages, self._worker_threads, sql, params)
+            for sql, params in shard_queries
+        ]
+        return [bucket for future in futures for bucket in future.result()]
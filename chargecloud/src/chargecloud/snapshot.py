@@ -0,0 +1,115 @@
+import functools
+import logging
+import threading
+from typing import Callable, Hashable, Optional
+
+import duckdb
+
+from .averages import StatisticsAverages
+from .cache import ResponseCache, files_fingerprint
+from .parquet import create_parquet_views, manifest_path
+from .prices import StationPriceIndex
+from .spatial import DEFAULT_BOUNDARY_TOLERANCE, LocationSpatialIndex
+from .util import LOCATIONS_CACHE_PATH
+
+logger = logging.getLogger(__name__)
+
+
+# A read-only connection on one version of the source (the db file, or the parquet export if parquet_path is given)
+# and the structures derived from it: the spatial index of the locations, the price index and the response cache.
+# When the source file is replaced, the repository opens a new snapshot and swaps it in as a whole,
+# so a request never mixes two versions of the data.
+class SourceSnapshot:
+    def __init__(
+        self,
+        db_path: str,
+        parquet_path: Optional[str] = None,
+        radius_boundary_tolerance: float = DEFAULT_BOUNDARY_TOLERANCE,
+        response_cache_options: Optional[dict] = None,
+        data_version: Optional[Callable[[], Hashable]] = None,
+    ):
+        self.source_path = manifest_path(parquet_path) if parquet_path else db_path
+        # taken before opening: a file replaced while it is opened is detected as a change and opened again
+        self.source_fingerprint = files_fingerprint(self.source_path)[0]
+        self.db = duckdb.connect()
+        if parquet_path:
+            create_parquet_views(self.db, parquet_path)
+        else:
+            attach_db(self.db, db_path)
+
+        # in-memory spatial index of locations and their stations for radius queries
+        self.locations_index = LocationSpatialIndex.from_db(
+            self.db.cursor(), boundary_tolerance=radius_boundary_tolerance
+        )
+
+        # optional cache of statistics / blocking time / reliability responses (max_entries, ttl_s, max_bytes)
+        # of this snapshot, invalidated when the locations cache or the data_version (e.g. of the live data) changes
+        self.response_cache = None
+        if response_cache_options is not None:
+            self.response_cache = ResponseCache(
+                fingerprint=lambda: (
+                    files_fingerprint(LOCATIONS_CACHE_PATH),
+                    data_version() if data_version else None,
+                ),
+                **response_cache_options,
+            )
+
+        # exact averages the statistics fall back to, computed (and loaded as tables) on the first statistics query
+        self._averages_lock = threading.Lock()
+        self._averages = None
+
+        # in-memory kwh prices of every station for /station/:id/priceAt, built on the first lookup
+        self._price_index_lock = threading.Lock()
+        self._price_index = None
+
+    def statistics_averages(self) -> StatisticsAverages:
+        with self._averages_lock:
+            if self._averages is None:
+                averages = StatisticsAverages.from_db(self.db.cursor())
+                averages.create_tables(self.db.cursor())
+                self._averages = averages
+            return self._averages
+
+    def price_index(self) -> StationPriceIndex:
+        with self._price_index_lock:
+            if self._price_index is None:
+                self._price_index = StationPriceIndex.from_db(self.db.cursor(), self.statistics_averages())
+                logger.info(f"Built the price index: {len(self._price_index)} kwh prices")
+            return self._price_index
+
+    # builds the indexes the previous snapshot had built on demand, so the first requests on this one don't wait
+    def warm_up(self, previous: "SourceSnapshot"):
+        if previous._averages is not None:
+            self.statistics_averages()
+        if previous._price_index is not None:
+            self.price_index()
+
+
+# attaches the db read-only to the connection (an in-memory database) and creates a view per table in it, named like
+# the tables, so the queries run unchanged. duckdb.connect(db_path) would return the database already open for this
+# path in the process: a replaced file would still be read through the previous snapshot's database.
+def attach_db(conn, db_path: str):
+    conn.execute(f"ATTACH '{db_path}' AS source (READ_ONLY)")
+    tables = conn.execute(
+        "SELECT table_name FROM information_schema.tables WHERE table_catalog = 'source' AND table_schema = 'main'"
+    ).fetchall()
+    for (table,) in tables:
+        conn.execute(f'CREATE VIEW "{table}" AS SELECT * FROM source.main."{table}"')
+
+
+# runs a repository method on the snapshot that is current when it's called (self._snapshot):
+# the calls it makes on the repository's connection / indexes use that snapshot even if a new one is swapped in
+# meanwhile. Nested calls keep the snapshot of the outermost call.
+def pinned_snapshot(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        local = self._thread_local
+        if getattr(local, "snapshot", None) is not None:
+            return method(self, *args, **kwargs)
+        local.snapshot = self._snapshot
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            local.snapshot = None
+
+    return wrapper
@@ -0,0 +1,128 @@
+import numpy as np
+
+EARTH_MEAN_RADIUS_KM = 6371.0088
+
+# the shortest length of one degree of latitude on the WGS-84 ellipsoid (at the equator)
+MIN_KM_PER_LATITUDE_DEGREE = 110.574
+
+# haversine (sphere) and geodesic (WGS-84 ellipsoid) distances differ by less than 0.6%
+# candidates closer than this to the radius boundary are refined with the exact geodesic distance
+DEFAULT_BOUNDARY_TOLERANCE = 0.01
+
+
+# In-memory index of location coordinates and the stations at each location.
+# Locations are sorted by latitude, a radius query:
+# - selects the latitude band of the bounding box with a binary search
+# - filters the band on the longitude range of the bounding box
+# - computes the haversine distance of the remaining candidates (vectorized)
+# - refines candidates within the tolerance band around the radius with geopy's geodesic distance,
+#   so results match the geodesic distance at the boundary
+class LocationSpatialIndex:
+    def __init__(
+        self,
+        location_ids,
+        latitudes,
+        longitudes,
+        station_ids,
+        station_location_ids,
+        boundary_tolerance: float = DEFAULT_BOUNDARY_TOLERANCE,
+    ):
+        order = np.argsort(np.asarray(latitudes, dtype=float), kind="stable")
+        self._location_ids = np.asarray(location_ids)[order]
+        self._latitudes = np.asarray(latitudes, dtype=float)[order]
+        self._longitudes = np.asarray(longitudes, dtype=float)[order]
+        self._latitudes_rad = np.radians(self._latitudes)
+        self._longitudes_rad = np.radians(self._longitudes)
+        self._boundary_tolerance = boundary_tolerance
+
+        # stations are kept in their original order, each location maps to the positions of its stations
+        self._station_ids = np.asarray(station_ids)
+        self._station_positions_by_location = {}
+        for position, location_id in enumerate(station_location_ids):
+            self._station_positions_by_location.setdefault(location_id, []).append(
+                position
+            )
+
+    @classmethod
+    def from_db(cls, conn, boundary_tolerance: float = DEFAULT_BOUNDARY_TOLERANCE):
+        locations_df = conn.execute("SELECT id, latitude, longitude FROM locations").df()
+        stations_df = conn.execute("SELECT id, locationId FROM stations").df()
+        return cls(
+            location_ids=locations_df["id"].to_numpy(),
+            latitudes=locations_df["latitude"].to_numpy(),
+            longitudes=locations_df["longitude"].to_numpy(),
+            station_ids=stations_df["id"].to_numpy(),
+            station_location_ids=stations_df["locationId"].to_list(),
+            boundary_tolerance=boundary_tolerance,
+        )
+
+    def __len__(self):
+        return len(self._location_ids)
+
+    # returns the ids of the locations within radius_km of the input point (inclusive)
+    def locations_within_radius(
+        self, latitude: float, longitude: float, radius_km: float
+    ) -> np.ndarray:
+        max_radius_km = radius_km * (1 + self._boundary_tolerance)
+
+        # latitude band of the bounding box
+        delta_latitude = max_radius_km / MIN_KM_PER_LATITUDE_DEGREE
+        start = np.searchsorted(self._latitudes, latitude - delta_latitude, side="left")
+        end = np.searchsorted(self._latitudes, latitude + delta_latitude, side="right")
+        candidates = np.arange(start, end)
+
+        # longitude range of the bounding box, the whole range if the box reaches a pole
+        max_abs_latitude = abs(latitude) + delta_latitude
+        if max_abs_latitude < 90:
+            delta_longitude = delta_latitude / np.cos(np.radians(max_abs_latitude))
+            if delta_longitude < 180:
+                longitude_diff = np.abs(
+                    (self._longitudes[candidates] - longitude + 180) % 360 - 180
+                )
+                candidates = candidates[longitude_diff <= delta_longitude]
+
+        if candidates.size == 0:
+            return self._location_ids[candidates]
+
+        # haversine distance of the candidates
+        latitude_rad, longitude_rad = np.radians(latitude), np.radians(longitude)
+        candidate_latitudes_rad = self._latitudes_rad[candidates]
+        a = (
+            np.sin((candidate_latitudes_rad - latitude_rad) / 2) ** 2
+            + np.cos(latitude_rad)
+            * np.cos(candidate_latitudes_rad)
+            * np.sin((self._longitudes_rad[candidates] - longitude_rad) / 2) ** 2
+        )
+        distances_km = 2 * EARTH_MEAN_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+        within = distances_km <= radius_km * (1 - self._boundary_tolerance)
+
+        # refine candidates close to the boundary with the geodesic distance
+        if self._boundary_tolerance > 0:
+            # geopy is imported on the first refinement instead of at startup
+            from geopy.distance import distance
+
+            boundary = np.flatnonzero(
+                (distances_km > radius_km * (1 - self._boundary_tolerance))
+                & (distances_km <= max_radius_km)
+            )
+            for i in boundary:
+                position = candidates[i]
+                within[i] = (
+                    distance(
+                        (latitude, longitude),
+                        (self._latitudes[position], self._longitudes[position]),
+                    ).km
+                    <= radius_km
+                )
+
+        return self._location_ids[candidates[within]]
+
+    # returns the ids of the stations at the input locations, in the order of the stations table
+    def stations_at_locations(self, location_ids) -> np.ndarray:
+        positions = [
+            position
+            for location_id in location_ids
+            for position in self._station_positions_by_location.get(location_id, [])
+        ]
+        return self._station_ids[np.sort(np.asarray(positions, dtype=np.int64))]
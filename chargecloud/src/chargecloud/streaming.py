@@ -0,0 +1,135 @@
+import itertools
+import json
+
+import pandas as pd
+
+from typing import Iterator, Optional
+
+# json: a single json document sent in chunks, ndjson: one json record per line
+STREAM_FORMATS = ["json", "ndjson"]
+
+CONTENT_TYPES = {"json": "application/json", "ndjson": "application/x-ndjson"}
+
+# number of duckdb vectors (2048 rows each) fetched per chunk
+VECTORS_PER_CHUNK = 8
+
+
+# fetches the result of an executed query chunk by chunk as dataframes, the cursor is closed once consumed
+def iter_df_chunks(cursor, vectors_per_chunk: int = VECTORS_PER_CHUNK) -> Iterator[pd.DataFrame]:
+    try:
+        while True:
+            chunk = cursor.fetch_df_chunk(vectors_per_chunk)
+            if chunk.empty:
+                return
+            yield chunk
+    finally:
+        cursor.close()
+
+
+# returns None if there are no chunks, otherwise an iterator over all chunks
+# (the first chunk is fetched eagerly, so empty results can still be answered with a regular response)
+def peek_chunks(chunks: Iterator[pd.DataFrame]) -> Optional[Iterator[pd.DataFrame]]:
+    first = next(chunks, None)
+    if first is None:
+        return None
+    return itertools.chain([first], chunks)
+
+
+# streams the records of the chunks, as ndjson lines or as the items of a json list between prefix and suffix
+# chunks must only contain json serializable values
+def stream_records(
+    chunks: Iterator[pd.DataFrame],
+    stream_format: str,
+    prefix: str = "[",
+    suffix: str = "]",
+) -> Iterator[str]:
+    if stream_format == "ndjson":
+        for chunk in chunks:
+            yield "".join(
+                json.dumps(record) + "\n" for record in chunk.to_dict(orient="records")
+            )
+        return
+
+    yield prefix
+    separator = ""
+    for chunk in chunks:
+        records = chunk.to_dict(orient="records")
+        yield separator + ",".join(json.dumps(record) for record in records)
+        separator = ","
+    yield suffix
+
+
+# same as stream_records, serialized with pandas' to_json (same formatting as the non-streamed to_json responses)
+def stream_json_records(
+    chunks: Iterator[pd.DataFrame],
+    stream_format: str,
+    prefix: str = "[",
+    suffix: str = "]",
+    date_format: str = "iso",
+) -> Iterator[str]:
+    if stream_format == "ndjson":
+        for chunk in chunks:
+            yield chunk.to_json(orient="records", lines=True, date_format=date_format)
+        return
+
+    yield prefix
+    separator = ""
+    for chunk in chunks:
+        # the records of the chunk without the enclosing brackets
+        yield separator + chunk.to_json(orient="records", date_format=date_format)[1:-1]
+        separator = ","
+    yield suffix
+
+
+# streams the records as a json object of lists grouped by a key column, chunks must be sorted by the key
+# e.g. {"1": [record, record], "2": [record]} (ndjson: one record per line, key included)
+def stream_grouped_records(
+    chunks: Iterator[pd.DataFrame],
+    stream_format: str,
+    key_column: str,
+    prefix: str = "{",
+    suffix: str = "}",
+) -> Iterator[str]:
+    if stream_format == "ndjson":
+        yield from stream_records(chunks, stream_format)
+        return
+
+    yield prefix
+    current_key = None
+    for chunk in chunks:
+        parts = []
+        records = chunk.drop(columns=[key_column]).to_dict(orient="records")
+        for key, record in zip(chunk[key_column].to_list(), records):
+            if current_key is None:
+                parts.append(f"{json.dumps(str(key))}:[")
+            elif key != current_key:
+                parts.append(f"],{json.dumps(str(key))}:[")
+            else:
+                parts.append(",")
+            parts.append(json.dumps(record))
+            current_key = key
+        yield "".join(parts)
+    if current_key is not None:
+        yield "]"
+    yield suffix
+
+
+# streams the values of a column, as ndjson lines or as the items of a json list between prefix and suffix
+def stream_values(
+    chunks: Iterator[pd.DataFrame],
+    stream_format: str,
+    column: str,
+    prefix: str = "[",
+    suffix: str = "]",
+) -> Iterator[str]:
+    if stream_format == "ndjson":
+        for chunk in chunks:
+            yield "".join(json.dumps(value) + "\n" for value in chunk[column].to_list())
+        return
+
+    yield prefix
+    separator = ""
+    for chunk in chunks:
+        yield separator + ",".join(json.dumps(value) for value in chunk[column].to_list())
+        separator = ","
+    yield suffix
@@ -1,63 +1,180 @@
 import logging
+import threading
+import time
+
+from datetime import datetime, timezone
+from typing import Callable, Hashable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
 
-def validate_locations(df, issues):
+class ValidationIssue(NamedTuple):
+    name: str
+    message: str
+    # key of the ids in the responses
+    ids_key: str
+    # in the order they are reported
+    ids: list
+    # sorted, for pagination
+    sorted_ids: np.ndarray
+
+
+def _issue(name: str, message: str, ids_key: str, ids: list) -> ValidationIssue:
+    return ValidationIssue(name, message, ids_key, ids, np.sort(np.asarray(ids, dtype=np.int64)))
+
+
+# issues in the order they are reported
+ISSUE_NAMES = [
+    "validation_error_location_not_in_germany",
+    "validation_error_transaction_no_status_events",
+    "validation_error_transaction_no_stopped_events",
+    "validation_error_transaction_negative_kwh_consumed",
+]
+
+
+def validate_locations(df) -> List[ValidationIssue]:
     # Check if all locations are in Germany
     df = df[df["country"] != "Deutschland"]
-    if not df.empty:
-        issues["validation_errors"].append(
-            {
-                "validation_error_location_not_in_germany": f"Found {len(df['id'].to_list())} locations not in Germany",
-                "LocationIds": df["id"].to_list(),
-            }
+    if df.empty:
+        return []
+    ids = df["id"].to_list()
+    return [
+        _issue(
+            "validation_error_location_not_in_germany",
+            f"Found {len(ids)} locations not in Germany",
+            "LocationIds",
+            ids,
         )
+    ]
 
 
-def validate_transactions(conn, issues):
-    # transactions without any status events
-    df = conn.execute(
-        "SELECT id FROM transactions "
-        "WHERE id NOT IN "
-        "(SELECT transactionId "
-        "FROM transaction_meter_values)"
-    ).df()
-
-    if not df.empty:
-        issues["validation_errors"].append(
-            {
-                "validation_error_transaction_no_status_events": f"Found {len(df['id'].to_list())} transactions "
-                f"with no corresponding status events",
-                "transactionsIds": df["id"].to_list(),
-            }
-        )
+# (issue, column of the validation query, description of the transactions)
+TRANSACTION_CHECKS = [
+    (
+        "validation_error_transaction_no_status_events",
+        "noStatusEvents",
+        "with no corresponding status events",
+    ),
+    (
+        "validation_error_transaction_no_stopped_events",
+        "noStoppedEvents",
+        "with no charging_stopped status events",
+    ),
+    (
+        "validation_error_transaction_negative_kwh_consumed",
+        "negativeKwhConsumed",
+        "with negative kwhConsumed",
+    ),
+]
 
-    # transactions without charging_stopped status
-    df = conn.execute(
-        "SELECT id FROM transactions "
-        "WHERE id NOT IN "
-        "(SELECT transactionId "
-        "FROM transaction_meter_values "
-        "WHERE chargingStatusId = 1)"
-    ).df()
-
-    if not df.empty:
-        issues["validation_errors"].append(
-            {
-                "validation_error_transaction_no_stopped_events": f"Found {len(df['id'].to_list())} transactions "
-                f"with no charging_stopped status events",
-                "transactionsIds": df["id"].to_list(),
-            }
-        )
 
-    df = conn.execute("SELECT id FROM transactions " "WHERE kwhConsumed < 0").df()
+# all transaction checks in a single pass: the meter values are grouped by transaction once
+# (has any event / has a charging_stopped event, false if all its events have a NULL chargingStatusId)
+# and anti-joined with the transactions
+def validate_transactions(conn, queries) -> List[ValidationIssue]:
+    df = queries.df(
+        conn,
+        "validate_transactions",
+        "WITH transaction_events AS ("
+        "    SELECT transactionId, bool_or(coalesce(chargingStatusId = 1, false)) AS hasStoppedEvent "
+        "    FROM transaction_meter_values "
+        "    GROUP BY transactionId"
+        ") "
+        "SELECT tr.id, "
+        "te.transactionId IS NULL AS noStatusEvents, "
+        "coalesce(NOT te.hasStoppedEvent, true) AS noStoppedEvents, "
+        "coalesce(tr.kwhConsumed < 0, false) AS negativeKwhConsumed "
+        "FROM transactions tr "
+        "LEFT JOIN transaction_events te ON tr.id = te.transactionId "
+        "WHERE te.transactionId IS NULL OR NOT te.hasStoppedEvent OR tr.kwhConsumed < 0 "
+        "ORDER BY tr.id",
+    )
 
-    if not df.empty:
-        issues["validation_errors"].append(
-            {
-                "validation_error_transaction_negative_kwh_consumed": f"Found {len(df['id'].to_list())} transactions "
-                f"with negative kwhConsumed",
-                "transactionsIds": df["id"].to_list(),
-            }
-        )
+    issues = []
+    for name, column, description in TRANSACTION_CHECKS:
+        ids = df.loc[df[column], "id"].to_list()
+        if ids:
+            issues.append(_issue(name, f"Found {len(ids)} transactions {description}", "transactionsIds", ids))
+    return issues
+
+
+# Latest validation issues, validated again when the fingerprint of the validated files changes.
+# Requests wait for a running validation instead of starting their own.
+# The background revalidation keeps them up-to-date, so requests don't wait for a validation.
+class ValidationCache:
+    def __init__(
+        self,
+        fingerprint: Callable[[], Hashable],
+        validate: Callable[[], List[ValidationIssue]],
+    ):
+        self._fingerprint = fingerprint
+        self._validate = validate
+        self._lock = threading.Lock()
+        # (fingerprint, validated at, issues)
+        self._results = None
+
+    # returns (issues, validated at)
+    def issues(self) -> Tuple[List[ValidationIssue], datetime]:
+        fingerprint = self._fingerprint()
+        with self._lock:
+            if self._results is None or self._results[0] != fingerprint:
+                issues = self._validate()
+                self._results = (fingerprint, datetime.now(timezone.utc), issues)
+                logger.info(f"Validated the data: {len(issues)} issues")
+            return self._results[2], self._results[1]
+
+    # validates now, then checks the fingerprint every interval_s
+    def start_background_revalidation(self, interval_s: float) -> threading.Thread:
+        def revalidate():
+            while True:
+                try:
+                    self.issues()
+                except Exception:
+                    logger.exception("Background validation failed")
+                time.sleep(interval_s)
+
+        thread = threading.Thread(target=revalidate, name="chargecloud-validation", daemon=True)
+        thread.start()
+        return thread
+
+
+# the issues with all their ids (same response as before the validation was cached)
+def full_response(issues: List[ValidationIssue]) -> dict:
+    if not issues:
+        return {}
+    return {
+        "validation_errors": [
+            {issue.name: issue.message, issue.ids_key: issue.ids} for issue in issues
+        ]
+    }
+
+
+def counts_response(issues: List[ValidationIssue], validated_at: datetime) -> dict:
+    return {
+        "validation_errors": [
+            {issue.name: issue.message, "count": len(issue.ids)} for issue in issues
+        ],
+        "validatedAt": validated_at.isoformat(),
+    }
+
+
+# ids of an issue in ascending order, after the cursor (the last id of the previous page)
+def page_response(
+    issues: List[ValidationIssue], name: str, limit: int, cursor: Optional[int], validated_at: datetime
+) -> Optional[dict]:
+    issue = next((issue for issue in issues if issue.name == name), None)
+    if issue is None:
+        return None
+    start = 0 if cursor is None else int(np.searchsorted(issue.sorted_ids, cursor, side="right"))
+    page_ids = issue.sorted_ids[start : start + limit]
+    has_next = start + limit < issue.sorted_ids.size
+    return {
+        name: issue.message,
+        issue.ids_key: page_ids.tolist(),
+        "count": int(page_ids.size),
+        "total": int(issue.sorted_ids.size),
+        "nextCursor": int(page_ids[-1]) if has_next else None,
+        "validatedAt": validated_at.isoformat(),
+    }
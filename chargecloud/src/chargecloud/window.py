@@ -0,0 +1,67 @@
+import pandas as pd
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, Tuple
+
+# page size used when a cursor is given without a limit
+DEFAULT_PAGE_LIMIT = 1000
+
+
+# parses an ISO 8601 timestamp, timezone-aware timestamps are converted to UTC (the db timestamps are naive UTC)
+# raises ValueError if it isn't one (e.g. a number or an object of a json payload)
+def parse_timestamp(value) -> datetime:
+    if not isinstance(value, (str, datetime)):
+        raise ValueError(f"{value} is not a timestamp")
+    timestamp = pd.Timestamp(value)
+    if pd.isna(timestamp):
+        raise ValueError(f"{value} is not a timestamp")
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert("UTC").tz_localize(None)
+    return timestamp.to_pydatetime()
+
+
+# Half-open time window [start, end) on a timestamp column, unbounded on a side whose bound is None.
+@dataclass(frozen=True)
+class TimeWindow:
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+
+    # raises ValueError on invalid bounds
+    @classmethod
+    def parse(cls, time_from=None, time_to=None) -> "TimeWindow":
+        start = parse_timestamp(time_from) if time_from else None
+        end = parse_timestamp(time_to) if time_to else None
+        if start is not None and end is not None and start >= end:
+            raise ValueError(f"from ({time_from}) must be before to ({time_to})")
+        return cls(start, end)
+
+    # sql predicate selecting the window on a column and its parameters
+    # (plain comparisons on the column, so duckdb can skip row groups using their min/max startedAt)
+    def predicate(self, column: str) -> Tuple[str, list]:
+        clauses, params = [], []
+        if self.start is not None:
+            clauses.append(f"{column} >= ?")
+            params.append(self.start)
+        if self.end is not None:
+            clauses.append(f"{column} < ?")
+            params.append(self.end)
+        return " AND ".join(clauses) or "true", params
+
+    # predicate selecting the months ("YYYY-MM" strings) overlapping the window on a month column
+    def month_predicate(self, column: str) -> Tuple[str, list]:
+        clauses, params = [], []
+        if self.start is not None:
+            clauses.append(f"{column} >= ?")
+            params.append(self.start.strftime("%Y-%m"))
+        if self.end is not None:
+            clauses.append(f"{column} <= ?")
+            params.append(self.end.strftime("%Y-%m"))
+        return " AND ".join(clauses) or "true", params
+
+    # the bounds fall on hour boundaries, so the window selects whole hourly buckets
+    def is_hour_aligned(self) -> bool:
+        return all(
+            bound is None or bound == bound.replace(minute=0, second=0, microsecond=0)
+            for bound in (self.start, self.end)
+        )
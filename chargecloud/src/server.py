@@ -1,11 +1,17 @@
 import logging
 import os
 import pathlib
+import threading
+import time
 
-from bottle import run, route, HTTPResponse, request
+from bottle import install, run, route, HTTPResponse, request
 
-from chargecloud.repository import ChargeCloudRepository
+# only light modules are imported before the server listens,
+# the repository and its dependencies (pandas, duckdb, geopy, ...) are imported by the startup thread
+from chargecloud.metrics import METRICS
+from chargecloud.serving import MetricsPlugin, ReadinessPlugin, ThreadPoolServer
 
+STARTED_AT = time.perf_counter()
 
 DB_PATH = (
     os.getenv("DB_PATH")
@@ -15,29 +21,198 @@ DB_PATH = (
     )
 )
 
+ROLLUP_PATH = os.getenv("ROLLUP_PATH")
+
+# sidecar db of the transactions / meter values ingested with POST /ingest, disabled if not set
+LIVE_PATH = os.getenv("LIVE_PATH")
+
+# directory of a parquet export of the db (python -m chargecloud.parquet), read instead of DB_PATH if set
+PARQUET_PATH = os.getenv("PARQUET_PATH")
+
+RADIUS_BOUNDARY_TOLERANCE = float(os.getenv("RADIUS_BOUNDARY_TOLERANCE", 0.01))
+
+# reverse geocoding of locations missing from the locations cache
+# "nominatim": the public Nominatim service allows 1 request/second, a self-hosted instance can go faster
+# "offline": nearest point of a local reference dataset, no network and no rate limit needed
+GEOCODER = os.getenv("GEOCODER", "nominatim")
+GEOCODER_DOMAIN = os.getenv("GEOCODER_DOMAIN", "nominatim.openstreetmap.org")
+GEOCODER_SCHEME = os.getenv("GEOCODER_SCHEME", "https")
+# offline: the gazetteer to geocode from (csv with latitude, longitude, city, state, country columns)
+# default: the reference dataset shipped in chargecloud/resources, built from the locations geocoded so far
+GEOCODER_REFERENCE_PATH = os.getenv("GEOCODER_REFERENCE_PATH")
+# offline: the address of the nearest reference point is used up to this distance
+GEOCODER_CITY_DISTANCE_KM = float(os.getenv("GEOCODER_CITY_DISTANCE_KM", 2))
+# offline: "nominatim" geocodes the locations further than GEOCODER_CITY_DISTANCE_KM from the reference points online
+# (GEOCODER_DOMAIN / GEOCODER_SCHEME, GEOCODER_FALLBACK_RATE_LIMIT requests/second), disabled if not set
+GEOCODER_FALLBACK = os.getenv("GEOCODER_FALLBACK")
+GEOCODER_FALLBACK_RATE_LIMIT = float(os.getenv("GEOCODER_FALLBACK_RATE_LIMIT", 1))
+GEOCODER_RATE_LIMIT = float(
+    os.getenv("GEOCODER_RATE_LIMIT", 0 if GEOCODER == "offline" else 1)
+)
+GEOCODER_WORKERS = int(os.getenv("GEOCODER_WORKERS", 1))
+GEOCODER_BATCH_SIZE = int(os.getenv("GEOCODER_BATCH_SIZE", 100))
+
+# response cache of the statistics, blocking time and reliability endpoints, 0 entries disables it
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1024))
+RESPONSE_CACHE_TTL_S = float(os.getenv("RESPONSE_CACHE_TTL_S", 300))
+RESPONSE_CACHE_MAX_MB = float(os.getenv("RESPONSE_CACHE_MAX_MB", 64))
+
+# interval of the background validation of the data (validated again if the db changed), 0 disables it
+VALIDATION_INTERVAL_S = float(os.getenv("VALIDATION_INTERVAL_S", 0))
+
+# number of worker processes computing the city / state statistics shard by shard, 1 computes them in the server
+STATISTICS_WORKERS = int(os.getenv("STATISTICS_WORKERS", 1))
+
+# interval of the check for a replaced db file (parquet export manifest), reloaded without restarting. 0 disables it
+RELOAD_INTERVAL_S = float(os.getenv("RELOAD_INTERVAL_S", 5))
+
 VERBOSE = os.getenv("VERBOSE", False)
 
 WEBSERVER_PORT = os.getenv("WEBSERVER_PORT", 8080)
 
+# number of worker threads serving requests concurrently, 1 uses bottle's default single-threaded server
+WEBSERVER_WORKERS = int(os.getenv("WEBSERVER_WORKERS", 1))
+
 logging.basicConfig(
     level=logging.DEBUG if VERBOSE else logging.INFO,
     format="%(asctime)-15s:%(name)s: %(levelname)s: %(message)s",
 )
 
 
-logging.info(">>> Charge Cloud monitoring server starting")
+# set by the startup thread once the repository is loaded and its indexes are warm, the routes answer 503 until then
+repo = None
+
+
+# loads the repository while the server already accepts connections,
+# geocoding of locations missing from the cache and the rollup refresh continue in the background.
+# The server exits if the repository can't be loaded.
+def start_repository():
+    global repo
+
+    try:
+        from chargecloud.geocoding import (
+            REVERSE_GEOCODING_REFERENCE_PATH,
+            OfflineReverseGeocoder,
+        )
+        from chargecloud.repository import ChargeCloudRepository
+
+        def nominatim():
+            from geopy.geocoders import Nominatim
+
+            return Nominatim(
+                user_agent="chargecloud_monitoring",
+                domain=GEOCODER_DOMAIN,
+                scheme=GEOCODER_SCHEME,
+            )
+
+        if GEOCODER == "offline":
+            if not GEOCODER_REFERENCE_PATH:
+                logging.warning(
+                    "GEOCODER_REFERENCE_PATH not set: geocoding offline from the bundled reference dataset, "
+                    "which only covers the places of the locations geocoded so far"
+                )
+            geocoder = OfflineReverseGeocoder(
+                GEOCODER_REFERENCE_PATH or REVERSE_GEOCODING_REFERENCE_PATH,
+                max_city_distance_km=GEOCODER_CITY_DISTANCE_KM,
+                fallback=nominatim() if GEOCODER_FALLBACK == "nominatim" else None,
+                fallback_rate_limit_per_s=GEOCODER_FALLBACK_RATE_LIMIT,
+            )
+        else:
+            geocoder = nominatim()
+
+        repository = ChargeCloudRepository(
+            DB_PATH,
+            rollup_path=ROLLUP_PATH,
+            parquet_path=PARQUET_PATH,
+            validation_interval_s=VALIDATION_INTERVAL_S,
+            radius_boundary_tolerance=RADIUS_BOUNDARY_TOLERANCE,
+            background_startup=True,
+            reload_interval_s=RELOAD_INTERVAL_S,
+            live_path=LIVE_PATH,
+            statistics_workers=STATISTICS_WORKERS,
+            geocoding_options={
+                "geocoder": geocoder,
+                "rate_limit_per_s": GEOCODER_RATE_LIMIT,
+                "max_workers": GEOCODER_WORKERS,
+                "batch_size": GEOCODER_BATCH_SIZE,
+            },
+            response_cache_options=(
+                {
+                    "max_entries": RESPONSE_CACHE_MAX_ENTRIES,
+                    "ttl_s": RESPONSE_CACHE_TTL_S,
+                    "max_bytes": int(RESPONSE_CACHE_MAX_MB * 1024 * 1024),
+                }
+                if RESPONSE_CACHE_MAX_ENTRIES > 0
+                else None
+            ),
+        )
+        repository.warm_up()
+    except Exception:
+        logging.exception(">>> Charge Cloud monitoring server failed to start")
+        os._exit(1)
+
+    repo = repository
+    logging.info(
+        f">>> Ready for requests, started in {time.perf_counter() - STARTED_AT:.2f}s"
+    )
+
 
-repo = ChargeCloudRepository(DB_PATH)
+# streamed bodies (?stream=json|ndjson) are generators sent chunk by chunk
+def response(code, body):
+    from chargecloud.streaming import CONTENT_TYPES
+
+    if isinstance(body, (dict, str)):
+        return HTTPResponse(status=code, body=body)
+    return HTTPResponse(
+        status=code, body=body, content_type=CONTENT_TYPES[request.query.stream]
+    )
 
 
 @route("/", method="GET")
 def index():
+    if repo is None:
+        return HTTPResponse(status=503, body={"status": "Starting"})
     return HTTPResponse(status=200, body={"status": "Ready for requests"})
 
 
 @route("/validate", method="GET")
 def validate():
-    code, body = repo.validate()
+    code, body = repo.validate(
+        counts_only=request.query.get("counts", "false").lower() in ["true", "1"],
+        issue=request.query.get("issue"),
+        limit=request.query.get("limit"),
+        cursor=request.query.get("cursor"),
+    )
+    return HTTPResponse(status=code, body=body)
+
+
+@route("/cache/stats", method="GET")
+def cache_stats():
+    code, body = repo.response_cache_stats()
+    return HTTPResponse(status=code, body=body)
+
+
+@route("/queries/stats", method="GET")
+def query_stats():
+    code, body = repo.query_stats()
+    return HTTPResponse(status=code, body=body)
+
+
+# histograms of the request / repository method / query / materialization / serialization times (prometheus format)
+@route("/metrics", method="GET")
+def metrics():
+    return HTTPResponse(
+        status=200, body=METRICS.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+# micro-batch of transactions / meter values, added to the statistics and chargepoint reliability
+@route("/ingest", method="POST")
+def ingest():
+    code, body = repo.ingest(
+        transactions=request.json.get("transactions"),
+        meter_values=request.json.get("meterValues"),
+    )
     return HTTPResponse(status=code, body=body)
 
 
@@ -47,13 +222,36 @@ def station_statistics(station_id, statistics_type, interval_type):
         station_id=station_id,
         statistics_type=statistics_type,
         interval_type=interval_type,
+        stream_format=request.query.get("stream"),
+        time_from=request.query.get("from"),
+        time_to=request.query.get("to"),
+        limit=request.query.get("limit"),
+        cursor=request.query.get("cursor"),
     )
-    return HTTPResponse(status=code, body=body)
+    return response(code, body)
 
 
 @route("/station/:station_id/blockingTime", method="GET")
 def station_blocking_time(station_id):
-    code, body = repo.get_blocking_time_by_station(station_id=station_id)
+    code, body = repo.get_blocking_time_by_station(
+        station_id=station_id,
+        stream_format=request.query.get("stream"),
+        time_from=request.query.get("from"),
+        time_to=request.query.get("to"),
+        limit=request.query.get("limit"),
+        cursor=request.query.get("cursor"),
+        duration_format=request.query.get("duration_format", "iso"),
+        summary=request.query.get("summary", "false").lower() in ["true", "1"],
+    )
+    return response(code, body)
+
+
+# kwh price of a station at ?ts= (repeated for several timestamps)
+@route("/station/:station_id/priceAt", method="GET")
+def station_price_at(station_id):
+    code, body = repo.get_price_at(
+        station_id=station_id, timestamps=request.query.getall("ts")
+    )
     return HTTPResponse(status=code, body=body)
 
 
@@ -68,8 +266,13 @@ def city_statistics():
         for_city=True,
         statistics_type=statistics_type,
         interval_type=interval_type,
+        stream_format=request.query.get("stream"),
+        time_from=request.json.get("from"),
+        time_to=request.json.get("to"),
+        limit=request.json.get("limit"),
+        cursor=request.json.get("cursor"),
     )
-    return HTTPResponse(status=code, body=body)
+    return response(code, body)
 
 
 @route("/state/statistics", method="POST")
@@ -83,6 +286,27 @@ def state_statistics():
         for_city=False,
         statistics_type=statistics_type,
         interval_type=interval_type,
+        stream_format=request.query.get("stream"),
+        time_from=request.json.get("from"),
+        time_to=request.json.get("to"),
+        limit=request.json.get("limit"),
+        cursor=request.json.get("cursor"),
+    )
+    return response(code, body)
+
+
+# statistics of several stations / cities / states in a single request
+@route("/statistics/batch", method="POST")
+def statistics_batch():
+    payload = request.json or {}
+    code, body = repo.get_statistics_batch(
+        interval_type=payload.get("interval_type"),
+        station_ids=payload.get("station_ids"),
+        city_names=payload.get("city_names"),
+        state_names=payload.get("state_names"),
+        statistics_types=payload.get("statistics_types"),
+        time_from=payload.get("from"),
+        time_to=payload.get("to"),
     )
     return HTTPResponse(status=code, body=body)
 
@@ -95,6 +319,17 @@ def chargepoint_reliability(chargepoint_id):
     return HTTPResponse(status=code, body=body)
 
 
+# reliability of all chargepoints (GET) or of the chargepoints in the payload (POST)
+@route("/chargepoints/reliability", method=["GET", "POST"])
+def chargepoints_reliability():
+    chargepoint_ids = (request.json or {}).get("chargepoint_ids")
+
+    code, body = repo.get_charge_points_status_event_reliability_pct(
+        chargepoint_ids=chargepoint_ids
+    )
+    return HTTPResponse(status=code, body=body)
+
+
 @route("/stationsInRadius", method="POST")
 def stations_in_radius():
     latitude = request.json["latitude"]
@@ -109,14 +344,14 @@ def stations_in_radius():
 
 @route("/chargepoints/list", method="GET")
 def list_chargepoints():
-    code, body = repo.list_all("chargepoints")
-    return HTTPResponse(status=code, body=body)
+    code, body = repo.list_all("chargepoints", stream_format=request.query.get("stream"))
+    return response(code, body)
 
 
 @route("/stations/list", method="GET")
 def list_stations():
-    code, body = repo.list_all("stations")
-    return HTTPResponse(status=code, body=body)
+    code, body = repo.list_all("stations", stream_format=request.query.get("stream"))
+    return response(code, body)
 
 
 @route("/cities/list", method="GET")
@@ -131,4 +366,23 @@ def list_states():
     return HTTPResponse(status=code, body=body)
 
 
-run(host="0.0.0.0", port=WEBSERVER_PORT)
+# timings of every route, ?profile=1 / ?profile=cprofile
+install(MetricsPlugin())
+# 503 until the repository is loaded
+install(ReadinessPlugin(lambda: repo is not None))
+
+# the worker processes of the sharded statistics import this module too (spawn), they must not start a server
+if __name__ == "__main__":
+    logging.info(">>> Charge Cloud monitoring server starting")
+
+    threading.Thread(target=start_repository, name="chargecloud-startup", daemon=True).start()
+
+    if WEBSERVER_WORKERS > 1:
+        run(
+            server=ThreadPoolServer,
+            host="0.0.0.0",
+            port=WEBSERVER_PORT,
+            workers=WEBSERVER_WORKERS,
+        )
+    else:
+        run(host="0.0.0.0", port=WEBSERVER_PORT)